@@ -1,7 +1,74 @@
 # apps/tree_capitator/admin.py
 
 from django.contrib import admin
-from .models import DataSet, File_Model
+from django.core.exceptions import PermissionDenied
+from django.http import FileResponse, Http404
+from django.urls import path, reverse
+from django.utils.html import format_html, format_html_join
+from .models import DataSet, File_Model, Mosaic, TempResult
+from .profiling import profile_storage
 
 admin.site.register(DataSet)
 admin.site.register(File_Model)
+admin.site.register(Mosaic)
+
+
+@admin.register(TempResult)
+class TempResultAdmin(admin.ModelAdmin):
+    list_display = ("petition_key", "created_at", "feature_count", "profiled")
+    search_fields = ("petition_key",)
+    exclude = ("json_data", "profile_summary")
+    readonly_fields = ("petition_key", "created_at", "metrics", "profile", "profile_download", "hotspots")
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.display(boolean=True, description="perfil")
+    def profiled(self, obj):
+        return bool(obj.profile)
+
+    @admin.display(description="descargar perfil")
+    def profile_download(self, obj):
+        if not obj.profile:
+            return "-"
+        url = reverse("admin:tree_capitator_tempresult_profile", args=[obj.pk])
+        return format_html('<a href="{}">{}</a>', url, obj.profile.rsplit("/", 1)[-1])
+
+    @admin.display(description="funciones más costosas")
+    def hotspots(self, obj):
+        if not obj.profile_summary:
+            return "-"
+        rows = format_html_join(
+            "",
+            "<tr><td>{}</td><td>{}:{}</td><td>{}</td><td>{}</td><td>{}</td></tr>",
+            (
+                (row["function"], row["file"], row["line"], row["calls"], row["tottime"], row["cumtime"])
+                for row in obj.profile_summary
+            ),
+        )
+        return format_html(
+            "<table><thead><tr><th>función</th><th>archivo</th><th>llamadas</th>"
+            "<th>tiempo propio (s)</th><th>tiempo acumulado (s)</th></tr></thead><tbody>{}</tbody></table>",
+            rows,
+        )
+
+    def get_urls(self):
+        return [
+            path(
+                "<int:pk>/profile/",
+                self.admin_site.admin_view(self.download_profile),
+                name="tree_capitator_tempresult_profile",
+            ),
+        ] + super().get_urls()
+
+    def download_profile(self, request, pk):
+        result = self.get_object(request, pk)
+        if result is not None and not self.has_view_permission(request, result):
+            raise PermissionDenied
+        if result is None or not result.profile or not profile_storage.exists(result.profile):
+            raise Http404("Perfil no encontrado")
+        return FileResponse(
+            profile_storage.open(result.profile, "rb"),
+            as_attachment=True,
+            filename=f"{result.petition_key}.prof",
+        )
@@ -0,0 +1,420 @@
+"""
+Benchmarks del análisis con rasters y parcelas sintéticos.
+
+Genera GeoTIFF teselados como los que deja la ingesta (códigos Hansen 0-24,
+clasificaciones 0 / 0.5 / 1 encadenadas por año e índices de cultivo) con sus
+áreas por fila y, opcionalmente, sus pirámides, y conjuntos de parcelas de
+distinto número y tamaño. Sobre ellos mide:
+
+- cada analizador de ``engine.py`` por separado y los tres juntos;
+- ``modelo_gdf`` completo (Celery en modo eager, clima contra
+  ``fake_open_meteo`` y descripciones con el backend ``stub``), dentro de una
+  transacción que se revierte al terminar;
+- las vistas de subida, estado y resultados.
+
+Cada caso reporta segundos (primera corrida, mínimo y mediana), polígonos/s,
+píxeles/s y el pico de memoria residente, para comparar entre commits. Se
+ejecuta con ``manage.py benchmark_pipeline``.
+"""
+import json
+import math
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from unittest import mock
+
+import geopandas as gpd
+from asgiref.sync import async_to_sync
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely import affinity
+from shapely.geometry import box
+
+from . import engine
+from .fingerprint import catalog_versions
+from .models import DataSet, HistoryState, PolygonResult
+from .pixelarea import row_areas, save_row_areas
+from .pyramid import build_hansen_pyramid, build_history_pyramid
+from .zonal import LabelGrid, PolygonSet
+
+
+ORIGIN = (-74.0, 4.0)
+RESOLUTION = 0.0001   # grados (~11 m)
+
+PARCEL_SIZES = {
+    "small": (0.5, 5),      # hectáreas
+    "medium": (5, 50),
+    "large": (50, 500),
+}
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _write(path, data, nodata, transform):
+    with rasterio.open(
+        path, "w", driver="GTiff",
+        height=data.shape[0], width=data.shape[1], count=1, dtype=data.dtype,
+        crs="EPSG:4326", transform=transform, nodata=nodata,
+        tiled=True, blockxsize=256, blockysize=256, compress="DEFLATE",
+    ) as dst:
+        dst.write(data, 1)
+
+
+def synthetic_catalog(directory, size=4000, years=5, indices=2, pyramids=False, tile_size=256, seed=0):
+    """
+    Escribe los rasters en ``directory`` y devuelve un catálogo con la forma de
+    ``catalog.load_catalog``. Las claves llevan un token aleatorio para que
+    los resultados guardados de corridas anteriores no se reutilicen.
+    """
+    rng = np.random.default_rng(seed)
+    transform = from_origin(ORIGIN[0], ORIGIN[1], RESOLUTION, RESOLUTION)
+    token = uuid.uuid4().hex[:8]
+    areas = row_areas("EPSG:4326", transform, size, size)
+    area_path = os.path.join(directory, "area.npy")
+    save_row_areas(area_path, areas)
+
+    def source(path, year, subcategory, pyramid=None):
+        key = f"bench-{token}:{os.path.basename(path)}"
+        return engine.RasterSource(path, datetime(year, 1, 1), subcategory, key, pyramid, area_path)
+
+    # Hansen: 10 % de los píxeles con año de pérdida 1-24
+    hansen = np.where(rng.random((size, size)) < 0.1, rng.integers(1, 25, (size, size)), 0).astype("uint8")
+    hansen_path = os.path.join(directory, "hansen.tif")
+    _write(hansen_path, hansen, 255, transform)
+    hansen_pyramid = None
+    if pyramids:
+        pyramid_path = os.path.join(directory, "hansen.npz")
+        build_hansen_pyramid(hansen_path, tile_size, row_area=areas).save(pyramid_path)
+        hansen_pyramid = {"path": pyramid_path, "previous": None, "tile_size": tile_size}
+    hansen_sources = [source(hansen_path, 2020, 0, hansen_pyramid)]
+
+    # Histórico: cada año una parte del bosque (1) pasa a deforestación (0.5)
+    classes = rng.choice(np.array([0, 0.5, 1], dtype="float32"), size=(size, size), p=[0.3, 0.1, 0.6])
+    history_sources = []
+    for k in range(years):
+        if k:
+            classes = np.where((classes == 1) & (rng.random((size, size)) < 0.05), 0.5, classes).astype("float32")
+        path = os.path.join(directory, f"classificado_{2020 + k}.tif")
+        _write(path, classes, -1, transform)
+        pyramid = None
+        if pyramids:
+            previous = history_sources[-1] if history_sources else None
+            pyramid_path = os.path.join(directory, f"classificado_{2020 + k}.npz")
+            built = build_history_pyramid(
+                path, tile_size,
+                previous_path=previous.path if previous else None,
+                previous=previous.key if previous else None,
+                row_area=areas,
+            )
+            built.save(pyramid_path)
+            pyramid = {"path": pyramid_path, "previous": built.previous, "tile_size": tile_size}
+        history_sources.append(source(path, 2020 + k, 1, pyramid))
+
+    index_sources = []
+    for subcategory, label in list(DataSet.SUBCATEGORY_DATASET[1].items())[:indices]:
+        path = os.path.join(directory, f"{label.lower()}.tif")
+        _write(path, rng.random((size, size), dtype="float32"), None, transform)
+        index_sources.append((label, [source(path, 2024, subcategory)]))
+
+    files = {(0, 0): hansen_sources, (0, 1): history_sources}
+    for subcategory, (label, sources) in enumerate(index_sources):
+        files[(1, subcategory)] = sources
+    return {
+        "version": None,
+        "files": files,
+        "tiles": {},
+        "history": history_sources,
+        "hansen": hansen_sources,
+        "index": index_sources,
+    }
+
+
+def synthetic_parcels(count, size="small", raster_size=4000, seed=0):
+    """Parcelas rectangulares rotadas dentro de la extensión de los rasters."""
+    rng = np.random.default_rng(seed)
+    min_ha, max_ha = PARCEL_SIZES[size]
+    extent = raster_size * RESOLUTION
+    metres_per_degree = 111_320
+
+    parcels = []
+    for _ in range(count):
+        area_m2 = math.exp(rng.uniform(math.log(min_ha), math.log(max_ha))) * 10_000
+        aspect = rng.uniform(0.5, 2)
+        width = math.sqrt(area_m2 * aspect) / metres_per_degree
+        height = math.sqrt(area_m2 / aspect) / metres_per_degree
+        margin = max(width, height)
+        x = ORIGIN[0] + rng.uniform(margin, extent - margin)
+        y = ORIGIN[1] - rng.uniform(margin, extent - margin)
+        parcel = box(x - width / 2, y - height / 2, x + width / 2, y + height / 2)
+        parcels.append(affinity.rotate(parcel, rng.uniform(0, 90)))
+    return gpd.GeoDataFrame({"parcel": range(count)}, geometry=parcels, crs="EPSG:4326")
+
+
+def _peak_rss_mb():
+    """Pico de memoria residente del proceso (VmHWM) en MB."""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _reset_peak_rss():
+    # Linux permite reiniciar VmHWM; en otros sistemas el pico es acumulado
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def measure(run, repeat):
+    """Corre ``run`` ``repeat`` veces y devuelve tiempos y pico de memoria."""
+    _reset_peak_rss()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return {
+        "seconds": {
+            "first": times[0],
+            "min": min(times),
+            "median": statistics.median(times),
+        },
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "children_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+
+def _case(name, parcels, size, result, pixels=None):
+    seconds = result["seconds"]["median"]
+    case = {"name": name, "polygons": parcels, "parcel_size": size, **result}
+    case["polygons_per_s"] = round(parcels / seconds, 2) if seconds else None
+    if pixels is not None:
+        case["pixels"] = pixels
+        case["pixels_per_s"] = round(pixels / seconds) if seconds else None
+    return case
+
+
+def labelled_pixels(catalog, geometries):
+    """Píxeles de las parcelas en un raster de la rejilla (sin pirámide)."""
+    with rasterio.open(catalog["hansen"][0].path) as src:
+        return int(LabelGrid.for_source(PolygonSet(geometries), src).labels.size)
+
+
+def benchmark_analyzers(catalog, geometries, size, repeat, pool_size=1):
+    per_raster = labelled_pixels(catalog, geometries)
+    n = len(geometries)
+    analyzers = {
+        "deforestation_history": (
+            lambda: engine.deforestation_history_stats(catalog["history"], geometries),
+            len(catalog["history"]),
+        ),
+        "deforestation_hansen": (
+            lambda: engine.deforestation_hansen_stats(catalog["hansen"], geometries),
+            len(catalog["hansen"]),
+        ),
+        "index_crops": (
+            lambda: engine.index_stats(catalog["index"], geometries),
+            sum(len(sources) for _, sources in catalog["index"]),
+        ),
+        "all": (
+            lambda: engine.run_raster_analysis_pool(catalog, geometries, pool_size),
+            engine.count_sources(catalog),
+        ),
+    }
+    return [
+        _case(f"analyzer:{name}", n, size, measure(run, repeat), per_raster * rasters)
+        for name, (run, rasters) in analyzers.items()
+    ]
+
+
+@contextmanager
+def stubbed_pipeline(catalog):
+    """
+    Entorno de ``modelo_gdf`` sin servicios externos: Celery eager, clima
+    contra el servidor falso, descripciones ``stub`` y el catálogo sintético
+    en lugar del de Postgres.
+    """
+    from celery import current_app
+    from django.test.utils import override_settings
+
+    from .fake_open_meteo import running_fake_open_meteo
+
+    conf = current_app.conf
+    eager = conf.task_always_eager, conf.task_eager_propagates
+    conf.task_always_eager, conf.task_eager_propagates = True, True
+    try:
+        with running_fake_open_meteo() as server, override_settings(
+            OPEN_METEO_URL=server.url,
+            DESCRIPTION_BACKEND="stub",
+            DESCRIPTIONS_DEFERRED=False,
+        ), mock.patch("apps.tree_capitator.tasks.catalog_snapshot", return_value=catalog), \
+                mock.patch("apps.tree_capitator.tasks.rasters_outside", return_value=frozenset()):
+            yield
+    finally:
+        conf.task_always_eager, conf.task_eager_propagates = eager
+
+
+def clear_analysis_cache(catalog):
+    """
+    Borra los ``PolygonResult`` y ``HistoryState`` calculados con el catálogo
+    sintético, para que cada repetición del pipeline corra en frío.
+    """
+    PolygonResult.objects.filter(catalog_version__in=set(catalog_versions(catalog).values())).delete()
+    if catalog["history"]:
+        HistoryState.objects.filter(state__chain__0=catalog["history"][0].key).delete()
+
+
+def benchmark_pipeline(catalog, parcels, size, repeat, include_views=True):
+    """
+    Sube las parcelas por la vista, corre ``modelo_gdf`` completo y consulta
+    el estado y los resultados. Todo se revierte al terminar. Antes de cada
+    repetición se borran los resultados guardados de la anterior, así que
+    todas miden el análisis completo y no la caché por polígono.
+    """
+    from django.db import transaction
+    from django.test import Client
+
+    from .tasks import modelo_gdf
+
+    client = Client(HTTP_HOST="localhost")
+    payload = parcels.to_json().encode()
+    n = len(parcels)
+    timings = {"upload": [], "pipeline": [], "status": [], "results": [], "stream": []}
+    peak = {}
+
+    def timed(name, call):
+        start = time.perf_counter()
+        value = call()
+        timings[name].append(time.perf_counter() - start)
+        return value
+
+    def upload():
+        # La vista sólo guarda el archivo y encola; la tarea se corre aparte
+        with mock.patch("apps.tree_capitator.views.modelo_gdf") as task:
+            response = client.post(
+                "/api/v1/upload_file/",
+                {"file": _named_file(payload, "parcelas.geojson")},
+            )
+        assert response.status_code == 200, response.content
+        return task.delay.call_args.args[:2]
+
+    _reset_peak_rss()
+    try:
+        with transaction.atomic(), stubbed_pipeline(catalog):
+            for _ in range(repeat):
+                clear_analysis_cache(catalog)
+                upload_path, petition_key = timed("upload", upload)
+                timed("pipeline", lambda: modelo_gdf.apply(args=(upload_path, petition_key)).get())
+                if include_views:
+                    timed("status", lambda: client.post(
+                        "/api/v1/model_status/", {"petition_key": petition_key},
+                        content_type="application/json",
+                    ).content)
+                    timed("results", lambda: client.get(f"/api/v1/results/{petition_key}/").content)
+                    timed("stream", lambda: _content(client.get(
+                        f"/api/v1/results/{petition_key}/stream/", HTTP_ACCEPT_ENCODING="gzip",
+                    )))
+            peak["peak_rss_mb"] = round(_peak_rss_mb(), 1)
+            raise _Rollback()
+    except _Rollback:
+        pass
+
+    cases = []
+    for name, times in timings.items():
+        if not times:
+            continue
+        result = {
+            "seconds": {"first": times[0], "min": min(times), "median": statistics.median(times)},
+            **peak,
+        }
+        cases.append(_case(f"{'view' if name != 'pipeline' else 'task'}:{name}", n, size, result))
+    return cases
+
+
+def _content(response):
+    # Consumir el cuerpo completo, también de las respuestas en streaming
+    if response.streaming and response.is_async:
+        return async_to_sync(_aread)(response.streaming_content)
+    if response.streaming:
+        return b"".join(response.streaming_content)
+    return response.content
+
+
+async def _aread(content):
+    return b"".join([part async for part in content])
+
+
+def _named_file(payload, name):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    return SimpleUploadedFile(name, payload, content_type="application/geo+json")
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "rasterio": rasterio.__version__,
+        "gdal": rasterio.__gdal_version__,
+        "cpus": os.cpu_count(),
+    }
+
+
+def run_benchmarks(directory, counts=(100, 1000), sizes=("small", "large"), raster_size=4000,
+                   years=5, indices=2, pyramids=False, repeat=3, pool_size=1,
+                   pipeline=True, views=True, log=print):
+    """Ejecuta todos los casos y devuelve el reporte como dict serializable."""
+    log("Generando rasters sintéticos...")
+    catalog = synthetic_catalog(directory, raster_size, years, indices, pyramids)
+
+    cases = []
+    for count in counts:
+        for size in sizes:
+            parcels = synthetic_parcels(count, size, raster_size, seed=count)
+            geometries = list(parcels.geometry)
+            log(f"{count} parcelas {size}: analizadores")
+            cases += benchmark_analyzers(catalog, geometries, size, repeat, pool_size)
+            if pipeline:
+                log(f"{count} parcelas {size}: modelo_gdf")
+                cases += benchmark_pipeline(catalog, parcels, size, repeat, views)
+
+    return {
+        "environment": environment(),
+        "config": {
+            "raster_size": raster_size,
+            "resolution_degrees": RESOLUTION,
+            "years": years,
+            "indices": indices,
+            "pyramids": pyramids,
+            "repeat": repeat,
+            "pool_size": pool_size,
+        },
+        "cases": cases,
+    }
+
+
+def dumps(report):
+    return json.dumps(report, indent=2, default=float)
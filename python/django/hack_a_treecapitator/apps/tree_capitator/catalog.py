@@ -0,0 +1,166 @@
+"""
+Catálogo de rasters que usan los análisis.
+
+El catálogo se lee de Postgres y se guarda en memoria del worker
+junto con un número de versión que vive en Dragonfly (``CATALOG:version``).
+Las señales ``post_save`` / ``post_delete`` de ``DataSet``, ``File_Model`` y ``Mosaic``
+incrementan la versión, así que un worker sólo vuelve a consultar Postgres
+cuando el catálogo cambió, aunque procese muchos trabajos seguidos.
+
+Los datasets que llegan por teselas aparecen como un mosaico por fecha (ver
+``mosaic.py``) en lugar de sus teselas sueltas. Los rasters que no tocan los
+polígonos de un trabajo se descartan con una consulta espacial sobre
+``File_Model.footprint`` (ver ``rasters_outside``).
+"""
+import redis
+from django.conf import settings
+from django.contrib.gis.geos import MultiPolygon, Polygon
+from django.db.models import Q
+
+from .engine import RasterSource
+from .models import DataSet, File_Model, Mosaic, large_storage
+
+
+VERSION_KEY = "CATALOG:version"
+
+_version_client = None
+_snapshot = None
+
+
+def version_client():
+    global _version_client
+    if _version_client is None:
+        _version_client = redis.Redis.from_url(settings.CATALOG_CACHE_URL, decode_responses=True)
+    return _version_client
+
+
+def catalog_version():
+    """Versión actual del catálogo, o None si Dragonfly no responde."""
+    try:
+        return int(version_client().get(VERSION_KEY) or 0)
+    except redis.RedisError as e:
+        print("Versión de catálogo no disponible:", e)
+        return None
+
+
+def bump_catalog_version():
+    try:
+        version_client().incr(VERSION_KEY)
+    except redis.RedisError as e:
+        print("No se pudo actualizar la versión del catálogo:", e)
+
+
+def _pyramid_source(file_obj):
+    pyramid = file_obj.get_pyramid()
+    if pyramid is None:
+        return None
+    return {
+        "path": large_storage.path(pyramid["path"]),
+        "previous": pyramid.get("previous"),
+        "tile_size": pyramid.get("tile_size"),
+    }
+
+
+def _pixel_area_source(file_obj):
+    pixel_area = file_obj.get_pixel_area()
+    return large_storage.path(pixel_area["path"]) if pixel_area else None
+
+
+def load_catalog(version=None):
+    """
+    Lee el catálogo de Postgres. ``files`` guarda la lista ordenada de
+    ``RasterSource`` de cada ``(categoría, subcategoría)``; ``history``,
+    ``hansen`` e ``index`` son las entradas que recorren los analizadores, y
+    ``tiles`` las teselas de cada mosaico.
+    """
+    files = {}
+    tiles = {}
+    mosaics = Mosaic.objects.select_related("dataset").order_by("date", "pk")
+    for mosaic in mosaics:
+        dataset = mosaic.dataset
+        files.setdefault((dataset.category, dataset.subcategory), []).append(RasterSource(
+            mosaic.raster_path(),
+            mosaic.date,
+            dataset.subcategory,
+            mosaic.content_key(),
+        ))
+        tiles[mosaic.content_key()] = mosaic.tiles
+
+    rasters = (
+        File_Model.objects.filter(file_type=0)
+        .exclude(dataset__in={mosaic.dataset_id for mosaic in mosaics})
+        .select_related("dataset")
+        .order_by("date", "pk")
+    )
+    for file_obj in rasters:
+        dataset = file_obj.dataset
+        files.setdefault((dataset.category, dataset.subcategory), []).append(RasterSource(
+            file_obj.raster_path(),
+            file_obj.date,
+            dataset.subcategory,
+            file_obj.content_key(),
+            _pyramid_source(file_obj),
+            _pixel_area_source(file_obj),
+        ))
+
+    for sources in files.values():
+        sources.sort(key=lambda source: source.date)
+
+    subcategory_dict = DataSet.SUBCATEGORY_DATASET[1]
+    index_subcategories = sorted(
+        DataSet.objects.filter(category=1).values_list("subcategory", flat=True).distinct()
+    )
+
+    return {
+        "version": version,
+        "files": files,
+        "tiles": tiles,
+        "history": files.get((0, 1), []),
+        "hansen": files.get((0, 0), []),
+        "index": [
+            (subcategory_dict[int(subcat)], files.get((1, subcat), []))
+            for subcat in index_subcategories
+        ],
+    }
+
+
+def catalog_snapshot():
+    """
+    Catálogo vigente. Se reutiliza la copia en memoria mientras la versión no
+    cambie; la versión se lee antes de consultar para no perder cambios que
+    lleguen durante la carga.
+    """
+    global _snapshot
+    version = catalog_version()
+    if version is None:
+        return load_catalog()
+    if _snapshot is None or _snapshot["version"] != version:
+        _snapshot = load_catalog(version)
+    return _snapshot
+
+
+def rasters_outside(catalog, geometries):
+    """
+    Claves de los rasters del catálogo cuya huella no toca la caja de ningún
+    polígono de ``geometries``, en una sola consulta. Se usan las cajas porque
+    así deciden los analizadores si un polígono se superpone a un raster (ver
+    ``zonal.pixel_windows``); los rasters sin huella se dan por dentro, y un
+    mosaico queda dentro si alguna de sus teselas lo está.
+    """
+    boxes = [Polygon.from_bbox(g.bounds) for g in geometries if g is not None and not g.is_empty]
+    if not boxes:
+        return frozenset()
+
+    inside = (
+        File_Model.objects.filter(file_type=0)
+        .filter(Q(footprint__isnull=True) | Q(footprint__intersects=MultiPolygon(boxes, srid=4326)))
+        .values_list("pk", "file")
+    )
+    inside_keys = {f"{pk}:{name}" for pk, name in inside}
+    tiles = catalog.get("tiles", {})
+    return frozenset(
+        source.key
+        for sources in catalog["files"].values()
+        for source in sources
+        if not any(key in inside_keys for key in tiles.get(source.key, [source.key]))
+    )
@@ -0,0 +1,189 @@
+"""
+Subida por partes y reanudable de archivos de polígonos.
+
+1. ``create_upload`` reserva el archivo completo en ``large_storage`` y guarda
+   la sesión en Dragonfly (``UPLOAD:{upload_id}``).
+2. Cada parte se escribe directamente en su posición del archivo con
+   ``write_part``, verificando su tamaño y su SHA-256. Las partes pueden
+   llegar en cualquier orden y en paralelo, y reenviarse si fallan.
+3. ``complete_upload`` comprueba que estén todas y mueve el archivo a su ruta
+   definitiva sin volver a leerlo. Sólo una llamada puede completar la
+   subida; las demás reciben 409.
+
+El estado de la sesión (partes recibidas) permite al cliente reanudar.
+"""
+import hashlib
+import math
+import os
+import uuid
+
+import redis
+from django.conf import settings
+
+from .loaders import is_supported, upload_name
+from .models import large_storage
+
+
+# Tamaño de los bloques en que se lee y copia cada parte
+BLOCK_SIZE = 1024 * 1024
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+_client = None
+
+
+def client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.CHUNKED_UPLOAD_URL, decode_responses=True)
+    return _client
+
+
+def _session_key(upload_id):
+    return f"UPLOAD:{upload_id}"
+
+
+def _completing_key(upload_id):
+    return f"{_session_key(upload_id)}:completing"
+
+
+def _partial_name(upload_id):
+    return f"chunked/{upload_id}.part"
+
+
+def _staged_name(upload_id, number):
+    # Un nombre por envío: la misma parte puede llegar dos veces en paralelo
+    return f"chunked/{upload_id}.{number}.{uuid.uuid4().hex}.tmp"
+
+
+def create_upload(filename, size, part_size=None):
+    part_size = int(part_size or settings.CHUNKED_UPLOAD_PART_SIZE)
+    size = int(size)
+    if not is_supported(filename):
+        raise UploadError("Formato de archivo no soportado")
+    if size <= 0 or size > settings.CHUNKED_UPLOAD_MAX_SIZE:
+        raise UploadError("Tamaño de archivo inválido")
+    if not settings.CHUNKED_UPLOAD_MIN_PART <= part_size <= settings.CHUNKED_UPLOAD_MAX_PART:
+        raise UploadError("Tamaño de parte inválido")
+
+    upload_id = uuid.uuid4().hex
+    path = large_storage.path(_partial_name(upload_id))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.truncate(size)
+
+    session = {
+        "filename": os.path.basename(filename),
+        "size": size,
+        "part_size": part_size,
+        "parts": math.ceil(size / part_size),
+    }
+    pipe = client().pipeline()
+    pipe.hset(_session_key(upload_id), mapping=session)
+    pipe.expire(_session_key(upload_id), settings.CHUNKED_UPLOAD_TTL)
+    pipe.execute()
+    return {"upload_id": upload_id, **session}
+
+
+def get_upload(upload_id):
+    session = client().hgetall(_session_key(upload_id))
+    if not session:
+        raise UploadError("Subida no encontrada o expirada", status=404)
+
+    received = client().hgetall(f"{_session_key(upload_id)}:parts")
+    return {
+        "upload_id": upload_id,
+        "filename": session["filename"],
+        "size": int(session["size"]),
+        "part_size": int(session["part_size"]),
+        "parts": int(session["parts"]),
+        "received": {int(number): checksum for number, checksum in received.items()},
+    }
+
+
+def write_part(upload_id, number, stream, checksum):
+    """
+    Escribe la parte ``number`` (desde 0) leyendo ``stream`` por bloques y
+    comprobando que su SHA-256 coincide con ``checksum``.
+    """
+    upload = get_upload(upload_id)
+    if not 0 <= number < upload["parts"]:
+        raise UploadError("Número de parte inválido")
+    if not checksum:
+        raise UploadError("Falta el checksum SHA-256 de la parte")
+
+    offset = number * upload["part_size"]
+    expected = min(upload["part_size"], upload["size"] - offset)
+
+    # La parte se escribe aparte y se verifica antes de tocar el archivo,
+    # para no dañar una parte ya recibida con un reenvío corrupto
+    staged = large_storage.path(_staged_name(upload_id, number))
+    try:
+        digest = hashlib.sha256()
+        length = 0
+        with open(staged, "wb") as file:
+            while length <= expected:
+                block = stream.read(min(BLOCK_SIZE, expected + 1 - length))
+                if not block:
+                    break
+                digest.update(block)
+                file.write(block)
+                length += len(block)
+
+        if length != expected:
+            raise UploadError(f"La parte {number} debe tener {expected} bytes")
+        if digest.hexdigest() != checksum.lower():
+            raise UploadError(f"Checksum inválido en la parte {number}")
+        if client().exists(_completing_key(upload_id)):
+            raise UploadError("La subida ya se está completando", status=409)
+
+        try:
+            with open(staged, "rb") as source, open(large_storage.path(_partial_name(upload_id)), "r+b") as file:
+                file.seek(offset)
+                while block := source.read(BLOCK_SIZE):
+                    file.write(block)
+        except FileNotFoundError:
+            raise UploadError("La subida ya se completó", status=409)
+    finally:
+        if os.path.exists(staged):
+            os.remove(staged)
+
+    key = f"{_session_key(upload_id)}:parts"
+    pipe = client().pipeline()
+    pipe.hset(key, number, digest.hexdigest())
+    pipe.expire(key, settings.CHUNKED_UPLOAD_TTL)
+    pipe.execute()
+
+
+def complete_upload(upload_id, petition_key):
+    """
+    Mueve el archivo completo a ``uploads/`` y devuelve su ruta en
+    ``large_storage``. La subida se reclama con ``SET NX`` antes de moverla:
+    si dos llamadas llegan a la vez, sólo una lanza el análisis.
+    """
+    upload = get_upload(upload_id)
+    if not client().set(_completing_key(upload_id), petition_key, nx=True, ex=settings.CHUNKED_UPLOAD_TTL):
+        raise UploadError("La subida ya se está completando", status=409)
+
+    try:
+        # Se vuelve a leer: una parte pudo terminar justo antes del reclamo
+        upload = get_upload(upload_id)
+        missing = [n for n in range(upload["parts"]) if n not in upload["received"]]
+        if missing:
+            raise UploadError(f"Faltan partes: {missing[:20]}", status=409)
+
+        name = upload_name(petition_key, upload["filename"])
+        destination = large_storage.path(name)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(large_storage.path(_partial_name(upload_id)), destination)
+    except Exception:
+        client().delete(_completing_key(upload_id))
+        raise
+
+    client().delete(_session_key(upload_id), f"{_session_key(upload_id)}:parts", _completing_key(upload_id))
+    return name
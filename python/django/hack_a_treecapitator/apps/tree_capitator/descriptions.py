@@ -0,0 +1,201 @@
+"""
+Descripciones en lenguaje natural de cada polígono analizado.
+
+Las descripciones se generan con un backend intercambiable (``DESCRIPTION_BACKEND``):
+
+- ``openai``: modelo de completado de OpenAI.
+- ``template``: texto armado localmente a partir de los datos, sin red.
+- ``stub``: texto fijo y determinista, para pruebas.
+
+Las peticiones se hacen en paralelo con un límite (``DESCRIPTION_CONCURRENCY``)
+y cada descripción se guarda en Dragonfly bajo un hash de los datos
+normalizados del prompt, de modo que polígonos con la misma información no
+vuelven a pasar por el backend.
+"""
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+import redis
+from django.conf import settings
+
+from . import metrics
+
+
+UNAVAILABLE = "Descripción no disponible"
+
+
+def _total(value):
+    return (value or {}).get("total_def_area_ha", 0) or 0
+
+
+def prompt_inputs(properties, index):
+    """Datos normalizados del prompt a partir de una fila o de las propiedades de un feature."""
+    indices = ((properties.get("index_crops") or {}).get("indices")) or []
+    return {
+        "id": properties.get("id", index),
+        "area": round(float(properties.get("area_ha", 0) or 0), 2),
+        "hansen_total": round(float(_total(properties.get("deforestation_hansen"))), 2),
+        "history_total": round(float(_total(properties.get("deforestation_history"))), 2),
+        "indices": [[idx["subcategory"], round(float(idx["mean_value"]), 2)] for idx in indices],
+        "weather": properties.get("wheather") or {},
+    }
+
+
+def inputs_hash(inputs):
+    payload = json.dumps(inputs, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def render_prompt(inputs):
+    indices = ", ".join(f"{name}: {value:.2f}" for name, value in inputs["indices"])
+    return f"""
+        Genera una descripción concisa y clara para un polígono agrícola con la siguiente información:
+
+        - ID: {inputs["id"]}
+        - Área: {inputs["area"]:.2f} ha
+        - Deforestación Hansen histórica: {inputs["hansen_total"]:.2f} ha
+        - Deforestación reciente: {inputs["history_total"]:.2f} ha
+        - Índices de cultivos: {indices if indices else 'sin información'}
+        - Clima: {inputs["weather"] if inputs["weather"] else 'sin información'}
+
+        La descripción debe ser en lenguaje natural y fácil de entender.
+        """
+
+
+class OpenAIBackend:
+    """
+    El cliente se crea una vez por backend y lo comparten los hilos de
+    ``describe_all`` (es seguro entre hilos), así se reutilizan sus conexiones.
+    """
+    name = "openai"
+
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = openai.OpenAI()
+            return self._client
+
+    def describe(self, inputs):
+        prompt = render_prompt(inputs)
+        if hasattr(openai, "OpenAI"):
+            response = self.client().completions.create(
+                model=settings.DESCRIPTION_MODEL,
+                prompt=prompt,
+                max_tokens=150,
+                temperature=0.7,
+            )
+        else:
+            response = openai.Completion.create(
+                model=settings.DESCRIPTION_MODEL,
+                prompt=prompt,
+                max_tokens=150,
+                temperature=0.7,
+            )
+        return response.choices[0].text.strip()
+
+
+class TemplateBackend:
+    name = "template"
+
+    def describe(self, inputs):
+        parts = [f"El polígono {inputs['id']} tiene un área de {inputs['area']:.2f} ha."]
+
+        if inputs["hansen_total"] or inputs["history_total"]:
+            parts.append(
+                f"Registra {inputs['hansen_total']:.2f} ha de deforestación histórica (Hansen) "
+                f"y {inputs['history_total']:.2f} ha de deforestación reciente."
+            )
+        else:
+            parts.append("No registra deforestación en los datos disponibles.")
+
+        if inputs["indices"]:
+            indices = ", ".join(f"{name} {value:.2f}" for name, value in inputs["indices"])
+            parts.append(f"Índices de cultivo promedio: {indices}.")
+
+        weather = inputs["weather"]
+        if weather.get("temperature_2m_max"):
+            parts.append(
+                f"Hoy se esperan entre {weather['temperature_2m_min'][0]} y "
+                f"{weather['temperature_2m_max'][0]} °C con {weather['precipitation_sum'][0]} mm de lluvia."
+            )
+
+        return " ".join(parts)
+
+
+class StubBackend:
+    name = "stub"
+
+    def describe(self, inputs):
+        return f"Descripción de prueba {inputs_hash(inputs)[:12]}"
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (OpenAIBackend, TemplateBackend, StubBackend)
+}
+
+
+def get_backend(name=None):
+    return BACKENDS[name or settings.DESCRIPTION_BACKEND]()
+
+
+_cache_client = None
+
+
+def cache_client():
+    global _cache_client
+    if _cache_client is None:
+        _cache_client = redis.Redis.from_url(settings.DESCRIPTION_CACHE_URL, decode_responses=True)
+    return _cache_client
+
+
+def describe_all(inputs_list, backend=None):
+    """
+    Descripción de cada entrada de ``inputs_list`` (misma longitud y orden).
+    Entradas repetidas se describen una sola vez.
+    """
+    backend = backend or get_backend()
+    hashes = [inputs_hash(inputs) for inputs in inputs_list]
+    keys = {h: f"DESCRIPTION:{backend.name}:{h}" for h in hashes}
+    unique = dict(zip(hashes, inputs_list))
+
+    try:
+        cached = dict(zip(keys.values(), cache_client().mget(list(keys.values()))))
+    except redis.RedisError as e:
+        print("Caché de descripciones no disponible:", e)
+        cached = {}
+
+    descriptions = {h: cached[keys[h]] for h in unique if cached.get(keys[h])}
+    missing = [h for h in unique if h not in descriptions]
+    metrics.count("cache_hits", len(descriptions), "description")
+    metrics.count("cache_misses", len(missing), "description")
+
+    def describe(h):
+        try:
+            return h, backend.describe(unique[h])
+        except Exception as e:
+            print(f"Error generando descripción GPT: {e}")
+            return h, None
+
+    with metrics.span("description_backend", backend.name), \
+            ThreadPoolExecutor(max_workers=settings.DESCRIPTION_CONCURRENCY) as executor:
+        generated = dict(executor.map(describe, missing))
+
+    try:
+        pipe = cache_client().pipeline()
+        for h, description in generated.items():
+            if description:
+                pipe.set(keys[h], description, ex=settings.DESCRIPTION_CACHE_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        print("Caché de descripciones no disponible:", e)
+
+    descriptions.update(generated)
+    return [descriptions.get(h) or UNAVAILABLE for h in hashes]
@@ -0,0 +1,541 @@
+"""
+Motor de análisis "raster-major".
+
+En lugar de recorrer polígono por polígono y abrir todos los rasters para cada
+uno, se abre cada raster una sola vez por trabajo y se evalúan contra él todos
+los polígonos del GeoDataFrame mediante lecturas por ventana sobre una
+rejilla de etiquetas (ver ``zonal.py``).
+
+Este módulo no depende del ORM: recibe listas de ``RasterSource`` ya resueltas
+(ver ``catalog.py``) para poder usarse tanto desde
+Celery como desde los procesos auxiliares de ``run_raster_analysis_pool``.
+"""
+import hashlib
+import queue
+from collections import namedtuple
+
+import billiard
+import numpy as np
+
+from . import metrics, rasterpool
+from .pixelarea import row_areas_for
+from .pyramid import NEW_DEF_BIN, HANSEN_BINS, load_pyramid
+from .zonal import (
+    BLOCK_SIZE,
+    PolygonSet,
+    grid_key,
+    label_grid,
+    zonal_counts,
+    zonal_histogram,
+    zonal_sums,
+)
+
+
+# Cambia cuando cambia la forma de calcular los resultados, para invalidar los
+# resultados guardados por polígono (ver ``fingerprint.catalog_versions``)
+ANALYSIS_VERSION = 2
+
+# Clave de ``run_raster_analysis`` con el estado del historial por polígono
+HISTORY_STATE = "deforestation_history_state"
+
+# ``key`` identifica el contenido del archivo (id y nombre), ``pyramid`` es la
+# entrada ``data_rules["pyramid"]`` con la ruta absoluta ya resuelta y ``area``
+# la ruta del vector de áreas por fila (``data_rules["pixel_area"]``).
+RasterSource = namedtuple(
+    "RasterSource",
+    ["path", "date", "subcategory", "key", "pyramid", "area"],
+    defaults=(None, None, None),
+)
+
+
+def _open_sources(sources, progress=None, skip=()):
+    """
+    Recorre los rasters desde el pool de datasets abiertos del proceso; los
+    que fallan se reportan y se omiten. Los de ``skip`` (claves de rasters que
+    no tocan ningún polígono) no se abren.
+    """
+    for source in sources:
+        if source.key not in skip:
+            try:
+                src = rasterpool.open_raster(source.path)
+            except Exception as e:
+                print("Error procesando raster:", source.path, str(e))
+            else:
+                yield source, src
+        if progress is not None:
+            progress(1)
+
+
+def _count_read(dataset, grid):
+    metrics.count("raster_reads", 1, dataset)
+    metrics.count("pixels", grid.labels.size, dataset)
+
+
+def _as_polygon_set(polygons):
+    return polygons if isinstance(polygons, PolygonSet) else PolygonSet(polygons)
+
+
+def _to_ha(area_m2):
+    return area_m2 / 10000
+
+
+def _history_tile_size(sources):
+    """
+    Tamaño de tesela de las pirámides del histórico según el catálogo, si
+    toda la cadena las tiene y cada una guarda las transiciones respecto al
+    raster anterior de la cadena; si no, None.
+    """
+    entries = [source.pyramid for source in sources]
+    if not entries or not all(entries):
+        return None
+    for entry, previous in zip(entries[1:], sources[:-1]):
+        if entry.get("previous") != previous.key:
+            return None
+    tile_sizes = {entry.get("tile_size") for entry in entries}
+    return tile_sizes.pop() if len(tile_sizes) == 1 else None
+
+
+def _history_pyramids(sources, start=0):
+    """
+    Pirámides del histórico desde ``start`` (las anteriores quedan en None)
+    si toda la cadena las tiene; si no, None.
+    """
+    if _history_tile_size(sources) is None:
+        return None
+    pyramids = [None] * start + [load_pyramid(source) for source in sources[start:]]
+    loaded = pyramids[start:]
+    if any(pyramid is None for pyramid in loaded):
+        return None
+    if len({pyramid.tile_size for pyramid in loaded}) > 1:
+        return None
+    return pyramids
+
+
+def _grid_token(src, tile_size):
+    """
+    Identifica la rejilla de etiquetas de un raster: con la misma rejilla los
+    píxeles de un polígono salen siempre en el mismo orden.
+    """
+    return hashlib.sha256(repr((grid_key(src, tile_size), BLOCK_SIZE)).encode()).hexdigest()
+
+
+def _resume_index(state, keys, tile_size):
+    """Rasters de la cadena ya incluidos en ``state``, o 0 si no sirve."""
+    if not state or state.get("version") != ANALYSIS_VERSION or state.get("tile_size") != tile_size:
+        return 0
+    chain = state.get("chain") or []
+    return len(chain) if chain == keys[:len(chain)] else 0
+
+
+def pack_mask(mask):
+    return np.packbits(mask).tobytes()
+
+
+def unpack_mask(data, pixels):
+    return np.unpackbits(np.frombuffer(data, dtype="uint8"), count=pixels).astype(bool)
+
+
+def deforestation_history_states(sources, polygons, states=None, progress=None, grids=None, skip=()):
+    """
+    Historial de deforestación (clase 0.5) año a año para cada polígono.
+
+    La comparación con el año anterior se hace píxel a píxel, por lo que exige
+    que los rasters consecutivos compartan rejilla; si la rejilla cambia, la
+    cadena se reinicia en ese raster. Si toda la cadena tiene pirámide, las
+    teselas interiores se toman de ella y sólo se leen los bordes.
+
+    ``states`` trae, por polígono, el estado guardado de un cálculo anterior
+    (o None): los rasters de la cadena ya recorridos, la última máscara de
+    clase 0.5 de sus píxeles empaquetada en bits y el historial acumulado. Un
+    polígono con estado vigente sólo recorre los rasters nuevos, y la cadena
+    se abre desde el primer raster que le falta a alguno. Devuelve
+    ``(resultados, estados)``; el estado es None si no cambió o si algún
+    raster falló y el recorrido quedó incompleto.
+
+    Un raster de ``skip`` no se abre y corta la cadena: como no toca ningún
+    polígono, después de él ninguno tendría año anterior con que comparar.
+    """
+    polygons = _as_polygon_set(polygons)
+    grids = {} if grids is None else grids
+    n = polygons.n
+
+    if not sources:
+        return [{"history": [], "total_def_area_ha": 0} for _ in range(n)], [None] * n
+
+    keys = [source.key for source in sources]
+    tile_size = _history_tile_size(sources)
+    states = list(states) if states is not None else [None] * n
+    starts = np.array([_resume_index(state, keys, tile_size) for state in states], dtype="int64")
+    first = int(starts.min()) if n else len(sources)
+
+    pyramids = _history_pyramids(sources, first)
+    if pyramids is None:
+        if tile_size is not None and starts.any():
+            # Sin pirámides la rejilla no es la de los estados guardados
+            return deforestation_history_states(sources, polygons, None, progress, grids, skip)
+        pyramids, tile_size = [None] * len(sources), None
+    position = {source.path: k for k, source in enumerate(sources)}
+
+    if progress is not None and first:
+        progress(first)
+
+    results = [list(state["history"]) if start else [] for state, start in zip(states, starts)]
+    totals = [state["total_def_area_ha"] if start else 0 for state, start in zip(states, starts)]
+    has_previous = np.zeros(n, dtype=bool)
+    previous_mask, previous_grid, previous_key, previous_token = None, None, None, None
+    processed = 0
+    skipped = sum(1 for source in sources[first:] if source.key in skip)
+    last = first - 1
+
+    for source, src in _open_sources(sources[first:], progress, skip):
+        k = position[source.path]
+        if any(other.key in skip for other in sources[last + 1:k]):
+            has_previous[:] = False
+            previous_grid = None
+        last = k
+        year = source.date.year
+        pyramid = pyramids[k]
+        if pyramid is not None and not pyramid.matches(src):
+            pyramid = None
+
+        try:
+            grid = label_grid(grids, polygons, src, pyramid)
+            with metrics.span("read", "deforestation_history"):
+                current_mask = (grid.values(src) == 0.5)
+        except Exception as e:
+            print("Error procesando raster:", source.path, str(e))
+            continue
+        processed += 1
+        _count_read("deforestation_history", grid)
+        token = _grid_token(src, pyramid.tile_size if pyramid is not None else None)
+        active = starts <= k
+
+        if grid is not previous_grid or (pyramid is not None and pyramid.previous != previous_key):
+            has_previous[:] = False
+            previous_mask = np.zeros(grid.labels.size, dtype=bool)
+
+        # Los polígonos que retoman su cadena aquí traen su máscara anterior
+        resuming = np.flatnonzero(starts == k) if k else []
+        if len(resuming):
+            order, offsets = grid.polygon_pixels()
+            chained = pyramid is None or pyramid.previous == keys[k - 1]
+            for i in resuming:
+                state = states[i]
+                pixels = order[offsets[i]:offsets[i + 1]]
+                has_previous[i] = (
+                    chained and state["has_previous"] and state["grid"] == token
+                    and state["pixels"] == pixels.size
+                )
+                if has_previous[i]:
+                    previous_mask[pixels] = unpack_mask(state["mask"], pixels.size)
+
+        selected = grid.overlaps & has_previous & active
+        if selected.any():
+            with metrics.span("zonal", "deforestation_history"):
+                row_area = row_areas_for(source, src)
+                new_def_pixels = np.logical_and(current_mask, np.logical_not(previous_mask))
+                counts = zonal_counts(grid.labels, new_def_pixels, n)
+                areas = zonal_sums(grid.labels, row_area[grid.rows], new_def_pixels, n)
+                if pyramid is not None:
+                    counts = counts + grid.interior_sums(pyramid)[:, NEW_DEF_BIN]
+                    areas = areas + grid.interior_areas(pyramid, row_area)[:, NEW_DEF_BIN]
+
+            for i in np.flatnonzero(selected):
+                area_ha = _to_ha(areas[i])
+                results[i].append({
+                    "year": year,
+                    "new_def_area_ha": float(area_ha),
+                    "pixels_detected": int(counts[i])
+                })
+                totals[i] += area_ha
+
+        has_previous |= grid.overlaps
+        previous_mask, previous_grid, previous_key, previous_token = current_mask, grid, source.key, token
+
+    if any(other.key in skip for other in sources[last + 1:]):
+        has_previous[:] = False
+        previous_grid, previous_token = None, None
+
+    results = [
+        {"history": history, "total_def_area_ha": float(total)}
+        for history, total in zip(results, totals)
+    ]
+
+    new_states = [None] * n
+    if processed + skipped == len(sources) - first:
+        if previous_grid is not None:
+            order, offsets = previous_grid.polygon_pixels()
+        for i in np.flatnonzero(starts < len(sources)):
+            if previous_grid is not None:
+                mask = previous_mask[order[offsets[i]:offsets[i + 1]]]
+            else:
+                mask = np.zeros(0, dtype=bool)
+            new_states[i] = {
+                "version": ANALYSIS_VERSION,
+                "chain": keys,
+                "tile_size": tile_size,
+                "grid": previous_token,
+                "has_previous": bool(has_previous[i]),
+                "mask": pack_mask(mask),
+                "pixels": int(mask.size),
+                **results[i],
+            }
+    return results, new_states
+
+
+def deforestation_history_stats(sources, polygons, progress=None, grids=None, skip=()):
+    """Historial de deforestación de cada polígono, recorriendo toda la cadena."""
+    return deforestation_history_states(sources, polygons, None, progress, grids, skip)[0]
+
+
+def deforestation_hansen_stats(sources, polygons, progress=None, grids=None, skip=()):
+    """
+    Área deforestada por año (códigos Hansen 1-24) para cada polígono. Las
+    teselas interiores se toman de la pirámide del raster cuando existe.
+    """
+    polygons = _as_polygon_set(polygons)
+    grids = {} if grids is None else grids
+    n = polygons.n
+
+    if not sources:
+        return [{"history": [], "total_def_area_ha": 0} for _ in range(n)]
+
+    results = [[] for _ in range(n)]
+    totals = [0] * n
+
+    for source, src in _open_sources(sources, progress, skip):
+        pyramid = load_pyramid(source)
+        if pyramid is not None and (not pyramid.matches(src) or pyramid.bins != HANSEN_BINS):
+            pyramid = None
+
+        try:
+            grid = label_grid(grids, polygons, src, pyramid)
+            with metrics.span("read", "deforestation_hansen"):
+                values = grid.values(src)
+        except Exception as e:
+            print("Error procesando raster:", source.path, str(e))
+            continue
+        _count_read("deforestation_hansen", grid)
+
+        # Histograma (polígono, año) en una sola pasada
+        with metrics.span("zonal", "deforestation_hansen"):
+            is_year = (values >= 1) & (values <= 24) & (values == np.floor(values))
+            codes = np.where(is_year, values, 0)
+            row_area = row_areas_for(source, src)
+            hist = zonal_histogram(grid.labels, codes, is_year, n, HANSEN_BINS)
+            area_hist = zonal_histogram(grid.labels, codes, is_year, n, HANSEN_BINS, row_area[grid.rows])
+            if pyramid is not None:
+                hist = hist + grid.interior_sums(pyramid)
+                area_hist = area_hist + grid.interior_areas(pyramid, row_area)
+
+        for i, val in zip(*np.nonzero(hist)):
+            count_pixels = hist[i, val]
+            area_ha = _to_ha(area_hist[i, val])
+            results[i].append({
+                "year": 2000 + int(val),
+                "new_def_area_ha": float(area_ha),
+                "pixels_detected": int(count_pixels)
+            })
+            totals[i] += area_ha
+
+    return [
+        {"history": history, "total_def_area_ha": float(total)}
+        for history, total in zip(results, totals)
+    ]
+
+
+def index_stats(sources_by_subcategory, polygons, progress=None, grids=None, skip=()):
+    """
+    Promedio de cada índice de cultivo por polígono.
+    ``sources_by_subcategory`` es una lista de ``(etiqueta, [RasterSource])``.
+    """
+    polygons = _as_polygon_set(polygons)
+    grids = {} if grids is None else grids
+    n = polygons.n
+
+    if not any(sources for _, sources in sources_by_subcategory):
+        return [{"indices": [], "total_mean_value": 0} for _ in range(n)]
+
+    results = [[] for _ in range(n)]
+
+    for label, sources in sources_by_subcategory:
+        subcat_values = [[] for _ in range(n)]
+
+        for source, src in _open_sources(sources, progress, skip):
+            try:
+                grid = label_grid(grids, polygons, src)
+                with metrics.span("read", label):
+                    values = grid.values(src)
+            except Exception as e:
+                print("Error procesando raster:", source.path, str(e))
+                continue
+            _count_read(label, grid)
+
+            # Aplicar trim: descartar valores menores que 0.5
+            with metrics.span("zonal", label):
+                trimmed = values >= 0.5
+                counts = zonal_counts(grid.labels, trimmed, n)
+                sums = zonal_sums(grid.labels, values, trimmed, n)
+
+            for i in np.flatnonzero(counts):
+                subcat_values[i].append(sums[i] / counts[i])
+
+        for i, values in enumerate(subcat_values):
+            if values:
+                results[i].append({
+                    "subcategory": label,
+                    "mean_value": float(np.mean(values))
+                })
+
+    return [{"indices": indices} for indices in results]
+
+
+def count_sources(catalog):
+    """Número de rasters que ``run_raster_analysis`` abrirá para un catálogo."""
+    return (
+        len(catalog["history"])
+        + len(catalog["hansen"])
+        + sum(len(sources) for _, sources in catalog["index"])
+    )
+
+
+def run_raster_analysis(catalog, geometries, progress=None, history_states=None):
+    """
+    Ejecuta los tres análisis sobre todos los polígonos abriendo cada raster
+    una sola vez. Los polígonos se etiquetan una sola vez por rejilla raster y
+    las etiquetas se comparten entre análisis. Devuelve un diccionario con una
+    lista por análisis, alineada con ``geometries``, y en ``HISTORY_STATE``
+    el nuevo estado del historial de cada polígono (ver
+    ``deforestation_history_states``). Los rasters de ``catalog["outside"]``
+    (ver ``catalog.rasters_outside``) no se abren.
+    """
+    polygons = PolygonSet(geometries)
+    grids = {}
+    skip = catalog.get("outside", ())
+    history, states = deforestation_history_states(
+        catalog["history"], polygons, history_states, progress, grids, skip
+    )
+    return {
+        "deforestation_history": history,
+        HISTORY_STATE: states,
+        "deforestation_hansen": deforestation_hansen_stats(catalog["hansen"], polygons, progress, grids, skip),
+        "index_crops": index_stats(catalog["index"], polygons, progress, grids, skip),
+    }
+
+
+def _run_chunk(catalog, geometries, progress, history_states):
+    """``run_raster_analysis`` en un proceso del pool, junto con sus métricas."""
+    return run_raster_analysis(catalog, geometries, progress, history_states), metrics.collect()
+
+
+_executor = None
+_executor_size = None
+
+
+def _discard_executor():
+    global _executor, _executor_size
+    if _executor is not None:
+        _executor.terminate()
+    _executor, _executor_size = None, None
+
+
+def _get_executor(pool_size):
+    """
+    Pool de procesos del worker, reutilizado entre trabajos. Se usa "spawn"
+    para no heredar por fork el estado de GDAL ni las conexiones del worker.
+
+    El pool es de billiard y no de ``concurrent.futures``: los procesos del
+    worker prefork de Celery son daemon y ``multiprocessing`` no les permite
+    tener hijos; billiard sí.
+    """
+    global _executor, _executor_size
+    if _executor is None or _executor_size != pool_size:
+        _discard_executor()
+        _executor = billiard.get_context("spawn").Pool(
+            processes=pool_size,
+            # Las opciones de GDAL llegan por el entorno heredado
+            initializer=rasterpool.configure,
+            initargs=(rasterpool.max_open(),),
+        )
+        _executor_size = pool_size
+    return _executor
+
+
+def run_raster_analysis_pool(catalog, geometries, pool_size, progress=None, chunks_per_worker=2, history_states=None):
+    """
+    Igual que ``run_raster_analysis`` pero repartiendo los polígonos en bloques
+    entre ``pool_size`` procesos. Los resultados por polígono no dependen del
+    bloque en que se calculan, así que coinciden con la ruta secuencial. El
+    avance y los resultados se recogen en el orden en que terminan los
+    bloques, sin esperar a los anteriores.
+
+    Si el pool falla (no se puede crear, un proceso muere, ...) el trabajo se
+    repite en la ruta secuencial en lugar de hacer fallar la petición.
+    """
+    geometries = list(geometries)
+    if pool_size <= 1 or len(geometries) < 2:
+        return run_raster_analysis(catalog, geometries, progress, history_states)
+
+    n_chunks = min(len(geometries), pool_size * chunks_per_worker)
+    edges = np.linspace(0, len(geometries), n_chunks + 1).astype(int)
+    total_rasters = count_sources(catalog)
+    reported = 0
+
+    try:
+        executor = _get_executor(pool_size)
+        # Los callbacks corren en un hilo del pool: sólo encolan el bloque
+        # terminado, y el avance se reporta desde este hilo en orden de llegada
+        finished = queue.Queue()
+        for start, stop in zip(edges[:-1], edges[1:]):
+            executor.apply_async(
+                _run_chunk,
+                (
+                    catalog,
+                    geometries[start:stop],
+                    None,
+                    history_states[start:stop] if history_states is not None else None,
+                ),
+                callback=lambda value, start=start, stop=stop: finished.put((start, stop, value)),
+                error_callback=lambda error: finished.put((None, None, error)),
+            )
+
+        results = {}
+        chunk_metrics = []
+        for done in range(1, n_chunks + 1):
+            start, stop, value = finished.get()
+            if start is None:
+                raise RuntimeError(f"Falló un bloque del pool: {value!r}")
+            chunk_results, collected = value
+            chunk_metrics.append(collected)
+            for key, values in chunk_results.items():
+                results.setdefault(key, [None] * len(geometries))[start:stop] = values
+
+            if progress is not None:
+                steps = total_rasters * done // n_chunks - reported
+                if steps:
+                    progress(steps)
+                    reported += steps
+    except Exception as e:
+        # Un proceso caído deja el pool inutilizable; se recrea en el próximo trabajo
+        print("Error en el pool de análisis, se continúa en serie:", repr(e))
+        _discard_executor()
+        return run_raster_analysis(catalog, geometries, _after(progress, reported), history_states)
+
+    for collected in chunk_metrics:
+        metrics.merge(collected)
+    return results
+
+
+def _after(progress, reported):
+    """``progress`` que no vuelve a reportar los primeros ``reported`` pasos."""
+    if progress is None or not reported:
+        return progress
+    skipped = 0
+
+    def report(steps):
+        nonlocal skipped
+        ignored = min(steps, reported - skipped)
+        skipped += ignored
+        if steps - ignored:
+            progress(steps - ignored)
+    return report
@@ -0,0 +1,74 @@
+"""
+Avance de las peticiones en tiempo real.
+
+Cada cambio de estado (``set_progress`` en ``tasks.py``) se publica en el
+canal ``PROGRESS:{petition_key}`` de Dragonfly además de guardarse en
+``TEMP:{petition_key}``. ``progress_events`` se suscribe al canal y entrega
+los eventos en formato Server-Sent Events; necesita correr bajo ASGI
+(``tree_capitator/asgi.py``). ``api/v1/model_status/`` sigue disponible para
+clientes que consultan periódicamente.
+"""
+import asyncio
+import json
+
+import redis.asyncio as aioredis
+from django.conf import settings
+
+
+FINAL_STATUSES = {"Proceso Completado", "sin datos", "error en el procesamiento"}
+
+
+def progress_channel(petition_key):
+    return f"PROGRESS:{petition_key}"
+
+
+def is_final(data):
+    return data.get("status") in FINAL_STATUSES and data.get("descriptions") != "pendiente"
+
+
+def sse(data, event=None):
+    lines = [f"event: {event}"] if event else []
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+async def progress_events(petition_key):
+    """
+    Estado actual de la petición y luego cada cambio publicado, hasta que
+    termina o se cumple ``PROGRESS_STREAM_TIMEOUT``.
+    """
+    client = aioredis.Redis.from_url(settings.PROGRESS_PUBSUB_URL, decode_responses=True)
+    pubsub = client.pubsub()
+    try:
+        # Se suscribe antes de leer el estado para no perder eventos entre ambos
+        await pubsub.subscribe(progress_channel(petition_key))
+        raw = await client.get(f"TEMP:{petition_key}")
+        if not raw:
+            yield sse({"error": "Petición no encontrada o expirada"}, event="error")
+            return
+
+        data = json.loads(raw)
+        yield sse(data)
+        if is_final(data):
+            return
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.PROGRESS_STREAM_TIMEOUT
+        while loop.time() < deadline:
+            message = await pubsub.get_message(
+                ignore_subscribe_messages=True,
+                timeout=settings.PROGRESS_KEEPALIVE,
+            )
+            if message is None:
+                # Comentario SSE para que proxies no cierren la conexión
+                yield ": keepalive\n\n"
+                continue
+
+            data = json.loads(message["data"])
+            yield sse(data)
+            if is_final(data):
+                return
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
+        await client.aclose()
@@ -0,0 +1,109 @@
+"""
+Servidor local que imita el endpoint ``/v1/forecast`` de Open-Meteo.
+
+Pensado para pruebas y benchmarks: responde consultas de una o varias
+coordenadas con valores deterministas derivados de la latitud y longitud, y
+puede simular errores (por ejemplo 429) en las primeras peticiones para
+ejercitar los reintentos del cliente.
+
+Uso::
+
+    with running_fake_open_meteo(fail_first=2) as server:
+        with override_settings(OPEN_METEO_URL=server.url):
+            ...
+"""
+import json
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def fake_daily(lat, lon, day, variables):
+    """Valores diarios deterministas para una coordenada."""
+    seed = abs(lat) * 7 + abs(lon) * 3
+    values = {
+        "temperature_2m_max": round(24 + seed % 8, 1),
+        "temperature_2m_min": round(14 + seed % 5, 1),
+        "precipitation_sum": round(seed % 12, 1),
+        "shortwave_radiation_sum": round(15 + seed % 10, 2),
+        "relative_humidity_2m_mean": round(60 + seed % 30),
+        "wind_speed_10m_mean": round(3 + seed % 9, 1),
+    }
+    daily = {"time": [day]}
+    for variable in variables:
+        daily[variable] = [values.get(variable)]
+    return daily
+
+
+class FakeOpenMeteoHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            failing = server.requests <= server.fail_first
+
+        if failing:
+            self._send(server.fail_status, {"error": True, "reason": "simulated"})
+            return
+
+        query = parse_qs(urlparse(self.path).query)
+        try:
+            lats = [float(v) for v in query["latitude"][0].split(",")]
+            lons = [float(v) for v in query["longitude"][0].split(",")]
+        except (KeyError, ValueError):
+            self._send(400, {"error": True, "reason": "Invalid coordinates"})
+            return
+        if len(lats) != len(lons):
+            self._send(400, {"error": True, "reason": "Parameter count mismatch"})
+            return
+
+        day = query.get("start_date", ["1970-01-01"])[0]
+        variables = query.get("daily", [""])[0].split(",")
+        locations = [
+            {"latitude": lat, "longitude": lon, "daily": fake_daily(lat, lon, day, variables)}
+            for lat, lon in zip(lats, lons)
+        ]
+        self._send(200, locations if len(locations) > 1 else locations[0])
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeOpenMeteoServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fail_first=0, fail_status=429):
+        super().__init__(("127.0.0.1", 0), FakeOpenMeteoHandler)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"http://{host}:{port}/v1/forecast"
+
+
+@contextmanager
+def running_fake_open_meteo(fail_first=0, fail_status=429):
+    server = FakeOpenMeteoServer(fail_first, fail_status)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,70 @@
+"""
+Huellas de geometrías y de catálogos para reutilizar resultados entre peticiones.
+
+La huella de un polígono es el hash de su forma canónica: coordenadas
+redondeadas a ``POLYGON_FINGERPRINT_GRID`` grados y anillos normalizados
+(orientación, punto de inicio y orden de las partes), de modo que el mismo
+predio subido otra vez, aunque venga con otra orientación o con ruido en los
+últimos decimales, produce la misma huella.
+
+La versión de catálogo de cada análisis es el hash de los rasters que usa,
+en orden, y de ``ANALYSIS_VERSION``; cambia si se agrega, reemplaza o elimina
+algún raster o si cambia el cálculo.
+"""
+import hashlib
+
+import shapely
+from django.conf import settings
+
+from .engine import ANALYSIS_VERSION
+
+
+ANALYZERS = ("deforestation_history", "deforestation_hansen", "index_crops")
+
+# Entrada del catálogo (ver ``catalog.py``) que usa cada análisis
+CATALOG_ENTRIES = {
+    "deforestation_history": "history",
+    "deforestation_hansen": "hansen",
+    "index_crops": "index",
+}
+
+
+def canonical_geometry(geometry, grid_size=None):
+    grid_size = grid_size or settings.POLYGON_FINGERPRINT_GRID
+    return shapely.normalize(shapely.set_precision(geometry, grid_size))
+
+
+def geometry_fingerprint(geometry):
+    """Huella hexadecimal de la geometría, o None si está vacía."""
+    if geometry is None or geometry.is_empty:
+        return None
+    canonical = canonical_geometry(geometry)
+    if canonical.is_empty:
+        return None
+    return hashlib.sha256(shapely.to_wkb(canonical, output_dimension=2)).hexdigest()
+
+
+def _sources_token(sources):
+    return [[source.key, source.date.isoformat()] for source in sources]
+
+
+def catalog_versions(catalog):
+    """Versión del catálogo para cada análisis."""
+    tokens = {
+        "history": _sources_token(catalog["history"]),
+        "hansen": _sources_token(catalog["hansen"]),
+        "index": [[label, _sources_token(sources)] for label, sources in catalog["index"]],
+    }
+    return {
+        analyzer: hashlib.sha256(repr([ANALYSIS_VERSION, tokens[entry]]).encode()).hexdigest()
+        for analyzer, entry in CATALOG_ENTRIES.items()
+    }
+
+
+def without_entries(catalog, analyzers):
+    """Copia del catálogo sin los rasters de ``analyzers``."""
+    reduced = dict(catalog)
+    for analyzer in analyzers:
+        entry = CATALOG_ENTRIES[analyzer]
+        reduced[entry] = []
+    return reduced
@@ -0,0 +1,196 @@
+"""
+Normalización de rasters al registrarlos.
+
+Cada raster de ``File_Model`` se reescribe como Cloud-Optimized GeoTIFF
+(teselado interno, compresión con predictor y overviews) junto al original,
+que se conserva tal cual. El diseño resultante se registra en
+``data_rules["cog"]`` y los analizadores leen la copia COG, de modo que un
+recorte por polígono sólo decodifica los bloques que toca.
+
+Cada raster recibe también el vector de áreas de píxel por fila
+(``data_rules["pixel_area"]``, ver ``pixelarea.py``), y los de deforestación
+(categoría 0) una pirámide de conteos y áreas por tesela
+(``data_rules["pyramid"]``, ver ``pyramid.py``).
+
+La huella del raster en EPSG:4326 y su resolución se guardan en
+``File_Model.footprint`` / ``File_Model.resolution`` para que los análisis
+descarten con una consulta espacial los rasters que no tocan los polígonos.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+import shapely
+from django.conf import settings
+from django.contrib.gis.geos import GEOSGeometry
+from rasterio.warp import transform_geom
+from shapely.geometry import box, mapping
+
+from .models import large_storage
+from .pixelarea import row_areas, save_row_areas
+from .pyramid import build_hansen_pyramid, build_history_pyramid
+
+
+def derived_stem(file_obj):
+    """
+    Base de los nombres de los archivos derivados de un raster. Lleva un hash
+    de ``content_key`` (id y ruta completa) para que rasters con el mismo
+    nombre en otro directorio o con otra extensión no se pisen entre sí.
+    """
+    stem = os.path.splitext(os.path.basename(file_obj.file.name))[0]
+    digest = hashlib.sha256(file_obj.content_key().encode()).hexdigest()[:12]
+    return f"{stem}-{digest}"
+
+
+def cog_name(file_obj):
+    """Nombre (relativo al storage) de la copia COG de un raster."""
+    return f"datasets/cog/{derived_stem(file_obj)}.tif"
+
+
+def overview_resampling(file_obj):
+    # Las clasificaciones (deforestación) no se pueden promediar
+    return "NEAREST" if file_obj.dataset.category == 0 else "AVERAGE"
+
+
+def write_cog(src_path, dst_path, resampling="NEAREST"):
+    """Escribe ``src_path`` como COG en ``dst_path`` de forma atómica."""
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    tmp_path = f"{dst_path}.tmp"
+
+    rasterio.shutil.copy(
+        src_path,
+        tmp_path,
+        driver="COG",
+        BLOCKSIZE=settings.RASTER_TILE_SIZE,
+        COMPRESS=settings.RASTER_COG_COMPRESS,
+        LEVEL=settings.RASTER_COG_LEVEL,
+        PREDICTOR="YES",
+        OVERVIEWS="AUTO",
+        RESAMPLING=resampling,
+        BIGTIFF="IF_SAFER",
+        NUM_THREADS="ALL_CPUS",
+    )
+    os.replace(tmp_path, dst_path)
+
+
+def describe_layout(path):
+    """Diseño interno de un GeoTIFF: bloques, compresión, predictor y overviews."""
+    with rasterio.open(path) as src:
+        image_structure = src.tags(ns="IMAGE_STRUCTURE")
+        return {
+            "blocksize": list(src.block_shapes[0]),
+            "compress": src.compression.value if src.compression else None,
+            "predictor": image_structure.get("PREDICTOR"),
+            "overviews": src.overviews(1),
+            "dtype": src.dtypes[0],
+            "nodata": src.nodata if src.nodata == src.nodata else "nan",
+            "width": src.width,
+            "height": src.height,
+        }
+
+
+def normalize_raster(file_obj):
+    """
+    Genera la copia COG de ``file_obj`` y devuelve la entrada ``data_rules["cog"]``.
+    El archivo original no se modifica.
+    """
+    name = cog_name(file_obj)
+    write_cog(file_obj.file.path, large_storage.path(name), overview_resampling(file_obj))
+
+    layout = describe_layout(large_storage.path(name))
+    layout["path"] = name
+    layout["original"] = file_obj.file.name
+    return layout
+
+
+def pixel_area_name(file_obj):
+    return f"datasets/area/{derived_stem(file_obj)}.npy"
+
+
+def pixel_area(file_obj):
+    """Calcula y guarda las áreas por fila; devuelve ``data_rules["pixel_area"]``."""
+    with rasterio.open(file_obj.raster_path()) as src:
+        areas = row_areas(src.crs, src.transform, src.width, src.height)
+
+    name = pixel_area_name(file_obj)
+    save_row_areas(large_storage.path(name), areas)
+    return {
+        "path": name,
+        "original": file_obj.file.name,
+        "min_m2": float(areas.min()),
+        "max_m2": float(areas.max()),
+    }
+
+
+def _row_areas(file_obj):
+    """Áreas por fila ya registradas del raster, o calculadas si no hay."""
+    entry = file_obj.get_pixel_area()
+    if entry:
+        return np.load(large_storage.path(entry["path"]))
+    with rasterio.open(file_obj.raster_path()) as src:
+        return row_areas(src.crs, src.transform, src.width, src.height)
+
+
+def footprint(file_obj):
+    """
+    Huella del raster en EPSG:4326 (GEOS) y resolución aproximada en metros
+    (lado de un píxel de área mediana), o ``(None, None)`` si no tiene CRS.
+    """
+    with rasterio.open(file_obj.raster_path()) as src:
+        if src.crs is None:
+            return None, None
+        left, bottom, right, top = src.bounds
+        outline = box(left, bottom, right, top)
+        if not src.crs.is_geographic:
+            # Se densifican los bordes para que sigan la curvatura al reproyectar
+            outline = shapely.segmentize(outline, max(right - left, top - bottom) / 64)
+        geometry = transform_geom(src.crs, "EPSG:4326", mapping(outline))
+
+    resolution = float(np.sqrt(np.median(_row_areas(file_obj))))
+    return GEOSGeometry(json.dumps(geometry), srid=4326), resolution
+
+
+def pyramid_name(file_obj):
+    return f"datasets/pyramid/{derived_stem(file_obj)}.npz"
+
+
+def _save_pyramid(file_obj, pyramid):
+    name = pyramid_name(file_obj)
+    pyramid.save(large_storage.path(name))
+    return {
+        "path": name,
+        "original": file_obj.file.name,
+        "tile_size": pyramid.tile_size,
+        "levels": len(pyramid.levels),
+        "bins": pyramid.bins,
+    }
+
+
+def hansen_pyramid(file_obj):
+    """Genera la pirámide Hansen y devuelve la entrada ``data_rules["pyramid"]``."""
+    pyramid = build_hansen_pyramid(
+        file_obj.raster_path(), settings.RASTER_TILE_SIZE, row_area=_row_areas(file_obj)
+    )
+    return _save_pyramid(file_obj, pyramid)
+
+
+def history_pyramid(file_obj, previous_obj=None):
+    """
+    Genera la pirámide del histórico con las transiciones respecto a
+    ``previous_obj`` (el raster anterior de la cadena ordenada por fecha).
+    """
+    previous_key = previous_obj.content_key() if previous_obj is not None else None
+    pyramid = build_history_pyramid(
+        file_obj.raster_path(),
+        settings.RASTER_TILE_SIZE,
+        previous_path=previous_obj.raster_path() if previous_obj is not None else None,
+        previous=previous_key,
+        row_area=_row_areas(file_obj),
+    )
+    rules = _save_pyramid(file_obj, pyramid)
+    rules["previous"] = pyramid.previous
+    rules["chain_previous"] = previous_key
+    return rules
@@ -0,0 +1,152 @@
+"""
+Lectura de los archivos de polígonos que suben los usuarios.
+
+La vista sólo guarda los bytes en el almacenamiento compartido
+(``large_storage``) y encola la ruta; la lectura y validación ocurren en el
+worker con estas funciones.
+
+Todos los formatos se leen por columnas con Arrow: GeoJSON, shapefile
+(zip), FlatGeobuf y GeoPackage con pyogrio (``use_arrow=True``) y
+GeoParquet con pyarrow. Con ``bbox`` (en EPSG:4326) sólo se leen las
+features que lo intersecan, usando el índice espacial del archivo cuando lo
+tiene (FlatGeobuf, GeoPackage, ``.qix`` de shapefile).
+"""
+import os
+import zipfile
+
+import geopandas as gpd
+import pyogrio
+from pyproj import CRS, Transformer
+from shapely.geometry import box
+
+from .models import large_storage
+
+
+SUPPORTED_EXTENSIONS = (".geojson", ".json", ".zip", ".fgb", ".gpkg", ".parquet", ".geoparquet")
+
+# Formatos vectoriales que se pueden encontrar dentro de un zip
+ZIP_MEMBERS = (".shp", ".fgb", ".gpkg", ".geojson", ".json")
+
+
+def is_supported(name):
+    return name.lower().endswith(SUPPORTED_EXTENSIONS)
+
+
+def upload_name(petition_key, filename):
+    """Ruta en ``large_storage`` donde se guarda el archivo de una petición."""
+    safe_name = os.path.basename(filename).replace(" ", "_")
+    return f"uploads/{petition_key}/{safe_name}"
+
+
+def delete_upload(name):
+    """
+    Borra un archivo de ``uploads/{petition_key}/`` y la carpeta de la
+    petición cuando queda vacía.
+    """
+    large_storage.delete(name)
+    try:
+        os.rmdir(os.path.dirname(large_storage.path(name)))
+    except OSError:
+        # Todavía tiene archivos o ya no existe
+        pass
+
+
+def frame_name(petition_key):
+    """Ruta del GeoDataFrame ya validado de una petición (ver ``save_frame``)."""
+    return f"uploads/{petition_key}/frame.parquet"
+
+
+def save_frame(gdf, petition_key):
+    """
+    Guarda el GeoDataFrame validado como GeoParquet para que las tareas de la
+    petición lo lean del almacenamiento compartido en lugar de recibirlo en
+    los mensajes de Celery. Devuelve su ruta en ``large_storage``.
+    """
+    name = frame_name(petition_key)
+    path = large_storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    gdf.to_parquet(path)
+    return name
+
+
+def load_frame(name, start=None, stop=None, columns=None):
+    """Filas ``start:stop`` del GeoDataFrame guardado con ``save_frame``."""
+    gdf = gpd.read_parquet(large_storage.path(name), columns=columns)
+    return gdf.iloc[start:stop]
+
+
+def parse_bbox(value):
+    """``"minx,miny,maxx,maxy"`` (o lista) en EPSG:4326; None si no se envía."""
+    if value in (None, ""):
+        return None
+    parts = value.split(",") if isinstance(value, str) else value
+    bbox = tuple(float(v) for v in parts)
+    if len(bbox) != 4 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+        raise ValueError("bbox inválido, se espera minx,miny,maxx,maxy")
+    return bbox
+
+
+def _to_4326(gdf):
+    if gdf.crs is None:
+        gdf.set_crs("EPSG:4326", inplace=True)
+    elif gdf.crs.to_epsg() != 4326:
+        gdf = gdf.to_crs("EPSG:4326")
+    return gdf
+
+
+def _bbox_in_crs(bbox, crs):
+    """``bbox`` (EPSG:4326) expresado en el CRS del archivo."""
+    if bbox is None or crs is None or CRS.from_user_input(crs).to_epsg() == 4326:
+        return bbox
+    transformer = Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+    return transformer.transform_bounds(*bbox)
+
+
+def _read_ogr(path, bbox=None):
+    info = pyogrio.read_info(path)
+    return pyogrio.read_dataframe(path, bbox=_bbox_in_crs(bbox, info["crs"]), use_arrow=True)
+
+
+def _zip_member(path):
+    """Ruta ``/vsizip/`` del primer archivo vectorial del zip, sin extraerlo."""
+    with zipfile.ZipFile(path, "r") as zpf:
+        names = sorted(
+            (name for name in zpf.namelist() if name.lower().endswith(ZIP_MEMBERS)),
+            key=lambda name: (ZIP_MEMBERS.index(os.path.splitext(name.lower())[1]), name),
+        )
+    if not names:
+        raise ValueError("El zip no contiene archivos vectoriales")
+    return f"/vsizip/{path}/{names[0]}"
+
+
+def _read_parquet(path, bbox=None):
+    gdf = gpd.read_parquet(path)
+    if bbox is not None:
+        area = gpd.GeoSeries([box(*bbox)], crs="EPSG:4326")
+        if gdf.crs is not None:
+            area = area.to_crs(gdf.crs)
+        gdf = gdf[gdf.intersects(area.iloc[0])]
+    return gdf
+
+
+def loader_dataframe_from_file(path, bbox=None):
+    name = path.lower()
+
+    if name.endswith((".parquet", ".geoparquet")):
+        gdf = _read_parquet(path, bbox)
+    elif name.endswith(".zip"):
+        gdf = _read_ogr(_zip_member(path), bbox)
+    elif name.endswith(SUPPORTED_EXTENSIONS):
+        gdf = _read_ogr(path, bbox)
+    else:
+        raise ValueError("Formato de archivo no soportado")
+
+    return _to_4326(gdf).reset_index(drop=True)
+
+
+def load_upload(name, bbox=None):
+    """Lee el archivo guardado en ``large_storage`` y lo elimina."""
+    try:
+        return loader_dataframe_from_file(large_storage.path(name), bbox)
+    finally:
+        delete_upload(name)
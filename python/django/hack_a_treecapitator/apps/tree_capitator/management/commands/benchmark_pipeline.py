@@ -0,0 +1,48 @@
+import tempfile
+
+from django.core.management.base import BaseCommand
+
+from ...benchmark import PARCEL_SIZES, dumps, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = "Mide los analizadores, modelo_gdf y las vistas con rasters y parcelas sintéticos."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--counts", type=int, nargs="+", default=[100, 1000],
+                            help="Número de parcelas de cada caso")
+        parser.add_argument("--sizes", nargs="+", choices=sorted(PARCEL_SIZES), default=["small", "large"],
+                            help="Tamaños de parcela")
+        parser.add_argument("--raster-size", type=int, default=4000, help="Ancho y alto de los rasters en píxeles")
+        parser.add_argument("--years", type=int, default=5, help="Rasters del histórico")
+        parser.add_argument("--indices", type=int, default=2, help="Rasters de índices de cultivo")
+        parser.add_argument("--pyramids", action="store_true", help="Generar pirámides de deforestación")
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--pool-size", type=int, default=1)
+        parser.add_argument("--skip-pipeline", action="store_true", help="Sólo los analizadores")
+        parser.add_argument("--skip-views", action="store_true", help="Sin las vistas de estado y resultados")
+        parser.add_argument("--output", help="Archivo JSON del reporte (por defecto, la salida estándar)")
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory(prefix="benchmark-") as directory:
+            report = run_benchmarks(
+                directory,
+                counts=options["counts"],
+                sizes=options["sizes"],
+                raster_size=options["raster_size"],
+                years=options["years"],
+                indices=options["indices"],
+                pyramids=options["pyramids"],
+                repeat=options["repeat"],
+                pool_size=options["pool_size"],
+                pipeline=not options["skip_pipeline"],
+                views=not options["skip_views"],
+                log=lambda message: self.stderr.write(message),
+            )
+
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(dumps(report))
+            self.stderr.write(f"Reporte en {options['output']}")
+        else:
+            self.stdout.write(dumps(report))
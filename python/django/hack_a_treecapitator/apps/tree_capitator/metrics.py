@@ -0,0 +1,252 @@
+"""
+Tiempos por etapa y contadores de los análisis.
+
+Cada proceso acumula en memoria los tramos medidos con ``span(etapa,
+dataset)`` y los contadores de ``count(nombre, valor, etiqueta)``; al
+terminar cada tarea de una petición se publican en Dragonfly con
+``publish``:
+
+- ``METRICS:job:{petition_key}``: totales de la petición, que al terminar se
+  guardan en ``TempResult.metrics`` (ver ``job_summary``);
+- ``METRICS:histograms`` y ``METRICS:counters``: histogramas por etapa y
+  dataset y contadores de todos los trabajos, que ``render_prometheus``
+  expone en formato de texto de Prometheus.
+
+El registro en memoria no depende de Django ni de Dragonfly, así que
+``engine.py`` lo usa también en los procesos de ``run_raster_analysis_pool``,
+que devuelven lo suyo con ``collect()`` para que el proceso padre lo sume con
+``merge()``.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+import redis
+from django.conf import settings
+
+
+# Límites superiores (segundos) de los buckets de los histogramas
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+# Contadores expuestos: nombre -> (etiqueta, ayuda)
+COUNTERS = {
+    "raster_reads": ("dataset", "Rasters leídos por los analizadores"),
+    "pixels": ("dataset", "Píxeles leídos y procesados por los analizadores"),
+    "cache_hits": ("cache", "Aciertos de caché"),
+    "cache_misses": ("cache", "Fallos de caché"),
+    "jobs": ("status", "Peticiones terminadas"),
+}
+
+HISTOGRAMS_KEY = "METRICS:histograms"
+COUNTERS_KEY = "METRICS:counters"
+JOB_TTL = 24 * 3600
+
+_lock = threading.Lock()
+_spans = {}      # (etapa, dataset) -> [segundos, n, conteos por bucket]
+_counters = {}   # (nombre, etiqueta) -> valor
+
+
+def observe(stage, seconds, dataset=""):
+    with _lock:
+        entry = _spans.get((stage, dataset))
+        if entry is None:
+            entry = _spans[(stage, dataset)] = [0.0, 0, [0] * (len(BUCKETS) + 1)]
+        entry[0] += seconds
+        entry[1] += 1
+        entry[2][bisect.bisect_left(BUCKETS, seconds)] += 1
+
+
+@contextmanager
+def span(stage, dataset=""):
+    """Mide el bloque como un tramo de ``stage`` (también si lanza excepción)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, dataset)
+
+
+def count(name, value=1, label=""):
+    if not value:
+        return
+    with _lock:
+        _counters[(name, label)] = _counters.get((name, label), 0) + int(value)
+
+
+def collect():
+    """Devuelve lo acumulado por el proceso (serializable) y lo reinicia."""
+    global _spans, _counters
+    with _lock:
+        spans, counters = _spans, _counters
+        _spans, _counters = {}, {}
+    return {
+        "spans": [[stage, dataset, *entry] for (stage, dataset), entry in spans.items()],
+        "counters": [[name, label, value] for (name, label), value in counters.items()],
+    }
+
+
+def merge(collected):
+    """Suma al proceso lo devuelto por ``collect()`` en otro proceso."""
+    with _lock:
+        for stage, dataset, seconds, n, buckets in collected["spans"]:
+            entry = _spans.get((stage, dataset))
+            if entry is None:
+                entry = _spans[(stage, dataset)] = [0.0, 0, [0] * (len(BUCKETS) + 1)]
+            entry[0] += seconds
+            entry[1] += n
+            entry[2] = [a + b for a, b in zip(entry[2], buckets)]
+        for name, label, value in collected["counters"]:
+            _counters[(name, label)] = _counters.get((name, label), 0) + value
+
+
+_client = None
+
+
+def metrics_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.METRICS_URL, decode_responses=True)
+    return _client
+
+
+def job_key(petition_key):
+    return f"METRICS:job:{petition_key}"
+
+
+def start_job(petition_key):
+    try:
+        client = metrics_client()
+        client.hset(job_key(petition_key), "started", time.time())
+        client.expire(job_key(petition_key), JOB_TTL)
+    except redis.RedisError as e:
+        print("Métricas no disponibles:", e)
+
+
+def job_elapsed(petition_key):
+    """Segundos desde que empezó la petición, o None si no se registró."""
+    try:
+        started = metrics_client().hget(job_key(petition_key), "started")
+    except redis.RedisError as e:
+        print("Métricas no disponibles:", e)
+        return None
+    return time.time() - float(started) if started else None
+
+
+def publish(petition_key=None):
+    """
+    Publica y reinicia lo acumulado por el proceso: siempre en los agregados
+    globales y, con ``petition_key``, también en los totales de la petición.
+    """
+    collected = collect()
+    if not collected["spans"] and not collected["counters"]:
+        return
+
+    job = job_key(petition_key) if petition_key else None
+    try:
+        pipe = metrics_client().pipeline(transaction=False)
+        for stage, dataset, seconds, n, buckets in collected["spans"]:
+            field = f"{stage}|{dataset}"
+            pipe.hincrbyfloat(HISTOGRAMS_KEY, f"{field}|sum", seconds)
+            pipe.hincrby(HISTOGRAMS_KEY, f"{field}|count", n)
+            for i, hits in enumerate(buckets):
+                if hits:
+                    pipe.hincrby(HISTOGRAMS_KEY, f"{field}|{i}", hits)
+            if job:
+                pipe.hincrbyfloat(job, f"span|{field}|seconds", seconds)
+                pipe.hincrby(job, f"span|{field}|count", n)
+        for name, label, value in collected["counters"]:
+            pipe.hincrby(COUNTERS_KEY, f"{name}|{label}", value)
+            if job:
+                pipe.hincrby(job, f"counter|{name}|{label}", value)
+        if job:
+            pipe.expire(job, JOB_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        # Las métricas nunca detienen un análisis
+        print("Métricas no disponibles:", e)
+
+
+def job_summary(petition_key):
+    """
+    Resumen de la petición para ``TempResult.metrics``: segundos y número de
+    tramos por etapa y dataset (de mayor a menor tiempo) y contadores.
+    Los segundos de etapas en procesos paralelos se suman, así que pueden
+    superar a ``elapsed_seconds``.
+    """
+    try:
+        fields = metrics_client().hgetall(job_key(petition_key))
+    except redis.RedisError as e:
+        print("Métricas no disponibles:", e)
+        return {}
+
+    stages = {}
+    counters = []
+    for field, value in fields.items():
+        kind, *parts = field.split("|")
+        if kind == "span":
+            stage, dataset, measure = parts
+            entry = stages.setdefault((stage, dataset), {"stage": stage, "dataset": dataset})
+            entry[measure] = round(float(value), 4) if measure == "seconds" else int(value)
+        elif kind == "counter":
+            name, label = parts
+            counters.append({"name": name, COUNTERS.get(name, ("label",))[0]: label, "value": int(value)})
+
+    started = fields.get("started")
+    return {
+        "elapsed_seconds": round(time.time() - float(started), 3) if started else None,
+        "stages": sorted(stages.values(), key=lambda entry: -entry.get("seconds", 0)),
+        "counters": sorted(counters, key=lambda entry: (entry["name"], -entry["value"])),
+    }
+
+
+def _labels(**labels):
+    escaped = {
+        key: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for key, value in labels.items()
+    }
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped.items()) + "}"
+
+
+def render_prometheus():
+    """Histogramas y contadores globales en el formato de texto de Prometheus."""
+    client = metrics_client()
+    histograms = client.hgetall(HISTOGRAMS_KEY)
+    counters = client.hgetall(COUNTERS_KEY)
+
+    series = {}
+    for field, value in histograms.items():
+        stage, dataset, part = field.split("|")
+        entry = series.setdefault((stage, dataset), {"sum": 0.0, "count": 0, "buckets": [0] * (len(BUCKETS) + 1)})
+        if part == "sum":
+            entry["sum"] = float(value)
+        elif part == "count":
+            entry["count"] = int(value)
+        else:
+            entry["buckets"][int(part)] = int(value)
+
+    lines = [
+        "# HELP tree_capitator_stage_seconds Duración de las etapas del análisis.",
+        "# TYPE tree_capitator_stage_seconds histogram",
+    ]
+    for (stage, dataset), entry in sorted(series.items()):
+        cumulative = 0
+        for bound, hits in zip((*BUCKETS, "+Inf"), entry["buckets"]):
+            cumulative += hits
+            lines.append(
+                f"tree_capitator_stage_seconds_bucket{_labels(stage=stage, dataset=dataset, le=bound)} {cumulative}"
+            )
+        lines.append(f"tree_capitator_stage_seconds_sum{_labels(stage=stage, dataset=dataset)} {entry['sum']}")
+        lines.append(f"tree_capitator_stage_seconds_count{_labels(stage=stage, dataset=dataset)} {entry['count']}")
+
+    values = {}
+    for field, value in counters.items():
+        name, label = field.split("|")
+        values.setdefault(name, []).append((label, int(value)))
+    for name, (label_name, help_text) in COUNTERS.items():
+        lines.append(f"# HELP tree_capitator_{name}_total {help_text}.")
+        lines.append(f"# TYPE tree_capitator_{name}_total counter")
+        for label, value in sorted(values.get(name, [])):
+            lines.append(f"tree_capitator_{name}_total{_labels(**{label_name: label})} {value}")
+
+    return "\n".join(lines) + "\n"
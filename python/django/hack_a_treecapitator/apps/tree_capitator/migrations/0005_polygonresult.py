@@ -0,0 +1,31 @@
+# Generated by Django 4.2.20 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_capitator', '0004_tempresult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PolygonResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('analyzer', models.CharField(max_length=32)),
+                ('catalog_version', models.CharField(max_length=64)),
+                ('result', models.JSONField()),
+                ('last_used', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['last_used'], name='tree_capita_last_us_398ead_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='polygonresult',
+            constraint=models.UniqueConstraint(fields=('fingerprint', 'analyzer'), name='polygon_result_unique'),
+        ),
+    ]
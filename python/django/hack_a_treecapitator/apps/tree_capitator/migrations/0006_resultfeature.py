@@ -0,0 +1,27 @@
+# Generated by Django 4.2.20 on 2026-10-18 11:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_capitator', '0005_polygonresult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResultFeature',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField()),
+                ('data', models.JSONField()),
+                ('result', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='features', to='tree_capitator.tempresult')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='resultfeature',
+            constraint=models.UniqueConstraint(fields=('result', 'index'), name='result_feature_unique'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.20 on 2026-10-18 13:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_capitator', '0006_resultfeature'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='ResultFeature',
+        ),
+        migrations.CreateModel(
+            name='ResultPage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.IntegerField()),
+                ('count', models.IntegerField()),
+                ('payload', models.BinaryField()),
+                ('crc', models.BigIntegerField()),
+                ('size', models.BigIntegerField()),
+                ('result', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pages', to='tree_capitator.tempresult')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='resultpage',
+            constraint=models.UniqueConstraint(fields=('result', 'start'), name='result_page_unique'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.20 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_capitator', '0007_resultpage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistoryState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=64, unique=True)),
+                ('state', models.JSONField()),
+                ('mask', models.BinaryField()),
+                ('last_used', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['last_used'], name='tree_capita_last_us_11a547_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.20 on 2026-10-18 16:20
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_capitator', '0008_historystate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file_model',
+            name='footprint',
+            field=django.contrib.gis.db.models.fields.PolygonField(blank=True, null=True, srid=4326),
+        ),
+        migrations.AddField(
+            model_name='file_model',
+            name='resolution',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.20 on 2026-10-18 17:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_capitator', '0009_file_model_footprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Mosaic',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField()),
+                ('path', models.CharField(max_length=255)),
+                ('tiles', models.JSONField()),
+                ('signature', models.CharField(max_length=16)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('dataset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mosaics', to='tree_capitator.dataset')),
+            ],
+            options={
+                'ordering': ['date', 'pk'],
+            },
+        ),
+    ]
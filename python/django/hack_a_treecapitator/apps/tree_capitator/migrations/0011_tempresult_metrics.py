@@ -0,0 +1,18 @@
+# Generated by Django 4.2.20 on 2026-10-18 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_capitator', '0010_mosaic'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tempresult',
+            name='metrics',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
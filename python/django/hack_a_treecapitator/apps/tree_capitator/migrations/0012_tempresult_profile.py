@@ -0,0 +1,23 @@
+# Generated by Django 4.2.20 on 2026-10-18 19:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_capitator', '0011_tempresult_metrics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tempresult',
+            name='profile',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='tempresult',
+            name='profile_summary',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
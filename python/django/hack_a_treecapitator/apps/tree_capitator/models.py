@@ -1,18 +1,33 @@
 from django.db import models
+from django.contrib.gis.db.models import PolygonField
 from django.core.files.storage import FileSystemStorage
 from django.contrib.auth.models import User
-from django.db.models.signals import post_delete
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 import os
 
+from .resultstore import encode_page, page_features
+
 large_storage = FileSystemStorage(
     location='media',
     base_url='/media/'
 )
 
 class TempResult(models.Model):
+    """
+    Resultado de una petición. ``json_data`` guarda sólo el resumen
+    (``{"type": "FeatureCollection", "count": n}``); las features se guardan
+    comprimidas por páginas en ``ResultPage`` (ver ``resultstore.py``).
+    ``metrics`` guarda los tiempos por etapa y contadores de la petición (ver
+    ``metrics.job_summary``), y ``profile`` / ``profile_summary`` el perfil de
+    las peticiones perfiladas (ver ``profiling.py``).
+    """
     petition_key = models.CharField(max_length=255, unique=True)
     json_data = models.JSONField()
+    metrics = models.JSONField(default=dict, blank=True)
+    profile = models.CharField(max_length=255, blank=True)
+    profile_summary = models.JSONField(default=list, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -20,6 +35,78 @@ class TempResult(models.Model):
             models.Index(fields=["created_at"]),
         ]
 
+    def feature_count(self):
+        return self.json_data.get("count", 0) if isinstance(self.json_data, dict) else 0
+
+    def feature_collection(self):
+        """FeatureCollection completa; sólo para resultados pequeños."""
+        features = []
+        for page in self.pages.order_by("start"):
+            features.extend(page.features())
+        return {"type": "FeatureCollection", "features": features}
+
+
+class ResultPage(models.Model):
+    """Features ``start .. start + count - 1`` de un resultado, comprimidas."""
+    result = models.ForeignKey(TempResult, on_delete=models.CASCADE, related_name="pages")
+    start = models.IntegerField()
+    count = models.IntegerField()
+    payload = models.BinaryField()
+    crc = models.BigIntegerField()
+    size = models.BigIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["result", "start"], name="result_page_unique"),
+        ]
+
+    def features(self):
+        return page_features(self.payload)
+
+    def set_features(self, features):
+        self.payload, self.crc, self.size = encode_page(features)
+        self.count = len(features)
+
+
+class PolygonResult(models.Model):
+    """
+    Resultado de un análisis para un polígono, reutilizable entre peticiones.
+    ``fingerprint`` es la huella de la geometría y ``catalog_version`` la del
+    catálogo de rasters con que se calculó (ver ``fingerprint.py``).
+    """
+    fingerprint = models.CharField(max_length=64)
+    analyzer = models.CharField(max_length=32)
+    catalog_version = models.CharField(max_length=64)
+    result = models.JSONField()
+    last_used = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["fingerprint", "analyzer"], name="polygon_result_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["last_used"]),
+        ]
+
+
+class HistoryState(models.Model):
+    """
+    Estado del historial de deforestación de un polígono (ver
+    ``engine.deforestation_history_states``): ``state`` guarda la cadena de
+    rasters recorrida, el historial y los totales, y ``mask`` la última
+    máscara de clase 0.5 empaquetada en bits. Con él un raster nuevo extiende
+    el historial leyendo sólo ese raster.
+    """
+    fingerprint = models.CharField(max_length=64, unique=True)
+    state = models.JSONField()
+    mask = models.BinaryField()
+    last_used = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["last_used"]),
+        ]
+
 
 def file_upload_path(instance, filename):
     """
@@ -103,6 +190,10 @@ class File_Model(models.Model):
     data_rules = models.JSONField()
     file_url = models.URLField(max_length=500, blank=True)
     dataset = models.ForeignKey(DataSet,on_delete=models.CASCADE,related_name="files")
+    # Extensión del raster en EPSG:4326 (índice GiST) y tamaño de píxel en
+    # metros; se calculan al registrarlo (ver ``ingest.footprint``)
+    footprint = PolygonField(srid=4326, null=True, blank=True)
+    resolution = models.FloatField(null=True, blank=True)
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
@@ -113,8 +204,132 @@ class File_Model(models.Model):
     def __str__(self):
         return self.title + ' ' + str(self.FILE_TYPES[self.file_type])
 
+    def get_cog(self):
+        """Diseño de la copia COG vigente (``data_rules["cog"]``), o None."""
+        rules = self.data_rules if isinstance(self.data_rules, dict) else {}
+        cog = rules.get("cog")
+        if cog and cog.get("original") == self.file.name:
+            return cog
+        return None
+
+    def raster_path(self):
+        """Ruta que deben leer los analizadores: la copia COG si existe."""
+        cog = self.get_cog()
+        if cog:
+            return large_storage.path(cog["path"])
+        return self.file.path
+
+    def get_pyramid(self):
+        """Pirámide de conteos vigente (``data_rules["pyramid"]``), o None."""
+        rules = self.data_rules if isinstance(self.data_rules, dict) else {}
+        pyramid = rules.get("pyramid")
+        if pyramid and pyramid.get("original") == self.file.name:
+            return pyramid
+        return None
+
+    def get_pixel_area(self):
+        """Áreas de píxel por fila vigentes (``data_rules["pixel_area"]``), o None."""
+        rules = self.data_rules if isinstance(self.data_rules, dict) else {}
+        pixel_area = rules.get("pixel_area")
+        if pixel_area and pixel_area.get("original") == self.file.name:
+            return pixel_area
+        return None
+
+    def content_key(self):
+        """Identifica el contenido actual del archivo (cambia si se reemplaza)."""
+        return f"{self.pk}:{self.file.name}"
+
+
+class Mosaic(models.Model):
+    """
+    Mosaico virtual (VRT) de los rasters de un ``DataSet`` con la misma fecha
+    de adquisición, sobre una rejilla común a todo el dataset (ver
+    ``mosaic.py``). Los analizadores lo usan en lugar de sus teselas.
+    """
+    dataset = models.ForeignKey(DataSet, on_delete=models.CASCADE, related_name="mosaics")
+    date = models.DateTimeField()
+    path = models.CharField(max_length=255)
+    # ``content_key`` de las teselas, en el orden en que se apilan
+    tiles = models.JSONField()
+    # Cambia si cambian las teselas, los archivos que leen o la rejilla del dataset
+    signature = models.CharField(max_length=16)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["date", "pk"]
+
+    def __str__(self):
+        return f"{self.dataset.title} {self.date:%Y-%m-%d}"
+
+    def raster_path(self):
+        return large_storage.path(self.path)
+
+    def content_key(self):
+        return f"mosaic:{self.pk}:{self.signature}"
+
+
+@receiver(post_save, sender=File_Model)
+def normalize_raster_on_save(sender, instance, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= {"file_url"}:
+        return
+    if instance.file_type != 0 or not instance.file or instance.get_cog():
+        return
+
+    from .tasks import ingest_raster
+    transaction.on_commit(lambda: ingest_raster.delay(instance.pk))
+
+
+@receiver(post_save, sender=DataSet)
+@receiver(post_delete, sender=DataSet)
+@receiver(post_save, sender=File_Model)
+@receiver(post_delete, sender=File_Model)
+@receiver(post_save, sender=Mosaic)
+@receiver(post_delete, sender=Mosaic)
+def bump_catalog_version_on_change(sender, **kwargs):
+    from .catalog import bump_catalog_version
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver(post_save, sender=File_Model)
+@receiver(post_delete, sender=File_Model)
+def rebuild_mosaics_on_change(sender, instance, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= {"file_url"}:
+        return
+    # Un raster nuevo se agrega al terminar su ingesta (ver ``ingest_raster``)
+    if instance.file_type != 0 or (kwargs.get("signal") is post_save and not instance.get_cog()):
+        return
+
+    from .tasks import rebuild_mosaics
+    dataset_id = instance.dataset_id
+    transaction.on_commit(lambda: rebuild_mosaics.delay(dataset_id))
+
+
+@receiver(post_delete, sender=Mosaic)
+def delete_mosaic_file(sender, instance, **kwargs):
+    if instance.path:
+        large_storage.delete(instance.path)
+
+
+@receiver(post_delete, sender=TempResult)
+def delete_profile_files(sender, instance, **kwargs):
+    if instance.profile:
+        from .profiling import delete_profile
+        delete_profile(instance.petition_key)
+
 
 @receiver(post_delete, sender=File_Model)
 def delete_file_on_remove(sender, instance, **kwargs):
+    # Los ``PolygonResult`` del catálogo anterior no se borran aquí: dejan de
+    # coincidir con ``catalog_version`` y los desaloja ``evict_polygon_results``
     if instance.file:
-        instance.file.delete(save=False)
\ No newline at end of file
+        instance.file.delete(save=False)
+
+    rules = instance.data_rules if isinstance(instance.data_rules, dict) else {}
+    for derived in ("cog", "pyramid", "pixel_area"):
+        if rules.get(derived):
+            large_storage.delete(rules[derived]["path"])
+
+    # Las transiciones del siguiente raster del histórico dejan de ser válidas
+    if rules.get("pyramid") and instance.dataset.category == 0 and instance.dataset.subcategory == 1:
+        from .tasks import rebuild_history_pyramids
+        transaction.on_commit(lambda: rebuild_history_pyramids.delay())
\ No newline at end of file
@@ -0,0 +1,215 @@
+"""
+Mosaicos virtuales de los datasets que llegan por teselas.
+
+Cuando un ``DataSet`` tiene varios rasters con la misma fecha de adquisición
+(teselas de un mismo producto), cada fecha se une en un VRT de GDAL y los
+analizadores usan ese VRT como un solo raster: una fecha cuenta una sola vez
+en el historial y un polígono sólo lee las teselas que toca.
+
+Todos los mosaicos de un dataset comparten una misma rejilla (CRS,
+resolución, origen y extensión de todas sus teselas), de modo que fechas
+consecutivas se comparan píxel a píxel. Los VRT se regeneran con
+``rebuild_dataset_mosaics`` cada vez que cambia un raster del dataset.
+"""
+import hashlib
+import math
+import os
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+import rasterio
+from rasterio.dtypes import dtype_rev, typename_fwd
+from rasterio.transform import Affine
+
+from .models import Mosaic, large_storage
+
+
+Tile = namedtuple("Tile", ["key", "path", "crs", "transform", "width", "height", "dtype", "nodata", "block"])
+
+# Tolerancia (en píxeles) al alinear las teselas con la rejilla
+ALIGN_TOLERANCE = 1e-6
+
+
+def mosaic_name(dataset, date):
+    return f"datasets/mosaic/{dataset.pk}/{date:%Y%m%d}.vrt"
+
+
+def read_tile(file_obj):
+    with rasterio.open(file_obj.raster_path()) as src:
+        return Tile(
+            file_obj.content_key(),
+            src.name,
+            src.crs,
+            src.transform,
+            src.width,
+            src.height,
+            src.dtypes[0],
+            src.nodata,
+            src.block_shapes[0],
+        )
+
+
+def mosaic_signature(grid_token, members):
+    """
+    Huella de un mosaico: rejilla, teselas y el archivo que lee cada una, para
+    que el VRT se regenere cuando una tesela pasa a leer su copia COG.
+    """
+    entries = [[tile.key, tile.path] for tile in members]
+    return hashlib.sha256(repr([grid_token, entries]).encode()).hexdigest()[:16]
+
+
+def dataset_grid(tiles):
+    """
+    Rejilla común de las teselas de un dataset: la de la primera tesela,
+    extendida hasta cubrirlas a todas. Devuelve ``(grid, teselas)`` con las
+    teselas que encajan en ella; las de otro CRS o resolución se descartan.
+    """
+    reference = tiles[0]
+    res_x, res_y = reference.transform.a, reference.transform.e
+    x0, y0 = reference.transform.c, reference.transform.f
+
+    aligned = []
+    for tile in tiles:
+        transform = tile.transform
+        if (
+            tile.crs != reference.crs
+            or transform.b or transform.d
+            or not math.isclose(transform.a, res_x, rel_tol=ALIGN_TOLERANCE)
+            or not math.isclose(transform.e, res_y, rel_tol=ALIGN_TOLERANCE)
+        ):
+            print("Tesela fuera de la rejilla del dataset:", tile.path)
+            continue
+        aligned.append(tile)
+
+    col0 = min(math.floor((t.transform.c - x0) / res_x + ALIGN_TOLERANCE) for t in aligned)
+    row0 = min(math.floor((t.transform.f - y0) / res_y + ALIGN_TOLERANCE) for t in aligned)
+    col1 = max(math.ceil((t.transform.c - x0) / res_x + t.width - ALIGN_TOLERANCE) for t in aligned)
+    row1 = max(math.ceil((t.transform.f - y0) / res_y + t.height - ALIGN_TOLERANCE) for t in aligned)
+
+    grid = {
+        "crs": reference.crs,
+        "transform": Affine(res_x, 0, x0 + col0 * res_x, 0, res_y, y0 + row0 * res_y),
+        "width": col1 - col0,
+        "height": row1 - row0,
+        "dtype": reference.dtype,
+        "nodata": reference.nodata,
+    }
+    return grid, aligned
+
+
+def _number(value):
+    return repr(float(value))
+
+
+def vrt_document(grid, tiles):
+    """XML del VRT de ``tiles`` sobre ``grid``; las teselas posteriores quedan encima."""
+    transform = grid["transform"]
+    dataset = ET.Element("VRTDataset", rasterXSize=str(grid["width"]), rasterYSize=str(grid["height"]))
+    ET.SubElement(dataset, "SRS").text = grid["crs"].to_wkt()
+    ET.SubElement(dataset, "GeoTransform").text = ", ".join(
+        _number(v) for v in (transform.c, transform.a, transform.b, transform.f, transform.d, transform.e)
+    )
+
+    band = ET.SubElement(dataset, "VRTRasterBand", dataType=typename_fwd[dtype_rev[grid["dtype"]]], band="1")
+    nodata = grid["nodata"]
+    if nodata is not None:
+        ET.SubElement(band, "NoDataValue").text = _number(nodata)
+
+    for tile in tiles:
+        # Con NODATA los píxeles sin dato de una tesela no tapan a las demás
+        source = ET.SubElement(band, "ComplexSource" if tile.nodata is not None else "SimpleSource")
+        ET.SubElement(source, "SourceFilename", relativeToVRT="0").text = tile.path
+        ET.SubElement(source, "SourceBand").text = "1"
+        ET.SubElement(
+            source,
+            "SourceProperties",
+            RasterXSize=str(tile.width),
+            RasterYSize=str(tile.height),
+            DataType=typename_fwd[dtype_rev[tile.dtype]],
+            BlockXSize=str(tile.block[1]),
+            BlockYSize=str(tile.block[0]),
+        )
+        ET.SubElement(source, "SrcRect", xOff="0", yOff="0", xSize=str(tile.width), ySize=str(tile.height))
+        ET.SubElement(
+            source,
+            "DstRect",
+            xOff=_number((tile.transform.c - transform.c) / transform.a),
+            yOff=_number((tile.transform.f - transform.f) / transform.e),
+            xSize=str(tile.width),
+            ySize=str(tile.height),
+        )
+        if tile.nodata is not None:
+            ET.SubElement(source, "NODATA").text = _number(tile.nodata)
+
+    return ET.tostring(dataset, encoding="unicode")
+
+
+def write_vrt(path, document):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write(document)
+    os.replace(tmp_path, path)
+
+
+def rebuild_dataset_mosaics(dataset):
+    """
+    Regenera los mosaicos de ``dataset``: uno por fecha si alguna fecha tiene
+    más de un raster, ninguno si no. Sólo se reescriben los VRT cuyas teselas
+    o rejilla cambiaron. Devuelve True si cambió algún mosaico.
+    """
+    by_date = {}
+    for file_obj in dataset.files.filter(file_type=0).order_by("date", "pk"):
+        by_date.setdefault(file_obj.date.date(), []).append(file_obj)
+
+    existing = {mosaic.date.date(): mosaic for mosaic in dataset.mosaics.all()}
+    if not any(len(files) > 1 for files in by_date.values()):
+        for mosaic in existing.values():
+            mosaic.delete()
+        return bool(existing)
+
+    tiles = {}
+    for files in by_date.values():
+        for file_obj in files:
+            try:
+                tiles[file_obj.pk] = read_tile(file_obj)
+            except Exception as e:
+                print("Error leyendo tesela:", file_obj.file.name, str(e))
+    if not tiles:
+        return False
+
+    grid, aligned = dataset_grid(list(tiles.values()))
+    aligned = {tile.key for tile in aligned}
+    grid_token = repr([grid["crs"].to_wkt(), tuple(grid["transform"]), grid["width"], grid["height"]])
+
+    changed = False
+    for day, files in by_date.items():
+        members = [tiles[f.pk] for f in files if f.pk in tiles and tiles[f.pk].key in aligned]
+        mosaic = existing.pop(day, None)
+        if not members:
+            if mosaic is not None:
+                mosaic.delete()
+                changed = True
+            continue
+
+        keys = [tile.key for tile in members]
+        signature = mosaic_signature(grid_token, members)
+        name = mosaic_name(dataset, day)
+        if mosaic is not None and mosaic.signature == signature and large_storage.exists(mosaic.path):
+            continue
+
+        write_vrt(large_storage.path(name), vrt_document(grid, members))
+        if mosaic is None:
+            mosaic = Mosaic(dataset=dataset)
+        mosaic.date = files[0].date
+        mosaic.path = name
+        mosaic.tiles = keys
+        mosaic.signature = signature
+        mosaic.save()
+        changed = True
+
+    # Fechas que ya no tienen rasters
+    for mosaic in existing.values():
+        mosaic.delete()
+        changed = True
+    return changed
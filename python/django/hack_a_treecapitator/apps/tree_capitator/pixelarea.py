@@ -0,0 +1,110 @@
+"""
+Área real de los píxeles de un raster, fila por fila.
+
+En un raster en grados (EPSG:4326) el área de un píxel depende de la latitud,
+así que se precalcula un vector con el área geodésica (m²) de un píxel de
+cada fila: para celdas limitadas por paralelos y meridianos se usa la fórmula
+exacta de la zona elipsoidal. En CRS proyectados se mide sobre el elipsoide
+el píxel de la columna central de cada fila.
+
+El vector se guarda al registrar el raster (``data_rules["pixel_area"]``) y
+los analizadores convierten píxeles en área con una suma ponderada por fila
+en lugar de multiplicar por un tamaño de píxel fijo.
+"""
+import os
+
+import numpy as np
+from pyproj import CRS, Geod, Transformer
+
+
+def _authalic_q(phi, e):
+    sin_phi = np.sin(phi)
+    if e == 0:
+        return 2 * sin_phi
+    return (1 - e ** 2) * (
+        sin_phi / (1 - (e * sin_phi) ** 2)
+        - np.log((1 - e * sin_phi) / (1 + e * sin_phi)) / (2 * e)
+    )
+
+
+def _geographic_row_areas(crs, transform, height):
+    ellipsoid = crs.ellipsoid
+    a = ellipsoid.semi_major_metre
+    inverse_flattening = ellipsoid.inverse_flattening
+    f = 1 / inverse_flattening if inverse_flattening else 0
+    e = np.sqrt(f * (2 - f))
+
+    rows = np.arange(height + 1, dtype="float64")
+    lat_edges = np.radians(np.clip(transform.f + rows * transform.e, -90, 90))
+    dlon = np.radians(abs(transform.a))
+
+    # Área de la zona entre dos paralelos por radián de longitud
+    q = _authalic_q(lat_edges, e)
+    return np.abs(np.diff(q)) * a ** 2 / 2 * dlon
+
+
+def _projected_row_areas(crs, transform, width, height):
+    geographic = crs.geodetic_crs
+    to_geographic = Transformer.from_crs(crs, geographic, always_xy=True)
+    ellipsoid = geographic.ellipsoid
+    rf = ellipsoid.inverse_flattening
+    geod = Geod(a=ellipsoid.semi_major_metre, f=1 / rf if rf else 0)
+
+    # Esquinas del píxel de la columna central de cada fila
+    rows = np.arange(height, dtype="float64")[:, None]
+    cols = width // 2 + np.array([0, 1, 1, 0], dtype="float64")
+    offsets = np.array([0, 0, 1, 1], dtype="float64")
+    xs = transform.a * cols + transform.b * (rows + offsets) + transform.c
+    ys = transform.d * cols + transform.e * (rows + offsets) + transform.f
+    lons, lats = to_geographic.transform(xs, ys)
+
+    return np.array([
+        abs(geod.polygon_area_perimeter(lon, lat)[0])
+        for lon, lat in zip(lons, lats)
+    ])
+
+
+def row_areas(crs, transform, width, height):
+    """Área (m²) de un píxel de cada fila, arreglo de largo ``height``."""
+    crs = CRS.from_user_input(crs) if crs is not None else None
+    if crs is None:
+        # Sin CRS no hay forma de medir: se asume que las unidades son metros
+        return np.full(height, abs(transform.a * transform.e - transform.b * transform.d))
+    if crs.is_geographic and transform.b == 0 and transform.d == 0:
+        return _geographic_row_areas(crs, transform, height)
+    return _projected_row_areas(crs, transform, width, height)
+
+
+def save_row_areas(path, areas):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp.npy"
+    np.save(tmp_path, areas)
+    os.replace(tmp_path, path)
+
+
+_memo = {}
+
+
+def row_areas_for(source, src):
+    """
+    Áreas por fila de un raster abierto: las precalculadas al registrarlo
+    si coinciden con su alto, o calculadas y memorizadas por rejilla.
+    """
+    key = (str(src.crs), tuple(src.transform), src.width, src.height)
+    if key in _memo:
+        return _memo[key]
+
+    areas = None
+    if getattr(source, "area", None):
+        try:
+            areas = np.load(source.area)
+        except Exception as e:
+            print("Error leyendo áreas por fila:", source.area, str(e))
+        if areas is not None and areas.shape != (src.height,):
+            areas = None
+
+    if areas is None:
+        areas = row_areas(src.crs, src.transform, src.width, src.height)
+
+    _memo[key] = areas
+    return areas
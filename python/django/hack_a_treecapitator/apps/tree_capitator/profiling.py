@@ -0,0 +1,140 @@
+"""
+Perfilado opcional de una petición.
+
+Con ``profile`` en la subida (sólo staff), cada tarea de la petición
+(``modelo_gdf``, los bloques, el clima, la unión y las descripciones
+diferidas) corre bajo cProfile y guarda sus estadísticas en
+``{petition_key}/`` dentro de ``PROFILE_ROOT``. Cuando el resultado ya
+existe, las partes se unen en ``{petition_key}.prof`` (``TempResult.profile``)
+y las funciones más costosas se resumen en ``TempResult.profile_summary``
+para el admin. El archivo se abre con ``pstats`` o snakeviz.
+
+``PROFILE_ROOT`` queda fuera de ``MEDIA_ROOT``: los perfiles exponen rutas y
+estructura del código, así que sólo se descargan por la vista del admin.
+
+Los bloques de una petición perfilada analizan los rasters en el proceso del
+worker, sin ``run_raster_analysis_pool``, para que el perfil los cubra.
+"""
+import cProfile
+import os
+import pstats
+
+import redis
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+
+from .metrics import JOB_TTL, job_key, metrics_client
+
+
+# Fuera de ``MEDIA_ROOT``: los perfiles no tienen URL pública
+profile_storage = FileSystemStorage(location=settings.PROFILE_ROOT)
+
+
+_profiler = None
+_owner = None
+
+
+def profile_name(petition_key):
+    return f"{petition_key}.prof"
+
+
+def parts_dir(petition_key):
+    return petition_key
+
+
+def request_profile(petition_key):
+    """Marca la petición para que sus tareas corran bajo el perfilador."""
+    try:
+        client = metrics_client()
+        client.hset(job_key(petition_key), "profile", 1)
+        client.expire(job_key(petition_key), JOB_TTL)
+    except redis.RedisError as e:
+        print("Perfilado no disponible:", e)
+
+
+def profile_requested(petition_key):
+    try:
+        return bool(metrics_client().hget(job_key(petition_key), "profile"))
+    except redis.RedisError as e:
+        print("Perfilado no disponible:", e)
+        return False
+
+
+def start(task_id):
+    """
+    Empieza a perfilar la tarea ``task_id``. Con Celery en modo eager las
+    subtareas corren dentro de la tarea que ya se está perfilando, y el
+    perfil de esa tarea las incluye.
+    """
+    global _profiler, _owner
+    if _profiler is not None:
+        return
+    _profiler, _owner = cProfile.Profile(), task_id
+    _profiler.enable()
+
+
+def stop(task_id, petition_key, task_name):
+    """Detiene el perfil de ``task_id`` y guarda sus estadísticas; devuelve True si había uno."""
+    global _profiler, _owner
+    if _profiler is None or _owner != task_id:
+        return False
+    profiler, _profiler, _owner = _profiler, None, None
+    profiler.disable()
+
+    path = profile_storage.path(f"{parts_dir(petition_key)}/{task_name}-{task_id}.prof")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    profiler.dump_stats(path)
+    return True
+
+
+def hotspots(stats, limit):
+    """Las ``limit`` funciones con más tiempo propio."""
+    rows = []
+    for (filename, line, function), (_, calls, own, cumulative, _) in stats.stats.items():
+        rows.append({
+            "function": function,
+            "file": filename,
+            "line": line,
+            "calls": calls,
+            "tottime": round(own, 4),
+            "cumtime": round(cumulative, 4),
+        })
+    rows.sort(key=lambda row: -row["tottime"])
+    return rows[:limit]
+
+
+def combine(petition_key):
+    """
+    Une las partes de la petición en ``profile_name`` y devuelve
+    ``(nombre, resumen)``, o ``(None, [])`` si no hay partes.
+    """
+    directory = parts_dir(petition_key)
+    if not profile_storage.exists(directory):
+        return None, []
+    parts = [
+        profile_storage.path(f"{directory}/{name}")
+        for name in sorted(profile_storage.listdir(directory)[1])
+        if name.endswith(".prof")
+    ]
+    if not parts:
+        return None, []
+
+    stats = pstats.Stats(*parts)
+    name = profile_name(petition_key)
+    tmp_path = f"{profile_storage.path(name)}.tmp"
+    stats.dump_stats(tmp_path)
+    os.replace(tmp_path, profile_storage.path(name))
+    return name, hotspots(stats, settings.PROFILE_TOP_N)
+
+
+def active():
+    return _profiler is not None
+
+
+def delete_profile(petition_key):
+    directory = parts_dir(petition_key)
+    if profile_storage.exists(directory):
+        for name in profile_storage.listdir(directory)[1]:
+            profile_storage.delete(f"{directory}/{name}")
+        os.rmdir(profile_storage.path(directory))
+    profile_storage.delete(profile_name(petition_key))
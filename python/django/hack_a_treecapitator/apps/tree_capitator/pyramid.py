@@ -0,0 +1,274 @@
+"""
+Pirámide de conteos por tesela para rasters de deforestación.
+
+Al registrar un raster de categoría 0 se precalcula, por tesela fija de
+``RASTER_TILE_SIZE`` píxeles, el número de píxeles de cada código (años
+Hansen 1-24, o clases 0/0.5/1 del histórico más los píxeles nuevos en 0.5
+respecto al raster anterior de la cadena). Cada nivel superior suma bloques
+de 2x2 teselas del nivel anterior. Si se conoce el área de los píxeles de
+cada fila (ver ``pixelarea.py``), se guarda también el área (m²) por tesela
+y código.
+
+En consulta, las teselas completamente dentro de un polígono se responden
+desde la pirámide y sólo las teselas del borde se leen a resolución completa,
+de modo que el costo escala con el perímetro y no con el área.
+"""
+import math
+import os
+import tempfile
+
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.windows import Window
+from shapely.geometry import Polygon
+from shapely.prepared import prep
+
+
+PYRAMID_MAX_LEVELS = 6
+
+HANSEN_BINS = 25     # códigos de año 0..24 (el 0 no se usa)
+HISTORY_BINS = 4     # clases 0 / 0.5 / 1 y píxeles nuevos en 0.5
+NEW_DEF_BIN = 3
+
+
+def pyramid_levels(width, height, tile_size, max_levels=PYRAMID_MAX_LEVELS):
+    """Número de niveles de la pirámide para una rejilla dada."""
+    levels = 1
+    while levels < max_levels:
+        size = tile_size * 2 ** (levels - 1)
+        if math.ceil(width / size) <= 1 and math.ceil(height / size) <= 1:
+            break
+        levels += 1
+    return levels
+
+
+def _tile_counts(codes, selection, tile_size, n_tiles_x, bins, weights=None):
+    """
+    Conteo por (tesela, código) de una franja de ``tile_size`` filas; con
+    ``weights`` (uno por fila de la franja) suma esos pesos en lugar de contar.
+    """
+    tile_cols = np.broadcast_to(np.arange(codes.shape[1]) // tile_size, codes.shape)
+    flat = tile_cols[selection] * bins + codes[selection].astype("int64")
+    if weights is not None:
+        weights = np.broadcast_to(weights[:, None], codes.shape)[selection]
+    return np.bincount(flat, weights=weights, minlength=n_tiles_x * bins).reshape(n_tiles_x, bins)
+
+
+def _coarsen(level):
+    """Suma bloques de 2x2 teselas para obtener el nivel superior."""
+    ty, tx, bins = level.shape
+    padded = np.zeros((ty + ty % 2, tx + tx % 2, bins), dtype=level.dtype)
+    padded[:ty, :tx] = level
+    return padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2, bins).sum(axis=(1, 3))
+
+
+def _read_strip(src, row, tile_size):
+    window = Window(0, row * tile_size, src.width, min(tile_size, src.height - row * tile_size))
+    data = src.read(1, window=window, masked=True)
+    values = data.data.astype("float32")
+    values[np.ma.getmaskarray(data)] = np.nan
+    return values
+
+
+def same_grid(a, b):
+    return a.crs == b.crs and a.transform == b.transform and a.width == b.width and a.height == b.height
+
+
+class TilePyramid:
+    """Conteos por tesela de un raster, en ``n_levels`` niveles."""
+
+    def __init__(self, levels, tile_size, transform, width, height, previous=None, areas=None):
+        self.levels = levels
+        self.areas = areas
+        self.tile_size = tile_size
+        self.transform = transform
+        self.width = width
+        self.height = height
+        self.previous = previous
+
+    @property
+    def bins(self):
+        return self.levels[0].shape[2]
+
+    def matches(self, src):
+        return (
+            tuple(src.transform) == tuple(self.transform)
+            and src.width == self.width
+            and src.height == self.height
+        )
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Un temporal propio por llamada: dos ingestas pueden guardar la misma pirámide
+        fd, tmp_path = tempfile.mkstemp(suffix=".npz", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as file:
+                np.savez_compressed(
+                    file,
+                    tile_size=self.tile_size,
+                    transform=np.array(tuple(self.transform)[:6]),
+                    shape=np.array([self.height, self.width]),
+                    **{f"level{i}": level for i, level in enumerate(self.levels)},
+                    **{f"area{i}": area for i, area in enumerate(self.areas or [])},
+                )
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path, previous=None):
+        with np.load(path) as data:
+            n_levels = sum(1 for key in data.files if key.startswith("level"))
+            height, width = (int(v) for v in data["shape"])
+            return cls(
+                levels=[data[f"level{i}"] for i in range(n_levels)],
+                areas=[data[f"area{i}"] for i in range(n_levels)] if "area0" in data.files else None,
+                tile_size=int(data["tile_size"]),
+                transform=Affine(*data["transform"]),
+                width=width,
+                height=height,
+                previous=previous,
+            )
+
+    @classmethod
+    def from_level0(cls, level0, tile_size, src, previous=None, area0=None):
+        levels, areas = [level0], [area0] if area0 is not None else None
+        for _ in range(pyramid_levels(src.width, src.height, tile_size) - 1):
+            levels.append(_coarsen(levels[-1]))
+            if areas is not None:
+                areas.append(_coarsen(areas[-1]))
+        return cls(levels, tile_size, src.transform, src.width, src.height, previous, areas)
+
+
+def _strip_weights(row_area, row, tile_size):
+    if row_area is None:
+        return None
+    return row_area[row * tile_size:(row + 1) * tile_size]
+
+
+def build_hansen_pyramid(path, tile_size, row_area=None):
+    """Pirámide de conteos (y áreas, con ``row_area``) por año Hansen (1-24)."""
+    with rasterio.open(path) as src:
+        ty, tx = math.ceil(src.height / tile_size), math.ceil(src.width / tile_size)
+        level0 = np.zeros((ty, tx, HANSEN_BINS), dtype="int64")
+        area0 = np.zeros((ty, tx, HANSEN_BINS)) if row_area is not None else None
+
+        for row in range(ty):
+            values = _read_strip(src, row, tile_size)
+            is_year = (values >= 1) & (values <= 24) & (values == np.floor(values))
+            codes = np.where(is_year, values, 0)
+            level0[row] = _tile_counts(codes, is_year, tile_size, tx, HANSEN_BINS)
+            if area0 is not None:
+                weights = _strip_weights(row_area, row, tile_size)
+                area0[row] = _tile_counts(codes, is_year, tile_size, tx, HANSEN_BINS, weights)
+
+        return TilePyramid.from_level0(level0, tile_size, src, area0=area0)
+
+
+def build_history_pyramid(path, tile_size, previous_path=None, previous=None, row_area=None):
+    """
+    Pirámide de clases del histórico (0/0.5/1) y de píxeles nuevos en 0.5
+    respecto a ``previous_path``. Si no hay raster anterior o no comparte
+    rejilla, la pirámide no guarda transiciones (``previous`` queda en None).
+    """
+    with rasterio.open(path) as src:
+        ty, tx = math.ceil(src.height / tile_size), math.ceil(src.width / tile_size)
+        level0 = np.zeros((ty, tx, HISTORY_BINS), dtype="int64")
+        area0 = np.zeros((ty, tx, HISTORY_BINS)) if row_area is not None else None
+
+        prev_src = rasterio.open(previous_path) if previous_path else None
+        try:
+            if prev_src is not None and not same_grid(src, prev_src):
+                prev_src.close()
+                prev_src, previous = None, None
+            if prev_src is None:
+                previous = None
+
+            for row in range(ty):
+                values = _read_strip(src, row, tile_size)
+                classes = np.rint(values * 2)
+                is_class = np.isin(classes, (0, 1, 2)) & (values * 2 == classes)
+                counts = _tile_counts(classes, is_class, tile_size, tx, 3)
+                weights = _strip_weights(row_area, row, tile_size)
+
+                if prev_src is not None:
+                    current_mask = values == 0.5
+                    previous_mask = _read_strip(prev_src, row, tile_size) == 0.5
+                    new_def = np.logical_and(current_mask, np.logical_not(previous_mask))
+                else:
+                    new_def = np.zeros(values.shape, dtype=bool)
+                new_counts = _tile_counts(np.zeros(values.shape), new_def, tile_size, tx, 1)
+
+                level0[row] = np.concatenate([counts, new_counts], axis=1)
+                if area0 is not None:
+                    area0[row] = np.concatenate([
+                        _tile_counts(classes, is_class, tile_size, tx, 3, weights),
+                        _tile_counts(np.zeros(values.shape), new_def, tile_size, tx, 1, weights),
+                    ], axis=1)
+        finally:
+            if prev_src is not None:
+                prev_src.close()
+
+        return TilePyramid.from_level0(level0, tile_size, src, previous, area0)
+
+
+def load_pyramid(source):
+    """Pirámide registrada para un ``RasterSource``, o None si no hay o falla."""
+    if not source.pyramid:
+        return None
+    try:
+        return TilePyramid.load(source.pyramid["path"], source.pyramid.get("previous"))
+    except Exception as e:
+        print("Error leyendo pirámide:", source.pyramid["path"], str(e))
+        return None
+
+
+def _tile_polygon(transform, row0, row1, col0, col1):
+    corners = [(col0, row0), (col1, row0), (col1, row1), (col0, row1)]
+    return Polygon([transform * corner for corner in corners])
+
+
+def interior_tiles(geometry, window, transform, width, height, tile_size, n_levels):
+    """
+    Teselas ``(nivel, fila, columna)`` completamente dentro de ``geometry``,
+    usando la tesela más grande posible (descenso tipo quadtree).
+    ``window`` es la ventana de píxeles ``(row0, row1, col0, col1)`` del polígono.
+    """
+    row0, row1, col0, col1 = (int(v) for v in window)
+    if row1 - row0 < tile_size or col1 - col0 < tile_size:
+        return []
+
+    prepared = prep(geometry)
+    top = n_levels - 1
+    size = tile_size * 2 ** top
+    stack = [
+        (top, r, c)
+        for r in range(row0 // size, (row1 - 1) // size + 1)
+        for c in range(col0 // size, (col1 - 1) // size + 1)
+    ]
+
+    tiles = []
+    while stack:
+        level, r, c = stack.pop()
+        size = tile_size * 2 ** level
+        if r * size >= height or c * size >= width:
+            continue
+
+        tile = _tile_polygon(
+            transform,
+            r * size, min((r + 1) * size, height),
+            c * size, min((c + 1) * size, width),
+        )
+        if not prepared.intersects(tile):
+            continue
+        if prepared.contains(tile):
+            tiles.append((level, r, c))
+        elif level > 0:
+            stack.extend(
+                (level - 1, 2 * r + dr, 2 * c + dc) for dr in (0, 1) for dc in (0, 1)
+            )
+
+    return tiles
@@ -0,0 +1,105 @@
+"""
+Pool de datasets rasterio abiertos por proceso.
+
+Abrir un raster cuesta leer su encabezado y, sobre todo, pierde la caché de
+bloques de GDAL que se calentó con lecturas anteriores. Los analizadores piden
+los rasters a este pool, que los mantiene abiertos entre polígonos y entre
+trabajos en un LRU limitado a ``max_open`` archivos. La llave incluye la fecha
+de modificación, así que un archivo reemplazado se vuelve a abrir.
+
+Los datasets abiertos no se comparten entre procesos: después de un fork el
+pool se vacía en el hijo, que abre sus propios archivos.
+
+Este módulo no depende de Django para poder usarse en los procesos
+auxiliares del motor; la configuración llega por ``configure``.
+"""
+import os
+import resource
+import threading
+from collections import OrderedDict
+
+import rasterio
+
+
+DEFAULT_MAX_OPEN = 64
+
+_lock = threading.Lock()
+_pool = OrderedDict()
+_max_open = DEFAULT_MAX_OPEN
+
+
+def _fd_limit(max_open):
+    # Se deja margen para sockets, archivos temporales y sidecars de GDAL
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return max_open
+    return max(1, min(max_open, soft // 4))
+
+
+def configure(max_open=DEFAULT_MAX_OPEN, gdal_config=None):
+    """
+    Fija el tamaño del pool y las opciones de GDAL (``GDAL_CACHEMAX``, etc.).
+    Las opciones se exportan como variables de entorno, que GDAL lee al
+    inicializarse y que heredan los procesos hijos.
+    """
+    global _max_open
+    for key, value in (gdal_config or {}).items():
+        os.environ[key] = str(value)
+    with _lock:
+        _max_open = _fd_limit(max_open)
+        _trim()
+
+
+def max_open():
+    return _max_open
+
+
+def _close(src):
+    try:
+        src.close()
+    except Exception as e:
+        print("Error cerrando raster:", src.name, str(e))
+
+
+def _trim():
+    while len(_pool) > _max_open:
+        _, src = _pool.popitem(last=False)
+        _close(src)
+
+
+def open_raster(path):
+    """
+    Dataset abierto para ``path``. No debe cerrarse: el pool decide cuándo
+    liberarlo.
+    """
+    key = (path, os.stat(path).st_mtime_ns)
+    with _lock:
+        src = _pool.get(key)
+        if src is not None and not src.closed:
+            _pool.move_to_end(key)
+            return src
+
+        # Versiones anteriores del mismo archivo ya no se usarán
+        for stale in [k for k in _pool if k[0] == path]:
+            _close(_pool.pop(stale))
+
+        src = rasterio.open(path)
+        _pool[key] = src
+        _trim()
+        return src
+
+
+def clear():
+    with _lock:
+        while _pool:
+            _close(_pool.popitem()[1])
+
+
+def _reset_after_fork():
+    # Los handles heredados pertenecen al padre: el hijo los descarta
+    global _lock
+    _lock = threading.Lock()
+    _pool.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
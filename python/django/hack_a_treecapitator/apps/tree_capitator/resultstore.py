@@ -0,0 +1,121 @@
+"""
+Formato comprimido de los resultados.
+
+Las features de un resultado se guardan por páginas. Cada página es el texto
+``feature,\\nfeature,\\n...`` comprimido como un fragmento DEFLATE crudo
+cerrado con ``Z_FULL_FLUSH``: el fragmento no referencia datos anteriores y
+termina alineado a byte, así que varios fragmentos seguidos forman un flujo
+DEFLATE válido. Con el CRC32 y el tamaño de cada página se arma la cola del
+gzip sin descomprimir nada, y el GeoJSON completo se envía tal cual está
+guardado a los clientes que aceptan ``Content-Encoding: gzip``.
+
+Los flujos son generadores asíncronos: con ASGI, Django consume un iterador
+síncrono completo antes de enviar la respuesta.
+"""
+import json
+import struct
+import zlib
+
+
+SEPARATOR = ",\n"
+
+# Encabezado gzip mínimo: DEFLATE, sin nombre ni fecha, SO desconocido
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+FINAL_BLOCK = b"\x03\x00"   # bloque final vacío
+
+
+def encode_text(text, level=6):
+    """Fragmento ``(payload, crc32, tamaño)`` del texto."""
+    raw = text.encode()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    payload = compressor.compress(raw) + compressor.flush(zlib.Z_FULL_FLUSH)
+    return payload, zlib.crc32(raw), len(raw)
+
+
+def encode_page(features, level=6):
+    """Fragmento de una página de features (dicts)."""
+    return encode_text(SEPARATOR.join(json.dumps(feature) for feature in features), level)
+
+
+def decode_text(payload):
+    return zlib.decompressobj(-15).decompress(bytes(payload)).decode()
+
+
+def page_features(payload):
+    return json.loads(f"[{decode_text(payload)}]")
+
+
+def page_lines(payload):
+    """Una línea JSON por feature (las features no contienen saltos de línea)."""
+    return [line.rstrip(",") for line in decode_text(payload).split("\n")]
+
+
+def crc32_combine(crc1, crc2, size2):
+    """CRC32 de ``A + B`` a partir de ``crc32(A)``, ``crc32(B)`` y ``len(B)``."""
+    zeros = b"\0" * size2
+    return zlib.crc32(zeros, crc1) ^ zlib.crc32(zeros) ^ crc2
+
+
+async def geojson_fragments(pages, level=6):
+    """
+    Fragmentos del FeatureCollection completo: encabezado, páginas con su
+    separador y cierre. ``pages`` es un iterable asíncrono de
+    ``(payload, crc32, tamaño)``, p. ej. ``QuerySet.aiterator()``.
+    """
+    yield encode_text('{"type": "FeatureCollection", "features": [\n', level)
+    separator = encode_text(SEPARATOR, level)
+    first = True
+    async for page in pages:
+        if not first:
+            yield separator
+        first = False
+        yield page
+    yield encode_text("\n]}", level)
+
+
+async def gzip_stream(fragments):
+    """Flujo gzip a partir de fragmentos ya comprimidos, sin recomprimir."""
+    crc, size = 0, 0
+    yield GZIP_HEADER
+    async for payload, fragment_crc, fragment_size in fragments:
+        yield bytes(payload)
+        crc = crc32_combine(crc, fragment_crc, fragment_size)
+        size += fragment_size
+    yield FINAL_BLOCK + struct.pack("<II", crc & 0xFFFFFFFF, size & 0xFFFFFFFF)
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Si la cabecera ``Accept-Encoding`` admite gzip: ``gzip`` (o ``x-gzip``),
+    o ``*`` si gzip no aparece, con ``q`` mayor que 0.
+    """
+    weights = {}
+    for entry in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in entry.split(";")]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding.lower()] = q
+
+    for coding in ("gzip", "x-gzip", "*"):
+        if coding in weights:
+            return weights[coding] > 0
+    return False
+
+
+async def text_stream(fragments):
+    async for payload, _, _ in fragments:
+        yield decode_text(payload)
+
+
+async def ndjson_stream(pages):
+    async for payload, _, _ in pages:
+        for line in page_lines(payload):
+            yield f"{line}\n"
@@ -4,10 +4,31 @@ from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
 from django.core.mail import send_mail
 import tempfile
-from celery import shared_task
+from celery import chord, group, shared_task
+from celery.signals import task_postrun, task_prerun, worker_init, worker_process_init
+from django.conf import settings
+from django.db import transaction
 import os
+import inspect
 import logging
-from .models import DataSet, File_Model, TempResult
+from .models import DataSet, File_Model, HistoryState, PolygonResult, ResultPage, TempResult, large_storage
+from .weather import fetch_weather
+from .descriptions import describe_all, prompt_inputs
+from .events import progress_channel
+from .loaders import delete_upload, frame_name, load_frame, load_upload, save_frame
+from .ingest import footprint, hansen_pyramid, history_pyramid, normalize_raster, pixel_area
+from .mosaic import rebuild_dataset_mosaics
+from . import metrics, profiling, rasterpool
+from .catalog import bump_catalog_version, catalog_snapshot, rasters_outside
+from .fingerprint import ANALYZERS, catalog_versions, geometry_fingerprint, without_entries
+from .engine import (
+    HISTORY_STATE,
+    count_sources,
+    deforestation_hansen_stats,
+    deforestation_history_stats,
+    index_stats,
+    run_raster_analysis_pool,
+)
 import rasterio
 from rasterio.windows import from_bounds
 import geopandas as gpd
@@ -18,8 +39,6 @@ import json
 import numpy as np
 from rasterio.mask import mask
 from django.db.models import Q
-import gzip
-import base64
 from django.utils import timezone
 from datetime import timedelta
 import pyproj
@@ -34,17 +53,257 @@ import pandas as pd
 from shapely.geometry import mapping
 from datetime import datetime
 
-import openai
 import os
 
-openai.api_key = os.environ.get("OPENAI_API_KEY")  # Pon tu API key en la variable de entorno
-
 redis_manager_for_polygons = redis.Redis.from_url("redis://dragonfly:6379/0", decode_responses=True)
+
+
+@worker_init.connect
+@worker_process_init.connect
+def configure_raster_access(**kwargs):
+    """Opciones de GDAL y tamaño del pool de rasters en cada proceso del worker."""
+    rasterpool.configure(settings.RASTER_POOL_MAX_OPEN, settings.GDAL_CONFIG)
+
+
+_task_started = {}
+
+
+def task_petition_key(task, args, kwargs):
+    try:
+        return inspect.signature(task.run).bind(*args, **(kwargs or {})).arguments.get("petition_key")
+    except TypeError:
+        return None
+
+
+@task_prerun.connect
+def start_task_tracking(task_id=None, task=None, args=(), kwargs=None, **extra):
+    """Cronometra cada tarea y perfila las de las peticiones perfiladas."""
+    _task_started[task_id] = time.perf_counter()
+    petition_key = task_petition_key(task, args, kwargs)
+    if petition_key and profiling.profile_requested(petition_key):
+        profiling.start(task_id)
+
+
+@task_postrun.connect
+def finish_task_tracking(task_id=None, task=None, args=(), kwargs=None, **extra):
+    """
+    Al terminar cada tarea se publican sus tiempos y contadores (ver
+    ``metrics.py``); los de las tareas con ``petition_key`` se suman también
+    a los totales de esa petición.
+    """
+    name = task.name.rsplit(".", 1)[-1]
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        metrics.observe(f"task:{name}", time.perf_counter() - started)
+    petition_key = task_petition_key(task, args, kwargs)
+    if petition_key and profiling.stop(task_id, petition_key, name):
+        store_profile(petition_key)
+    metrics.publish(petition_key)
+
+
+def store_job_metrics(petition_key):
+    """Guarda el resumen de tiempos de la petición junto a su resultado."""
+    metrics.publish(petition_key)
+    TempResult.objects.filter(petition_key=petition_key).update(metrics=metrics.job_summary(petition_key))
+
+
+def store_profile(petition_key):
+    """Une el perfil de la petición junto a su resultado, si ya se guardó."""
+    if not TempResult.objects.filter(petition_key=petition_key).exists():
+        return
+    try:
+        name, summary = profiling.combine(petition_key)
+    except Exception as e:
+        print("Error guardando perfil:", petition_key, str(e))
+        return
+    TempResult.objects.filter(petition_key=petition_key).update(profile=name or "", profile_summary=summary)
+
+
 @shared_task
 def clean_temp_results():
     ttl_limit = timezone.now() - timedelta(hours=2)
+    # Las páginas se borran primero con un solo DELETE en lugar de la cascada
+    ResultPage.objects.filter(result__created_at__lt=ttl_limit).delete()
     TempResult.objects.filter(created_at__lt=ttl_limit).delete()
 
+    # Archivos subidos que ningún worker llegó a leer y polígonos de
+    # peticiones que no terminaron (ver ``loaders.save_frame``). Las
+    # peticiones en cola o en curso conservan sus archivos aunque sean viejos
+    if large_storage.exists("uploads"):
+        for petition_key in large_storage.listdir("uploads")[0]:
+            if redis_manager_for_polygons.exists(f"TEMP:{petition_key}", f"TEMP:{petition_key}:progress"):
+                continue
+            names = large_storage.listdir(f"uploads/{petition_key}")[1]
+            for name in names:
+                path = f"uploads/{petition_key}/{name}"
+                if large_storage.get_modified_time(path) < ttl_limit:
+                    delete_upload(path)
+            if not names:
+                os.rmdir(large_storage.path(f"uploads/{petition_key}"))
+
+    # Perfiles de peticiones que no llegaron a guardar resultado
+    storage = profiling.profile_storage
+    if storage.exists(""):
+        for petition_key in storage.listdir("")[0]:
+            if not TempResult.objects.filter(petition_key=petition_key).exists():
+                parts = storage.listdir(petition_key)[1]
+                if all(storage.get_modified_time(f"{petition_key}/{name}") < ttl_limit for name in parts):
+                    profiling.delete_profile(petition_key)
+
+    # Subidas por partes abandonadas
+    if large_storage.exists("chunked"):
+        upload_limit = timezone.now() - timedelta(seconds=settings.CHUNKED_UPLOAD_TTL)
+        for name in large_storage.listdir("chunked")[1]:
+            if large_storage.get_modified_time(f"chunked/{name}") < upload_limit:
+                large_storage.delete(f"chunked/{name}")
+
+
+@shared_task
+def ingest_raster(file_id):
+    """Normaliza un raster recién registrado a COG y guarda su diseño en data_rules."""
+    try:
+        file_obj = File_Model.objects.select_related("dataset").get(pk=file_id)
+    except File_Model.DoesNotExist:
+        return
+
+    try:
+        layout = normalize_raster(file_obj)
+    except Exception as e:
+        print("Error normalizando raster:", file_obj.file.path, str(e))
+        return
+
+    rules = file_obj.data_rules if isinstance(file_obj.data_rules, dict) else {"rules": file_obj.data_rules}
+    stale = derived_paths(rules)
+    entries = {"cog": layout}
+    try:
+        entries["pixel_area"] = pixel_area(file_obj)
+    except Exception as e:
+        print("Error calculando áreas de píxel:", file_obj.file.path, str(e))
+    # update() no dispara post_save, así que no vuelve a encolar la ingesta
+    rules = update_rules(file_id, entries)
+    file_obj.data_rules = rules
+    store_footprint(file_obj)
+
+    # Pirámide de conteos para los rasters de deforestación
+    if file_obj.dataset.category == 0 and file_obj.dataset.subcategory == 0:
+        try:
+            pyramid = hansen_pyramid(file_obj)
+        except Exception as e:
+            print("Error generando pirámide:", file_obj.file.path, str(e))
+        else:
+            rules = update_rules(file_id, {"pyramid": pyramid})
+    elif file_obj.dataset.category == 0 and file_obj.dataset.subcategory == 1:
+        rebuild_history_pyramids()
+
+    # Derivados del archivo anterior si el raster se reemplazó
+    drop_derived(stale - derived_paths(rules))
+
+    # Si el dataset llega por teselas, la fecha del raster se vuelve a unir
+    rebuild_mosaics(file_obj.dataset_id)
+
+    # update() tampoco dispara las señales que invalidan el catálogo
+    bump_catalog_version()
+
+
+def derived_paths(rules):
+    """Rutas de los archivos derivados (COG, áreas, pirámide) registrados en ``data_rules``."""
+    return {
+        rules[derived]["path"]
+        for derived in ("cog", "pixel_area", "pyramid")
+        if isinstance(rules.get(derived), dict) and rules[derived].get("path")
+    }
+
+
+def drop_derived(paths):
+    for path in paths:
+        large_storage.delete(path)
+
+
+def update_rules(file_id, entries):
+    """
+    Cambia sólo las claves ``entries`` de ``data_rules`` sobre la fila recién
+    leída y bloqueada, sin pisar lo que otra tarea haya escrito mientras
+    tanto. Devuelve las reglas guardadas.
+    """
+    with transaction.atomic():
+        current = File_Model.objects.select_for_update().values_list("data_rules", flat=True).get(pk=file_id)
+        rules = current if isinstance(current, dict) else {"rules": current}
+        rules.update(entries)
+        File_Model.objects.filter(pk=file_id).update(data_rules=rules)
+    return rules
+
+
+@shared_task
+def rebuild_mosaics(dataset_id):
+    """
+    Regenera los mosaicos VRT por fecha de un dataset (ver ``mosaic.py``).
+    El bloqueo de la fila evita que dos ingestas del mismo dataset creen
+    mosaicos duplicados.
+    """
+    try:
+        with transaction.atomic():
+            dataset = DataSet.objects.select_for_update().get(pk=dataset_id)
+            rebuild_dataset_mosaics(dataset)
+    except DataSet.DoesNotExist:
+        return
+    except Exception as e:
+        print("Error generando mosaicos:", dataset_id, str(e))
+
+
+def store_footprint(file_obj):
+    try:
+        geometry, resolution = footprint(file_obj)
+    except Exception as e:
+        print("Error calculando huella:", file_obj.file.path, str(e))
+        return
+    File_Model.objects.filter(pk=file_obj.pk).update(footprint=geometry, resolution=resolution)
+
+
+@shared_task
+def index_raster_footprints():
+    """Calcula la huella de los rasters registrados antes de que existiera."""
+    for file_obj in File_Model.objects.filter(file_type=0, footprint__isnull=True):
+        store_footprint(file_obj)
+
+
+def history_files():
+    """Rasters del histórico de deforestación en el orden de la cadena."""
+    datasets = DataSet.objects.filter(category=0, subcategory=1)
+    return File_Model.objects.filter(dataset__in=datasets).order_by("date", "pk")
+
+
+@shared_task
+def rebuild_history_pyramids():
+    """
+    Regenera las pirámides del histórico cuyo raster anterior en la cadena
+    cambió (alta, baja o reemplazo de un raster). Como ``rebuild_mosaics``,
+    bloquea las filas de los datasets del histórico: dos ingestas a la vez
+    regeneran la cadena una después de la otra.
+    """
+    previous = None
+    changed = False
+    with transaction.atomic():
+        list(DataSet.objects.select_for_update().filter(category=0, subcategory=1).order_by("pk"))
+        for file_obj in history_files().select_related("dataset"):
+            expected = previous.content_key() if previous is not None else None
+            current = file_obj.get_pyramid()
+
+            if current is None or current.get("chain_previous") != expected:
+                try:
+                    pyramid = history_pyramid(file_obj, previous)
+                except Exception as e:
+                    print("Error generando pirámide:", file_obj.file.path, str(e))
+                else:
+                    stale = {current["path"]} if current and current.get("path") else set()
+                    update_rules(file_obj.pk, {"pyramid": pyramid})
+                    drop_derived(stale - {pyramid["path"]})
+                    changed = True
+
+            previous = file_obj
+
+    if changed:
+        bump_catalog_version()
+
 
 @shared_task
 def send_password_reset_email(email, url):
@@ -58,366 +317,396 @@ def send_password_reset_email(email, url):
 
 
 
-@shared_task(bind=True)
-def modelo_gdf(self, gdf_json, petition_key):
+def set_progress(petition_key, status, load, **extra):
+    value = json.dumps({
+        "petition_key": petition_key,
+        "status": status,
+        "load": load,
+        **extra
+    })
+    # Se guarda para las consultas y se publica para los clientes suscritos
+    pipe = redis_manager_for_polygons.pipeline()
+    pipe.set(name=f"TEMP:{petition_key}", value=value, ex=300)
+    pipe.publish(progress_channel(petition_key), value)
+    pipe.execute()
+
+
+def start_progress(petition_key, total_steps, total_polygons):
+    """Inicializa los contadores compartidos por los bloques de un trabajo."""
+    key = f"TEMP:{petition_key}:progress"
+    redis_manager_for_polygons.delete(key)
+    redis_manager_for_polygons.hset(key, mapping={
+        "steps": 0,
+        "total_steps": total_steps,
+        "polygons": 0,
+        "total_polygons": total_polygons,
+    })
+    redis_manager_for_polygons.expire(key, 3600)
+
+
+def advance_progress(petition_key, steps=1, polygons=0):
+    """
+    Suma avance desde cualquier bloque y publica un único ``load`` agregado en
+    ``TEMP:{petition_key}``, de modo que ``GetTempFileStatus`` no cambia.
+    """
+    key = f"TEMP:{petition_key}:progress"
+    pipe = redis_manager_for_polygons.pipeline()
+    pipe.hincrby(key, "steps", steps)
+    pipe.hincrby(key, "polygons", polygons)
+    pipe.hmget(key, "total_steps", "total_polygons")
+    # Mientras avance, la petición cuenta como en curso (ver ``clean_temp_results``)
+    pipe.expire(key, 3600)
+    done_steps, done_polygons, (total_steps, total_polygons) = pipe.execute()
+
+    total_steps = int(total_steps or 1)
+    set_progress(
+        petition_key,
+        f"procesando poligono {done_polygons}/{total_polygons}",
+        min(round(done_steps/total_steps*100, 2), 99.99)
+    )
 
-    gdf_dict = json.loads(gdf_json)
-    gdf = gpd.GeoDataFrame.from_features(gdf_dict["features"])
-    gdf.set_crs("EPSG:4326", inplace=True)
 
-    gdf = gdf.to_crs(3116)
-    gdf["area_ha"] = gdf.geometry.area/10000
-    gdf = gdf.to_crs(4326)
+def chunk_slices(total, chunk_size):
+    return [(start, min(start + chunk_size, total)) for start in range(0, total, chunk_size)]
+
+
+@shared_task(bind=True)
+def modelo_gdf(self, upload, petition_key, bbox=None):
+    """
+    ``upload`` es la ruta en ``large_storage`` del archivo subido; se lee y
+    valida aquí para que la petición web no tenga que hacerlo. Con ``bbox``
+    sólo se analizan las features que lo intersecan.
+    """
+    metrics.start_job(petition_key)
+    try:
+        with metrics.span("load_upload"):
+            gdf = load_upload(upload, bbox)
+    except Exception as e:
+        print("Error leyendo archivo:", upload, str(e))
+        metrics.count("jobs", 1, "error")
+        set_progress(petition_key, "error en el procesamiento", 100, error=f"Error leyendo archivo: {str(e)}")
+        return
+
+    with metrics.span("area"):
+        gdf = gdf.to_crs(3116)
+        gdf["area_ha"] = gdf.geometry.area/10000
+        gdf = gdf.to_crs(4326)
     total = len(gdf)
 
     # Caso sin datos
     if total == 0:
-        TempResult.objects.create(
-            petition_key=petition_key,
-            data=[]
-        )
-        redis_manager_for_polygons.set(
-            name=f"TEMP:{petition_key}",
-            value=json.dumps({
-                "petition_key": petition_key,
-                "status": "sin datos",
-                "load": 100
-            }),
-            ex=300
-        )
+        save_result(petition_key, [])
+        metrics.count("jobs", 1, "empty")
+        store_job_metrics(petition_key)
+        set_progress(petition_key, "sin datos", 100)
         return
-    gdf["deforestation_history"] = None
-    gdf["deforestation_hansen"] = None
-    gdf["index_crops"] = None
-    gdf["wheather"] = None
-    # Iterar poligonos
-    for i, row in gdf.iterrows():
-        polygon = row.geometry
-        defo_stats = analyze_deforestation_history(polygon)
-        gdf.at[i, "deforestation_history"] = defo_stats
-        defo_stats_1 = analyze_deforestation_by_raster_values(polygon)
-        gdf.at[i, "deforestation_hansen"] = defo_stats_1
-        index_crops = analyze_index_history(polygon)
-        gdf.at[i, "index_crops"] = index_crops
-        wheather = download_weather_today(polygon)
-        gdf.at[i, "wheather"] = wheather
-        
-        load = round((i + 1)/total*100, 2)
-        status = f"procesando poligono {i+1}/{total}"
-
-        redis_manager_for_polygons.set(
-            name=f"TEMP:{petition_key}",
-            value=json.dumps({
-                "petition_key": petition_key,
-                "status": status,
-                "load": load
-            }),
-            ex=300
-        )
 
-    gdf = add_descriptions_to_gdf(gdf)
+    # Se reparte el trabajo en bloques de polígonos entre los workers y un
+    # chord junta los resultados al terminar
+    slices = chunk_slices(total, settings.ANALYSIS_CHUNK_SIZE)
+    with metrics.span("catalog"):
+        total_rasters = count_sources(catalog_snapshot())
+    start_progress(petition_key, len(slices) * total_rasters + total, total)
+    set_progress(petition_key, f"procesando poligono 0/{total}", 0)
+
+    # Las tareas leen los polígonos del almacenamiento compartido; los
+    # mensajes sólo llevan la ruta y los límites de cada bloque
+    with metrics.span("save_frame"):
+        frame = save_frame(gdf, petition_key)
+    header = group(
+        [analyze_chunk.s(frame, start, stop, petition_key) for start, stop in slices]
+        # El clima de todos los polígonos se pide en paralelo al análisis raster
+        + [weather_for_polygons.s(frame, petition_key)]
+    )
+    body = merge_chunks.s(frame, petition_key).on_error(modelo_gdf_failed.s(petition_key))
+    chord(header)(body)
 
-    # Convertir resultado final
-    final_json = json.loads(gdf.to_json())
 
-    # Guardar resultado grande en PostgreSQL
-    TempResult.objects.create(
-        petition_key=petition_key,
-        json_data=final_json
+@shared_task
+def analyze_chunk(frame, start, stop, petition_key):
+    """
+    Analiza los polígonos ``start:stop`` de ``frame`` (ver
+    ``loaders.save_frame``); devuelve un dict por polígono. Los
+    resultados ya calculados para la misma geometría y versión de catálogo se
+    reutilizan, y sólo se analizan los polígonos (y análisis) que faltan. El
+    historial de deforestación se extiende desde el estado guardado de cada
+    polígono, leyendo sólo los rasters que se agregaron desde entonces.
+    """
+    geometries = list(load_frame(frame, start, stop, columns=["geometry"]).geometry)
+
+    with metrics.span("catalog"):
+        catalog = catalog_snapshot()
+        versions = catalog_versions(catalog)
+    fingerprints = [geometry_fingerprint(geometry) for geometry in geometries]
+    with metrics.span("cache_lookup"):
+        cached = cached_polygon_results(fingerprints, versions)
+
+    # Cada huella distinta se analiza una sola vez, y sólo si le falta algún análisis
+    missing = {
+        analyzer: {fp for fp in fingerprints if (fp, analyzer) not in cached}
+        for analyzer in ANALYZERS
+    }
+    pending = {}
+    for geometry, fp in zip(geometries, fingerprints):
+        if any(fp in missing[analyzer] for analyzer in ANALYZERS):
+            pending.setdefault(fp, geometry)
+    metrics.count("cache_hits", len(cached), "polygon_result")
+    metrics.count("cache_misses", sum(len(fps) for fps in missing.values()), "polygon_result")
+
+    # Los análisis completos en caché no abren sus rasters
+    reduced = without_entries(catalog, [a for a in ANALYZERS if not missing[a]])
+    computed = {}
+    if pending:
+        # Ni los que no tocan ningún polígono del bloque
+        with metrics.span("footprints"):
+            reduced["outside"] = rasters_outside(reduced, pending.values())
+        if missing["deforestation_history"]:
+            with metrics.span("cache_lookup"):
+                states = cached_history_states(pending)
+            metrics.count("cache_hits", len(states), "history_state")
+            metrics.count("cache_misses", len(pending) - len(states), "history_state")
+        else:
+            states = {}
+        with metrics.span("raster_analysis"):
+            raster_stats = run_raster_analysis_pool(
+                reduced,
+                list(pending.values()),
+                # Un perfil sólo ve el proceso del worker
+                settings.ANALYSIS_POOL_SIZE if not profiling.active() else 1,
+                progress=lambda steps: advance_progress(petition_key, steps=steps),
+                history_states=[states.get(fp) for fp in pending],
+            )
+        for analyzer in ANALYZERS:
+            if missing[analyzer]:
+                computed.update({
+                    (fp, analyzer): result
+                    for fp, result in zip(pending, raster_stats[analyzer])
+                })
+        with metrics.span("cache_store"):
+            store_polygon_results(computed, versions)
+            store_history_states(dict(zip(pending, raster_stats[HISTORY_STATE])))
+
+    skipped_steps = count_sources(catalog) - (count_sources(reduced) if pending else 0)
+    if skipped_steps:
+        advance_progress(petition_key, steps=skipped_steps)
+
+    results = {**cached, **computed}
+    return [
+        {analyzer: results[(fp, analyzer)] for analyzer in ANALYZERS}
+        for fp in fingerprints
+    ]
+
+
+def cached_polygon_results(fingerprints, versions):
+    """Resultados guardados ``{(huella, análisis): resultado}`` vigentes para ``versions``."""
+    found = {}
+    used = []
+    rows = PolygonResult.objects.filter(
+        fingerprint__in={fp for fp in fingerprints if fp is not None}
+    ).values_list("pk", "fingerprint", "analyzer", "catalog_version", "result")
+
+    for pk, fp, analyzer, version, result in rows:
+        if versions.get(analyzer) == version:
+            found[(fp, analyzer)] = result
+            used.append(pk)
+
+    if used:
+        PolygonResult.objects.filter(pk__in=used).update(last_used=timezone.now())
+    return found
+
+
+def store_polygon_results(results, versions):
+    now = timezone.now()
+    PolygonResult.objects.bulk_create(
+        [
+            PolygonResult(
+                fingerprint=fp,
+                analyzer=analyzer,
+                catalog_version=versions[analyzer],
+                result=result,
+                last_used=now,
+            )
+            for (fp, analyzer), result in results.items()
+            if fp is not None
+        ],
+        update_conflicts=True,
+        unique_fields=["fingerprint", "analyzer"],
+        update_fields=["catalog_version", "result", "last_used"],
     )
 
-    # Último estado
-    redis_manager_for_polygons.set(
-        name=f"TEMP:{petition_key}",
-        value=json.dumps({
-            "petition_key": petition_key,
-            "status": "Proceso Completado",
-            "load": 100
-        }),
-        ex=300
-    )
 
+def cached_history_states(fingerprints):
+    """Estados del historial guardados ``{huella: estado}``, con la máscara en ``"mask"``."""
+    found = {}
+    rows = HistoryState.objects.filter(
+        fingerprint__in={fp for fp in fingerprints if fp is not None}
+    ).values_list("fingerprint", "state", "mask")
 
+    for fp, state, mask in rows:
+        found[fp] = {**state, "mask": bytes(mask)}
 
+    if found:
+        HistoryState.objects.filter(fingerprint__in=found).update(last_used=timezone.now())
+    return found
+
+
+def store_history_states(states):
+    now = timezone.now()
+    HistoryState.objects.bulk_create(
+        [
+            HistoryState(
+                fingerprint=fp,
+                state={key: value for key, value in state.items() if key != "mask"},
+                mask=state["mask"],
+                last_used=now,
+            )
+            for fp, state in states.items()
+            if fp is not None and state is not None
+        ],
+        update_conflicts=True,
+        unique_fields=["fingerprint"],
+        update_fields=["state", "mask", "last_used"],
+    )
 
-def analyze_deforestation_history(polygon):
-    # -----------------------------
-    # 1. Cargar dataset histórico
-    # -----------------------------
-    datasets = DataSet.objects.filter(category=0, subcategory=1)
-    historic_files = File_Model.objects.filter(dataset__in=datasets).order_by("date")
 
-    if not historic_files.exists():
-        return {"history": [], "total_def_area_ha": 0}
+@shared_task
+def evict_polygon_results():
+    """
+    Conserva sólo los ``POLYGON_CACHE_MAX_ENTRIES`` resultados (y estados del
+    historial) usados más recientemente.
+    """
+    for model in (PolygonResult, HistoryState):
+        cutoff = (
+            model.objects.order_by("-last_used")
+            .values_list("last_used", flat=True)[settings.POLYGON_CACHE_MAX_ENTRIES:settings.POLYGON_CACHE_MAX_ENTRIES + 1]
+        )
+        if cutoff:
+            model.objects.filter(last_used__lte=cutoff[0]).delete()
 
-    results = []
-    previous_mask = None
-    total_area_ha = 0
-    polygon_geojson = [mapping(polygon)]
 
-    for file_obj in historic_files:
-        year = file_obj.date.year
+@shared_task
+def weather_for_polygons(frame, petition_key):
+    """Clima de hoy para todos los polígonos, en lotes concurrentes."""
+    geometries = list(load_frame(frame, columns=["geometry"]).geometry)
+    with metrics.span("weather"):
+        return fetch_weather(
+            geometries,
+            on_batch=lambda n: advance_progress(petition_key, steps=n, polygons=n),
+        )
 
-        try:
-            with rasterio.open(file_obj.file.path) as src:
-                out_image, out_transform = mask(src, polygon_geojson, crop=True)
-                raster = out_image[0].astype("float32")
-                raster[raster == src.nodata] = np.nan
-
-                current_mask = (raster == 0.5)
-
-                if previous_mask is None:
-                    previous_mask = current_mask
-                    continue
-
-                new_def_pixels = np.logical_and(current_mask, np.logical_not(previous_mask))
-                count_pixels = np.sum(new_def_pixels)
-
-                # -----------------------------
-                # Aproximación rápida del área
-                # -----------------------------
-                if count_pixels > 0:
-                    nrows, ncols = raster.shape
-                    xs, ys = rasterio.transform.xy(out_transform, 0, 0)
-                    lat_center = np.mean([ys, ys + out_transform.e * nrows])
-
-                    # Tamaño del píxel en grados
-                    dx = abs(out_transform.a)
-                    dy = abs(out_transform.e)
-
-                    pixel_area_m2 = 10 * 10  # píxel 10x10 m
-                    area_ha = count_pixels * pixel_area_m2 / 10000
-                else:
-                    area_ha = 0
 
-                results.append({
-                    "year": year,
-                    "new_def_area_ha": float(area_ha),
-                    "pixels_detected": int(count_pixels)
-                })
+@shared_task
+def merge_chunks(chunk_results, frame, petition_key):
+    """Une los bloques en el GeoDataFrame final, genera descripciones y guarda el resultado."""
+    with metrics.span("merge"):
+        gdf = load_frame(frame)
+        *chunk_results, weather = chunk_results
+        rows = [row for chunk in chunk_results for row in chunk]
+
+        for column in ("deforestation_history", "deforestation_hansen", "index_crops"):
+            gdf[column] = [row[column] for row in rows]
+        gdf["wheather"] = weather
+
+    # Con descripciones diferidas el resultado analítico se publica primero
+    deferred = settings.DESCRIPTIONS_DEFERRED
+    if deferred:
+        gdf["description"] = None
+    else:
+        set_progress(petition_key, "generando descripciones", 99.99)
+        with metrics.span("descriptions"):
+            gdf = add_descriptions_to_gdf(gdf)
+
+    # Guardar resultado en PostgreSQL, una fila por feature
+    with metrics.span("save_result"):
+        save_result(petition_key, json.loads(gdf.to_json())["features"])
+    delete_upload(frame)
+
+    elapsed = metrics.job_elapsed(petition_key)
+    if elapsed is not None:
+        metrics.observe("job", elapsed)
+    metrics.count("jobs", 1, "completed")
+    store_job_metrics(petition_key)
 
-                total_area_ha += area_ha
-                previous_mask = current_mask
+    # Último estado
+    redis_manager_for_polygons.delete(f"TEMP:{petition_key}:progress")
+    if deferred:
+        set_progress(petition_key, "Proceso Completado", 100, descriptions="pendiente")
+        describe_result.delay(petition_key)
+    else:
+        set_progress(petition_key, "Proceso Completado", 100)
+
+
+def save_result(petition_key, features):
+    page_size = settings.RESULT_PAGE_SIZE
+    with transaction.atomic():
+        temp = TempResult.objects.create(
+            petition_key=petition_key,
+            json_data={"type": "FeatureCollection", "count": len(features)}
+        )
+        pages = []
+        for start in range(0, len(features), page_size):
+            page = ResultPage(result=temp, start=start)
+            page.set_features(features[start:start + page_size])
+            pages.append(page)
+        ResultPage.objects.bulk_create(pages, batch_size=50)
+    return temp
 
-        except Exception as e:
-            print("Error procesando raster:", file_obj.file.path, str(e))
-            continue
 
-    return {"history": results, "total_def_area_ha": float(total_area_ha)}
+@shared_task
+def describe_result(petition_key):
+    """Segunda fase: completa las descripciones de un resultado ya guardado."""
+    try:
+        temp = TempResult.objects.get(petition_key=petition_key)
+    except TempResult.DoesNotExist:
+        return
 
+    for page in temp.pages.order_by("start"):
+        features = page.features()
+        inputs = [prompt_inputs(feature["properties"], page.start + i) for i, feature in enumerate(features)]
+        with metrics.span("descriptions"):
+            described = describe_all(inputs)
+        for feature, description in zip(features, described):
+            feature["properties"]["description"] = description
+        with metrics.span("save_result"):
+            page.set_features(features)
+            page.save(update_fields=["payload", "crc", "size", "count"])
 
-def analyze_deforestation_by_raster_values(polygon):
-    datasets = DataSet.objects.filter(category=0, subcategory=0)
-    historic_files = File_Model.objects.filter(dataset__in=datasets).order_by("date")
-    
-    if not historic_files.exists():
-        return {"history": [], "total_def_area_ha": 0}
+    store_job_metrics(petition_key)
+    set_progress(petition_key, "Proceso Completado", 100, descriptions="completadas")
 
-    results = []
-    total_area_ha = 0
-    polygon_geojson = [mapping(polygon)]
 
-    for file_obj in historic_files:
-        try:
-            with rasterio.open(file_obj.file.path) as src:
-                # Recorte del raster al polígono
-                out_image, out_transform = mask(src, polygon_geojson, crop=True)
-                raster = out_image[0].astype("float32")
-                raster[raster == src.nodata] = np.nan
-                years = range(1, 25)
-                for val in years:
-                    # Año real
-                    year = 2000 + val
-
-                    # Píxeles que ocurrieron en ese año
-                    mask_year = (raster == val)
-                    count_pixels = np.sum(mask_year)
-
-                    if count_pixels > 0:
-                        # Aproximación rápida del área
-                        pixel_area_m2 = 10 * 10  # píxel 10x10 m
-                        area_ha = count_pixels * pixel_area_m2 / 10000
-                    else:
-                        area_ha = 0
-
-                    if area_ha > 0:
-                        results.append({
-                            "year": year,
-                            "new_def_area_ha": float(area_ha),
-                            "pixels_detected": int(count_pixels)
-                        })
-                        total_area_ha += area_ha
+@shared_task
+def modelo_gdf_failed(request, exc, traceback, petition_key):
+    print("Error en el análisis:", petition_key, str(exc))
+    metrics.count("jobs", 1, "error")
+    redis_manager_for_polygons.delete(f"TEMP:{petition_key}:progress")
+    delete_upload(frame_name(petition_key))
+    set_progress(petition_key, "error en el procesamiento", 100)
 
-        except Exception as e:
-            print("Error procesando raster:", file_obj.file.path, str(e))
-            continue
 
-    return {"history": results, "total_def_area_ha": float(total_area_ha)}
+def analyze_deforestation_history(polygon):
+    return deforestation_history_stats(catalog_snapshot()["history"], [polygon])[0]
 
-def analyze_index_history(polygon):
-    datasets = DataSet.objects.filter(category=1)
-    historic_files = File_Model.objects.filter(dataset__in=datasets).order_by("date")
-    subcategory_dict = DataSet.SUBCATEGORY_DATASET[1]
-    if not historic_files.exists():
-        return {"indices": [], "total_mean_value": 0}
-
-    results = []
-    total_mean_value = 0
-    polygon_geojson = [mapping(polygon)]
-
-    # Iteramos por subcategorías disponibles en los datasets
-    subcategories = datasets.values_list("subcategory", flat=True).distinct()
-
-    for subcat in subcategories:
-        # Filtrar archivos por subcategoría
-        files_subcat = historic_files.filter(dataset__subcategory=subcat)
-        subcat_values = []
-
-        for file_obj in files_subcat:
-            try:
-                with rasterio.open(file_obj.file.path) as src:
-                    # Recorte del raster al polígono
-                    out_image, _ = mask(src, polygon_geojson, crop=True)
-                    raster = out_image[0].astype("float32")
-                    raster[raster == src.nodata] = np.nan
-
-                    # Aplicar trim: descartar valores menores que 0.5
-                    raster_trimmed = np.where(raster >= 0.5, raster, np.nan)
-
-                    # Calcular valor promedio del raster recortado
-                    mean_value = np.nanmean(raster_trimmed)
-                    if not np.isnan(mean_value):
-                        subcat_values.append(mean_value)
-
-            except Exception as e:
-                print("Error procesando raster:", file_obj.file.path, str(e))
-                continue
 
-        # Promedio final de la subcategoría
-        if subcat_values:
-            mean_subcat = float(np.mean(subcat_values))
-            results.append({
-                "subcategory": subcategory_dict[int(subcat)],
-                "mean_value": mean_subcat
-            })
+def analyze_deforestation_by_raster_values(polygon):
+    return deforestation_hansen_stats(catalog_snapshot()["hansen"], [polygon])[0]
 
-    return {
-        "indices": results,
-    }
 
+def analyze_index_history(polygon):
+    return index_stats(catalog_snapshot()["index"], [polygon])[0]
 
 
-def download_weather_today(polygon, timezone="America/Bogota"):
-    # ---------------------
-    # Validación del polígono
-    # ---------------------
-    if not polygon.is_valid or polygon.is_empty:
-        print("Polígono inválido o vacío")
-        return {}
-
-    centroid = polygon.centroid
-    lat, lon = centroid.y, centroid.x
-
-    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
-        print("Coordenadas fuera de rango")
-        return {}
-
-    # ---------------------
-    # Fechas: solo hoy
-    # ---------------------
-    today = datetime.utcnow().date()
-    start_date = today.isoformat()
-    end_date = today.isoformat()
-
-    url = "https://api.open-meteo.com/v1/forecast"
-    params = {
-        "latitude": lat,
-        "longitude": lon,
-        "start_date": start_date,
-        "end_date": end_date,
-        "daily": (
-            "temperature_2m_max,"
-            "temperature_2m_min,"
-            "precipitation_sum,"
-            "shortwave_radiation_sum,"
-            "relative_humidity_2m_mean,"
-            "wind_speed_10m_mean"
-        ),
-        "timezone": timezone
-    }
 
-    # ---------------------
-    # Llamada segura
-    # ---------------------
-    try:
-        response = requests.get(url, params=params, timeout=10)
-        time.sleep(1)
-        response.raise_for_status()
-        data = response.json().get("daily", {})
-
-        if not data:
-            print("No hay datos para hoy")
-            return {}
-
-        return data
-
-    except requests.exceptions.Timeout:
-        print("Timeout al conectar con Open-Meteo")
-        return {}
-    except requests.exceptions.RequestException as e:
-        print("Error al solicitar datos de Open-Meteo:", e)
-        return {}
-    except Exception as e:
-        print("Error inesperado:", e)
-        return {}
+def download_weather_today(polygon, timezone="America/Bogota"):
+    return fetch_weather([polygon], timezone)[0]
 
 
 
 def add_descriptions_to_gdf(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     """
-    Añade una columna 'description' al GeoDataFrame usando GPT-3.0
-    para generar un resumen humanizado de cada feature.
+    Añade una columna 'description' al GeoDataFrame con un resumen humanizado
+    de cada feature (ver ``descriptions.py``).
     """
-    descriptions = []
-
-    for i, row in gdf.iterrows():
-        # Información base para el prompt
-        fid = row.get("id", i)
-        area = row.get("area_ha", 0)
-        hansen = row.get("deforestation_hansen", {})
-        hansen_total = hansen.get("total_def_area_ha", 0)
-        history = row.get("deforestation_history", {})
-        history_total = history.get("total_def_area_ha", 0)
-        indices = row.get("index_crops", {}).get("indices", [])
-        weather = row.get("wheather", {})
-
-        # Construir prompt para GPT
-        prompt = f"""
-        Genera una descripción concisa y clara para un polígono agrícola con la siguiente información:
-
-        - ID: {fid}
-        - Área: {area:.2f} ha
-        - Deforestación Hansen histórica: {hansen_total:.2f} ha
-        - Deforestación reciente: {history_total:.2f} ha
-        - Índices de cultivos: {', '.join([f"{idx['subcategory']}: {idx['mean_value']:.2f}" for idx in indices]) if indices else 'sin información'}
-        - Clima: {weather if weather else 'sin información'}
-
-        La descripción debe ser en lenguaje natural y fácil de entender.
-        """
-
-        try:
-            response = openai.Completion.create(
-                model="text-davinci-003",
-                prompt=prompt,
-                max_tokens=150,
-                temperature=0.7,
-            )
-            description = response.choices[0].text.strip()
-        except Exception as e:
-            print(f"Error generando descripción GPT: {e}")
-            description = "Descripción no disponible"
-
-        descriptions.append(description)
-
-    gdf["description"] = descriptions
+    inputs = [prompt_inputs(row, i) for i, row in gdf.iterrows()]
+    gdf["description"] = describe_all(inputs)
     return gdf
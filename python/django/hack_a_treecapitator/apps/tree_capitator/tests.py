@@ -1,3 +1,851 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+import zipfile
+from datetime import date
+from unittest import mock
 
-# Create your tests here.
+import billiard
+import fakeredis
+import geopandas as gpd
+import numpy as np
+import rasterio
+import redis
+from pyproj import Geod
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase, override_settings
+from rasterio.mask import mask
+from rasterio.transform import from_origin
+from rasterio.warp import transform_bounds
+from shapely.geometry import box, mapping
+
+from . import chunked, descriptions, engine, events, metrics, profiling, rasterpool, tasks, weather
+from .benchmark import synthetic_catalog, synthetic_parcels
+from .chunked import UploadError, complete_upload, create_upload, get_upload, write_part
+from .fake_open_meteo import fake_daily, running_fake_open_meteo
+from .fingerprint import ANALYZERS, catalog_versions
+from .catalog import rasters_outside
+from .ingest import cog_name, footprint, pixel_area_name, pyramid_name
+from .loaders import delete_upload, load_frame, loader_dataframe_from_file, save_frame
+from .models import File_Model, TempResult
+from .mosaic import Tile, mosaic_signature
+from .pixelarea import row_areas, row_areas_for
+from .pyramid import TilePyramid
+from .resultstore import accepts_gzip, encode_page, geojson_fragments, gzip_stream, ndjson_stream, text_stream
+
+
+class DerivedNamesTests(SimpleTestCase):
+    def test_same_stem_does_not_collide(self):
+        rasters = [
+            File_Model(pk=1, file="datasets/a/x.tif"),
+            File_Model(pk=2, file="datasets/a/x.tiff"),
+            File_Model(pk=3, file="datasets/b/x.tif"),
+        ]
+        for name in (cog_name, pixel_area_name, pyramid_name):
+            names = [name(raster) for raster in rasters]
+            self.assertEqual(len(set(names)), len(names), names)
+
+    def test_name_is_stable(self):
+        raster = File_Model(pk=1, file="datasets/a/x.tif")
+        self.assertEqual(cog_name(raster), cog_name(File_Model(pk=1, file="datasets/a/x.tif")))
+        self.assertTrue(cog_name(raster).startswith("datasets/cog/x-"))
+
+
+def _masked(source, polygon):
+    """Valores del raster dentro del polígono y área (m²) de su fila, como ``rasterio.mask``."""
+    with rasterio.open(source.path) as src:
+        out, _ = mask(src, [mapping(polygon)], filled=False)
+        inside = ~np.ma.getmaskarray(out[0])
+        rows = np.nonzero(inside)[0]
+        return out[0].data[inside].astype("float32"), row_areas_for(source, src)[rows]
+
+
+def baseline_analysis(catalog, polygon):
+    """Análisis de un polígono por la ruta original, un ``mask()`` por raster."""
+    hansen, total = [], 0
+    for source in catalog["hansen"]:
+        values, areas = _masked(source, polygon)
+        for val in range(1, 25):
+            selected = values == val
+            if selected.any():
+                area_ha = areas[selected].sum() / 10000
+                hansen.append({"year": 2000 + val, "new_def_area_ha": area_ha, "pixels_detected": int(selected.sum())})
+                total += area_ha
+    hansen_total = total
+
+    history, total, previous = [], 0, None
+    for source in catalog["history"]:
+        values, areas = _masked(source, polygon)
+        current = values == 0.5
+        if previous is not None:
+            new = current & ~previous
+            area_ha = areas[new].sum() / 10000
+            history.append({"year": source.date.year, "new_def_area_ha": area_ha, "pixels_detected": int(new.sum())})
+            total += area_ha
+        previous = current
+
+    indices = []
+    for label, sources in catalog["index"]:
+        means = []
+        for source in sources:
+            values, _ = _masked(source, polygon)
+            trimmed = values[values >= 0.5]
+            if trimmed.size:
+                means.append(trimmed.mean())
+        if means:
+            indices.append({"subcategory": label, "mean_value": np.mean(means)})
+
+    return {
+        "deforestation_hansen": {"history": hansen, "total_def_area_ha": hansen_total},
+        "deforestation_history": {"history": history, "total_def_area_ha": total},
+        "index_crops": {"indices": indices},
+    }
+
+
+class EngineBaselineTests(SimpleTestCase):
+    def assertMatchesBaseline(self, pyramids):
+        with tempfile.TemporaryDirectory() as directory:
+            catalog = synthetic_catalog(directory, size=400, years=3, indices=2, pyramids=pyramids, tile_size=32)
+            geometries = list(synthetic_parcels(15, size="medium", raster_size=400).geometry)
+            results = engine.run_raster_analysis(catalog, geometries)
+            for i, polygon in enumerate(geometries):
+                expected = baseline_analysis(catalog, polygon)
+                for analyzer in ("deforestation_hansen", "deforestation_history", "index_crops"):
+                    with self.subTest(polygon=i, analyzer=analyzer):
+                        self.assertNear(results[analyzer][i], expected[analyzer])
+
+    def assertNear(self, actual, expected):
+        if isinstance(expected, dict):
+            self.assertEqual(sorted(actual), sorted(expected))
+            for key in expected:
+                self.assertNear(actual[key], expected[key])
+        elif isinstance(expected, list):
+            self.assertEqual(len(actual), len(expected))
+            for a, b in zip(actual, expected):
+                self.assertNear(a, b)
+        elif isinstance(expected, (float, np.floating)):
+            self.assertAlmostEqual(actual, float(expected), places=5)
+        else:
+            self.assertEqual(actual, expected)
+
+    def test_matches_per_polygon_mask(self):
+        self.assertMatchesBaseline(pyramids=False)
+
+    def test_pyramids_match_per_polygon_mask(self):
+        self.assertMatchesBaseline(pyramids=True)
+
+
+def _pool_in_daemon(catalog, geometries, queue):
+    queue.put(json.dumps(engine.run_raster_analysis_pool(catalog, geometries, pool_size=2), sort_keys=True, default=repr))
+    engine._discard_executor()
+
+
+def _stored(states, previous):
+    """Estados como los devuelve ``cached_history_states`` tras guardarlos."""
+    stored = []
+    for state, old in zip(states, previous):
+        state = state if state is not None else old
+        if state is not None:
+            state = {**json.loads(json.dumps({k: v for k, v in state.items() if k != "mask"})), "mask": bytes(state["mask"])}
+        stored.append(state)
+    return stored
+
+
+class HistoryResumeTests(SimpleTestCase):
+    assertNear = EngineBaselineTests.assertNear
+
+    def assertResumeMatchesColdRun(self, pyramids):
+        with tempfile.TemporaryDirectory() as directory:
+            catalog = synthetic_catalog(directory, size=400, years=5, indices=0, pyramids=pyramids, tile_size=32)
+            geometries = list(synthetic_parcels(12, size="medium", raster_size=400).geometry)
+            history = catalog["history"]
+
+            states = [None] * len(geometries)
+            for end in (2, 4, 5):
+                # Los polígonos pares vienen de la corrida anterior; los impares son nuevos en 4
+                if end == 4:
+                    states = [state if i % 2 == 0 else None for i, state in enumerate(states)]
+                metrics.collect()
+                resumed, new_states = engine.deforestation_history_states(history[:end], geometries, states)
+                reads = sum(value for name, _, value in metrics.collect()["counters"] if name == "raster_reads")
+                cold, _ = engine.deforestation_history_states(history[:end], geometries)
+                with self.subTest(pyramids=pyramids, rasters=end):
+                    self.assertNear(resumed, cold)
+                    if end == 5:
+                        # Todos traen estado hasta el raster 4: sólo se lee el último
+                        self.assertEqual(reads, 1)
+                states = _stored(new_states, states)
+            self.assertTrue(all(state["chain"] == [source.key for source in history] for state in states))
+
+    def test_resume_matches_cold_run(self):
+        self.assertResumeMatchesColdRun(pyramids=False)
+
+    def test_resume_with_pyramids_matches_cold_run(self):
+        self.assertResumeMatchesColdRun(pyramids=True)
+
+
+class PolygonResultCacheTests(SimpleTestCase):
+    def catalog(self, history_years):
+        def source(key, year):
+            return engine.RasterSource(f"/rasters/{key}.tif", date(year, 1, 1), 1, key)
+        return {
+            "history": [source(f"{year}:classificado_{year}.tif", year) for year in history_years],
+            "hansen": [source("1:hansen.tif", 2020)],
+            "index": [("NDVI", [source("9:ndvi_2021.tif", 2021)])],
+        }
+
+    def test_new_raster_misses_cached_results(self):
+        before = catalog_versions(self.catalog([2020, 2021]))
+        after = catalog_versions(self.catalog([2020, 2021, 2022]))
+        self.assertNotEqual(before["deforestation_history"], after["deforestation_history"])
+        self.assertEqual(before["deforestation_hansen"], after["deforestation_hansen"])
+        self.assertEqual(before["index_crops"], after["index_crops"])
+
+        # Filas guardadas con el catálogo anterior
+        rows = [(pk, "abc", analyzer, before[analyzer], {}) for pk, analyzer in enumerate(ANALYZERS)]
+        with mock.patch.object(tasks.PolygonResult, "objects") as objects:
+            objects.filter.return_value.values_list.return_value = rows
+            self.assertEqual(set(tasks.cached_polygon_results(["abc"], before)), {("abc", a) for a in ANALYZERS})
+            self.assertEqual(
+                set(tasks.cached_polygon_results(["abc"], after)),
+                {("abc", "deforestation_hansen"), ("abc", "index_crops")},
+            )
+
+
+class FootprintTests(SimpleTestCase):
+    def write(self, path, crs, transform, size=40):
+        with rasterio.open(
+            path, "w", driver="GTiff", width=size, height=size, count=1, dtype="uint8",
+            nodata=255, crs=crs, transform=transform,
+        ) as dst:
+            dst.write(np.zeros((1, size, size), dtype="uint8"))
+
+    def test_projected_footprint_in_4326(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "utm.tif")
+            self.write(path, "EPSG:32618", from_origin(500000, 500000, 30, 30))
+            file_obj = File_Model(pk=1, file="datasets/utm.tif", data_rules={})
+            with mock.patch.object(File_Model, "raster_path", return_value=path):
+                geometry, resolution = footprint(file_obj)
+
+        self.assertEqual(geometry.srid, 4326)
+        expected = transform_bounds("EPSG:32618", "EPSG:4326", 500000, 498800, 501200, 500000, densify_pts=64)
+        for actual, bound in zip(geometry.extent, expected):
+            self.assertAlmostEqual(actual, bound, places=6)
+        self.assertAlmostEqual(resolution, 30, delta=0.1)
+
+    def test_rasters_outside_skip_unrelated_files(self):
+        def source(key):
+            return engine.RasterSource(f"/rasters/{key}.tif", date(2020, 1, 1), 0, key)
+
+        catalog = {
+            "files": {(0, 0): [source("1:a.tif"), source("2:b.tif"), source("mosaic:7:abc")]},
+            "tiles": {"mosaic:7:abc": ["3:t1.tif", "4:t2.tif"]},
+        }
+        with mock.patch.object(File_Model.objects, "filter") as query:
+            # Sólo tocan la caja del polígono el raster 1 y una tesela del mosaico
+            query.return_value.filter.return_value.values_list.return_value = [(1, "a.tif"), (4, "t2.tif")]
+            self.assertEqual(rasters_outside(catalog, [box(-74, 4, -73.9, 4.1)]), {"2:b.tif"})
+            self.assertEqual(rasters_outside(catalog, []), frozenset())
+
+    def test_outside_rasters_are_not_opened(self):
+        with tempfile.TemporaryDirectory() as directory:
+            catalog = synthetic_catalog(directory, size=200, years=2, indices=1)
+            far = os.path.join(directory, "far.tif")
+            self.write(far, "EPSG:4326", from_origin(10, 50, 0.0001, 0.0001))
+            far_source = engine.RasterSource(far, catalog["hansen"][0].date, 0, "99:far.tif")
+            catalog["hansen"] = catalog["hansen"] + [far_source]
+            geometries = list(synthetic_parcels(5, size="medium", raster_size=200).geometry)
+
+            expected = engine.run_raster_analysis(catalog, geometries)
+            with mock.patch.object(engine.rasterpool, "open_raster", wraps=rasterpool.open_raster) as opened:
+                results = engine.run_raster_analysis({**catalog, "outside": {far_source.key}}, geometries)
+            rasterpool.clear()
+
+        self.assertNotIn(far, [call.args[0] for call in opened.call_args_list])
+        self.assertEqual(results["deforestation_hansen"], expected["deforestation_hansen"])
+
+
+class PyramidSaveTests(SimpleTestCase):
+    def test_concurrent_saves_use_their_own_temporary_file(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "pyramid", "x.npz")
+            pyramids = [
+                TilePyramid([np.full((2, 2, 3), i, dtype="int64")], 32, rasterio.Affine.identity(), 64, 64)
+                for i in range(8)
+            ]
+            with ThreadPoolExecutor(8) as executor:
+                list(executor.map(lambda pyramid: pyramid.save(path), pyramids))
+            self.assertEqual(os.listdir(os.path.dirname(path)), ["x.npz"])
+            saved = TilePyramid.load(path).levels[0]
+            self.assertTrue(any(np.array_equal(saved, pyramid.levels[0]) for pyramid in pyramids))
+
+
+class AnalysisPoolTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.catalog = synthetic_catalog(cls.directory.name, size=400, years=3, indices=1)
+        cls.geometries = list(synthetic_parcels(12, raster_size=400).geometry)
+        cls.serial = engine.run_raster_analysis_pool(cls.catalog, cls.geometries, pool_size=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        engine._discard_executor()
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def assertSameResults(self, results):
+        # NaN != NaN: se compara la serialización
+        self.assertEqual(
+            json.dumps(results, sort_keys=True, default=repr),
+            json.dumps(self.serial, sort_keys=True, default=repr),
+        )
+
+    def test_pool_matches_serial(self):
+        steps = []
+        results = engine.run_raster_analysis_pool(self.catalog, self.geometries, pool_size=2, progress=steps.append)
+        self.assertSameResults(results)
+        self.assertEqual(sum(steps), engine.count_sources(self.catalog))
+
+    def test_pool_in_daemonic_process(self):
+        # Como los procesos del worker prefork de Celery
+        queue = billiard.Queue()
+        child = billiard.Process(target=_pool_in_daemon, args=(self.catalog, self.geometries, queue), daemon=True)
+        child.start()
+        results = queue.get(timeout=120)
+        child.join()
+        self.assertEqual(results, json.dumps(self.serial, sort_keys=True, default=repr))
+
+    def test_chunks_finishing_out_of_order(self):
+        # El primer bloque termina último: los demás se recogen antes
+        class ReversedPool:
+            submitted = []
+
+            def apply_async(self, func, args, callback, error_callback):
+                self.submitted.append((func, args, callback))
+                if len(self.submitted) == 4:
+                    for func, args, callback in reversed(self.submitted):
+                        callback(func(*args))
+
+        steps = []
+        with mock.patch.object(engine, "_get_executor", return_value=ReversedPool()):
+            results = engine.run_raster_analysis_pool(
+                self.catalog, self.geometries, pool_size=2, progress=steps.append
+            )
+        self.assertSameResults(results)
+        self.assertEqual(len(steps), 4)
+        self.assertEqual(sum(steps), engine.count_sources(self.catalog))
+
+    def test_failed_chunk_falls_back_to_serial(self):
+        class FailingPool:
+            def apply_async(self, func, args, callback, error_callback):
+                error_callback("WorkerLostError")
+
+            def terminate(self):
+                pass
+
+        with mock.patch.object(engine, "_get_executor", return_value=FailingPool()):
+            self.assertSameResults(engine.run_raster_analysis_pool(self.catalog, self.geometries, pool_size=2))
+
+    def test_falls_back_to_serial(self):
+        steps = []
+        with mock.patch.object(engine, "_get_executor", side_effect=AssertionError("daemonic processes")):
+            results = engine.run_raster_analysis_pool(self.catalog, self.geometries, pool_size=2, progress=steps.append)
+        self.assertSameResults(results)
+        self.assertEqual(sum(steps), engine.count_sources(self.catalog))
+
+
+class RasterPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.addCleanup(rasterpool.configure, rasterpool.max_open())
+        self.addCleanup(rasterpool.clear)
+
+    def write(self, name, value):
+        path = os.path.join(self.directory.name, name)
+        with rasterio.open(
+            path, "w", driver="GTiff", width=4, height=4, count=1, dtype="uint8",
+            crs="EPSG:4326", transform=from_origin(-74, 4, 0.1, 0.1),
+        ) as dst:
+            dst.write(np.full((1, 4, 4), value, dtype="uint8"))
+        return path
+
+    def test_reuses_open_datasets(self):
+        path = self.write("a.tif", 1)
+        src = rasterpool.open_raster(path)
+        self.assertIs(rasterpool.open_raster(path), src)
+        self.assertEqual(int(src.read(1)[0, 0]), 1)
+
+    def test_replaced_file_is_reopened(self):
+        path = self.write("a.tif", 1)
+        old = rasterpool.open_raster(path)
+        self.write("a.tif", 2)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        new = rasterpool.open_raster(path)
+        self.assertTrue(old.closed)
+        self.assertEqual(int(new.read(1)[0, 0]), 2)
+
+    def test_least_recently_used_is_closed(self):
+        rasterpool.configure(max_open=2)
+        a, b, c = (self.write(f"{name}.tif", 1) for name in "abc")
+        src_a = rasterpool.open_raster(a)
+        src_b = rasterpool.open_raster(b)
+        rasterpool.open_raster(a)
+        rasterpool.open_raster(c)
+        self.assertTrue(src_b.closed)
+        self.assertFalse(src_a.closed)
+
+
+class FrameTests(SimpleTestCase):
+    def test_round_trip(self):
+        gdf = synthetic_parcels(10, raster_size=400)
+        gdf["area_ha"] = gdf.to_crs(3116).geometry.area / 10000
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch("apps.tree_capitator.loaders.large_storage", FileSystemStorage(location=directory)):
+            frame = save_frame(gdf, "abc")
+            self.assertEqual(frame, "uploads/abc/frame.parquet")
+            self.assertEqual(load_frame(frame).to_json(), gdf.to_json())
+            chunk = load_frame(frame, 3, 7, columns=["geometry"])
+            self.assertEqual(list(chunk.geometry), list(gdf.geometry.iloc[3:7]))
+            self.assertEqual(list(chunk.columns), ["geometry"])
+
+            delete_upload(frame)
+            self.assertFalse(os.path.exists(os.path.join(directory, "uploads", "abc")))
+
+
+class PixelAreaTests(SimpleTestCase):
+    geod = Geod(ellps="WGS84")
+
+    def pixel_area(self, lon, lat, dx, dy):
+        lons = [lon, lon + dx, lon + dx, lon]
+        lats = [lat, lat, lat - dy, lat - dy]
+        return abs(self.geod.polygon_area_perimeter(lons, lats)[0])
+
+    def test_geographic_rows_match_geodesic_area(self):
+        # Píxeles de 0.00025° (~30 m) desde el ecuador hasta 60° N
+        for top in (0.0, 4.5, 30.0, 60.0):
+            with self.subTest(latitude=top):
+                transform = from_origin(-74, top, 0.00025, 0.00025)
+                areas = row_areas("EPSG:4326", transform, 10, 5)
+                expected = [self.pixel_area(-74, top - 0.00025 * row, 0.00025, 0.00025) for row in range(5)]
+                np.testing.assert_allclose(areas, expected, rtol=1e-6)
+
+    def test_projected_rows(self):
+        # UTM 18N: un píxel de 30 m mide cerca de 900 m² sobre el elipsoide
+        areas = row_areas("EPSG:32618", from_origin(500000, 500000, 30, 30), 100, 20)
+        self.assertEqual(areas.shape, (20,))
+        np.testing.assert_allclose(areas, 900, rtol=2e-3)
+
+    def test_area_shrinks_with_latitude(self):
+        # A 60° N un píxel en grados mide cerca de la mitad que en el ecuador
+        equator, north = (row_areas("EPSG:4326", from_origin(-74, top, 0.001, 0.001), 1, 1)[0] for top in (0.001, 60.001))
+        self.assertAlmostEqual(north / equator, 0.5, delta=0.01)
+
+
+class LoaderFormatTests(SimpleTestCase):
+    # Cuadrados de 0.01° a lo largo de una fila, guardados en EPSG:3116
+    parcels = gpd.GeoDataFrame(
+        {"id": list(range(6))},
+        geometry=[box(-74 + 0.1 * i, 4, -73.99 + 0.1 * i, 4.01) for i in range(6)],
+        crs="EPSG:4326",
+    ).to_crs(3116)
+
+    def write(self, directory, extension):
+        path = os.path.join(directory, f"parcels{extension}")
+        if extension == ".parquet":
+            self.parcels.to_parquet(path)
+        elif extension == ".zip":
+            shp = os.path.join(directory, "parcels.shp")
+            self.parcels.to_file(shp, engine="pyogrio")
+            with zipfile.ZipFile(path, "w") as zpf:
+                for part in ("shp", "shx", "dbf", "prj"):
+                    zpf.write(os.path.join(directory, f"parcels.{part}"), f"shape/parcels.{part}")
+        else:
+            self.parcels.to_file(path, engine="pyogrio")
+        return path
+
+    def test_formats_with_bbox(self):
+        for extension in (".geojson", ".fgb", ".gpkg", ".parquet", ".zip"):
+            with self.subTest(extension=extension), tempfile.TemporaryDirectory() as directory:
+                path = self.write(directory, extension)
+                gdf = loader_dataframe_from_file(path)
+                self.assertEqual(gdf.crs.to_epsg(), 4326)
+                self.assertEqual(sorted(gdf["id"]), list(range(6)))
+
+                gdf = loader_dataframe_from_file(path, bbox=(-73.85, 3.9, -73.65, 4.1))
+                self.assertEqual(sorted(gdf["id"]), [2, 3])
+                self.assertEqual(list(gdf.index), [0, 1])
+
+
+@override_settings(CHUNKED_UPLOAD_MIN_PART=16)
+class ChunkedUploadTests(SimpleTestCase):
+    payload = b'{"type": "FeatureCollection", "features": []}'
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.storage = FileSystemStorage(location=directory.name)
+        for target in (
+            mock.patch.object(chunked, "large_storage", self.storage),
+            mock.patch.object(chunked, "_client", fakeredis.FakeRedis(decode_responses=True)),
+        ):
+            target.start()
+            self.addCleanup(target.stop)
+        self.upload = create_upload("parcelas.geojson", len(self.payload), part_size=16)
+
+    def send(self, number, data=None, checksum=None):
+        part_size = self.upload["part_size"]
+        if data is None:
+            data = self.payload[number * part_size:(number + 1) * part_size]
+        checksum = checksum or hashlib.sha256(data).hexdigest()
+        write_part(self.upload["upload_id"], number, io.BytesIO(data), checksum)
+
+    def assertCompletes(self):
+        name = complete_upload(self.upload["upload_id"], "abc")
+        with self.storage.open(name, "rb") as file:
+            self.assertEqual(file.read(), self.payload)
+
+    def test_out_of_order_parts(self):
+        for number in reversed(range(self.upload["parts"])):
+            self.send(number)
+        self.assertCompletes()
+
+    def test_resume(self):
+        self.send(0)
+        self.send(2)
+        received = get_upload(self.upload["upload_id"])["received"]
+        self.assertEqual(sorted(received), [0, 2])
+        with self.assertRaises(UploadError) as error:
+            complete_upload(self.upload["upload_id"], "abc")
+        self.assertEqual(error.exception.status, 409)
+        self.send(1)
+        self.assertCompletes()
+
+    def test_checksum_mismatch_keeps_received_part(self):
+        for number in range(self.upload["parts"]):
+            self.send(number)
+        with self.assertRaises(UploadError):
+            self.send(1, data=b"x" * 16, checksum=hashlib.sha256(b"y" * 16).hexdigest())
+        self.assertCompletes()
+        self.assertEqual(self.storage.listdir("chunked")[1], [])
+
+    def test_only_one_complete(self):
+        for number in range(self.upload["parts"]):
+            self.send(number)
+        chunked.client().set(chunked._completing_key(self.upload["upload_id"]), "other")
+        with self.assertRaises(UploadError) as error:
+            complete_upload(self.upload["upload_id"], "abc")
+        self.assertEqual(error.exception.status, 409)
+        with self.assertRaises(UploadError) as error:
+            self.send(0)
+        self.assertEqual(error.exception.status, 409)
+        self.assertTrue(os.path.exists(self.storage.path(chunked._partial_name(self.upload["upload_id"]))))
+
+
+@override_settings(WEATHER_RATE_LIMIT=0, WEATHER_BACKOFF=0, WEATHER_BATCH_SIZE=4)
+class OpenMeteoClientTests(SimpleTestCase):
+    coords = [(4 + i / 100, -74 - i / 100) for i in range(10)]
+    day = date(2024, 1, 1)
+
+    def expected(self):
+        return [fake_daily(lat, lon, "2024-01-01", weather.DAILY_VARIABLES.split(",")) for lat, lon in self.coords]
+
+    def fetch(self, server, **kwargs):
+        with override_settings(OPEN_METEO_URL=server.url):
+            return asyncio.run(weather.fetch_weather_async(self.coords, day=self.day, **kwargs))
+
+    def test_batches(self):
+        batches = []
+        with running_fake_open_meteo() as server:
+            self.assertEqual(self.fetch(server, on_batch=batches.append), self.expected())
+        self.assertEqual(server.requests, 3)
+        self.assertEqual(sorted(len(batch) for batch in batches), [2, 4, 4])
+
+    @override_settings(WEATHER_BACKOFF=60)
+    def test_retry_after(self):
+        # Con 429 se espera lo que indica Retry-After (0) y no el backoff
+        start = time.monotonic()
+        with running_fake_open_meteo(fail_first=2) as server:
+            self.assertEqual(self.fetch(server), self.expected())
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(server.requests, 5)
+
+    @override_settings(WEATHER_MAX_RETRIES=2)
+    def test_retries_exhausted(self):
+        with running_fake_open_meteo(fail_first=1000, fail_status=503) as server:
+            self.assertEqual(self.fetch(server), [{} for _ in self.coords])
+        self.assertEqual(server.requests, 3 * 3)
+
+
+@override_settings(WEATHER_RATE_LIMIT=0, WEATHER_BACKOFF=0)
+class WeatherCacheTests(SimpleTestCase):
+    cells = [(40, -740), (41, -741), (42, -742)]
+
+    def expected(self, cell):
+        lat, lon = weather.cell_center(cell)
+        day = weather.local_today("America/Bogota").isoformat()
+        return fake_daily(round(lat, 6), round(lon, 6), day, weather.DAILY_VARIABLES.split(","))
+
+    def fetch(self, client):
+        with running_fake_open_meteo() as server, override_settings(OPEN_METEO_URL=server.url), \
+                mock.patch.object(weather, "_cache_client", client):
+            return weather.fetch_cells(self.cells)
+
+    def test_cached_after_first_fetch(self):
+        client = fakeredis.FakeRedis(decode_responses=True)
+        first = self.fetch(client)
+        self.assertEqual(first, {cell: self.expected(cell) for cell in self.cells})
+        self.assertEqual(self.fetch(client), first)
+        self.assertEqual(client.get("WEATHER:stats:hits"), "3")
+
+    def test_redis_errors_fall_back_to_direct_requests(self):
+        for method in ("mget", "incrby", "set", "pipeline"):
+            client = fakeredis.FakeRedis(decode_responses=True)
+            with self.subTest(method=method), \
+                    mock.patch.object(client, method, side_effect=redis.ConnectionError("caído")):
+                self.assertEqual(self.fetch(client), {cell: self.expected(cell) for cell in self.cells})
+
+    @override_settings(WEATHER_LOCK_WAIT=30)
+    def test_failed_marker_stops_waiting(self):
+        client = fakeredis.FakeRedis(decode_responses=True)
+        key = weather.cache_key(self.cells[0], weather.local_today("America/Bogota"), "America/Bogota")
+        client.set(f"{key}:lock", 1)
+        client.set(f"{key}:failed", 1)
+        start = time.monotonic()
+        self.assertEqual(self.fetch(client), {cell: self.expected(cell) for cell in self.cells})
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_owner_marks_failed_cells(self):
+        client = fakeredis.FakeRedis(decode_responses=True)
+        with running_fake_open_meteo(fail_first=1000, fail_status=400) as server, \
+                override_settings(OPEN_METEO_URL=server.url), mock.patch.object(weather, "_cache_client", client):
+            self.assertEqual(weather.fetch_cells(self.cells), {cell: {} for cell in self.cells})
+        day = weather.local_today("America/Bogota")
+        for cell in self.cells:
+            key = weather.cache_key(cell, day, "America/Bogota")
+            self.assertEqual(client.get(f"{key}:failed"), "1")
+            self.assertIsNone(client.get(f"{key}:lock"))
+
+    @override_settings(WEATHER_LOCK_WAIT=5)
+    def test_redis_error_while_waiting_for_lock(self):
+        client = fakeredis.FakeRedis(decode_responses=True)
+        day = weather.local_today("America/Bogota")
+        client.set(f"{weather.cache_key(self.cells[0], day, 'America/Bogota')}:lock", 1)
+        read_cache = weather._read_cache
+        calls = []
+
+        def failing_read(*args):
+            calls.append(args)
+            if len(calls) > 1:
+                raise redis.ConnectionError("caído")
+            return read_cache(*args)
+
+        with mock.patch.object(weather, "_read_cache", failing_read):
+            self.assertEqual(self.fetch(client), {cell: self.expected(cell) for cell in self.cells})
+
+
+class ResultStreamTests(SimpleTestCase):
+    pages = [
+        [{"type": "Feature", "properties": {"i": i, "name": "ñandú\n"}, "geometry": None} for i in range(start, start + 3)]
+        for start in (0, 3, 6)
+    ]
+
+    def read(self, stream, pages):
+        async def stored():
+            for features in pages:
+                yield encode_page(features)
+
+        async def consume():
+            return [part async for part in stream(stored())]
+        return asyncio.run(consume())
+
+    def test_gzip_pages_decompress_to_geojson(self):
+        for pages in (self.pages, self.pages[:1], []):
+            with self.subTest(pages=len(pages)):
+                body = b"".join(self.read(lambda stored: gzip_stream(geojson_fragments(stored)), pages))
+                # ``gzip`` verifica también el CRC32 y el tamaño de la cola
+                collection = json.loads(gzip.decompress(body))
+                self.assertEqual(collection["features"], [f for features in pages for f in features])
+
+    def test_accept_encoding(self):
+        for header, accepted in (
+            ("gzip", True),
+            ("gzip, deflate, br", True),
+            ("br;q=1.0, gzip;q=0.8", True),
+            ("gzip;q=0", False),
+            ("gzip; q=0.0, deflate", False),
+            ("*", True),
+            ("*;q=0", False),
+            ("gzip;q=0, *", False),
+            ("identity", False),
+            ("", False),
+        ):
+            with self.subTest(header=header):
+                self.assertEqual(accepts_gzip(header), accepted)
+
+    def test_text_and_ndjson_streams(self):
+        text = "".join(self.read(lambda stored: text_stream(geojson_fragments(stored)), self.pages))
+        self.assertEqual(json.loads(text)["features"], [f for features in self.pages for f in features])
+        lines = "".join(self.read(ndjson_stream, self.pages)).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [f for features in self.pages for f in features])
+
+
+@override_settings(RESULT_PAGE_SIZE=4)
+class ResultPagesTests(SimpleTestCase):
+    def test_result_is_saved_in_pages(self):
+        features = [{"type": "Feature", "properties": {"i": i}, "geometry": None} for i in range(10)]
+        with mock.patch.object(tasks.transaction, "atomic"), \
+                mock.patch.object(tasks.TempResult.objects, "create", side_effect=lambda **kw: TempResult(pk=1, **kw)), \
+                mock.patch.object(tasks.ResultPage.objects, "bulk_create") as bulk_create:
+            temp = tasks.save_result("abc", features)
+
+        pages = bulk_create.call_args.args[0]
+        self.assertEqual(temp.feature_count(), 10)
+        self.assertEqual([(page.start, page.count) for page in pages], [(0, 4), (4, 4), (8, 2)])
+        self.assertEqual([f for page in pages for f in page.features()], features)
+
+
+@override_settings(PROGRESS_STREAM_TIMEOUT=5, PROGRESS_KEEPALIVE=0.1)
+class ProgressEventsTests(SimpleTestCase):
+    def setUp(self):
+        server = fakeredis.FakeServer()
+        client = fakeredis.FakeRedis(server=server, decode_responses=True)
+        patches = (
+            mock.patch.object(tasks, "redis_manager_for_polygons", client),
+            mock.patch.object(
+                events.aioredis.Redis, "from_url",
+                side_effect=lambda *args, **kwargs: fakeredis.FakeAsyncRedis(server=server, decode_responses=True),
+            ),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def stream(self, petition_key, publish=()):
+        async def consume():
+            received = []
+            async for event in events.progress_events(petition_key):
+                if event.startswith(":"):
+                    continue
+                received.append(event)
+                # Los cambios llegan después del estado inicial
+                if len(received) == 1:
+                    for status, load in publish:
+                        tasks.set_progress(petition_key, status, load)
+            return received
+        return asyncio.run(consume())
+
+    def test_events_until_final_status(self):
+        tasks.set_progress("abc", "procesando", 0)
+        received = self.stream("abc", [("procesando", 50), ("Proceso Completado", 100)])
+        self.assertEqual([json.loads(event[len("data: "):])["load"] for event in received], [0, 50, 100])
+
+    def test_finished_petition_only_sends_its_state(self):
+        tasks.set_progress("abc", "Proceso Completado", 100)
+        self.assertEqual(len(self.stream("abc")), 1)
+
+    def test_unknown_petition(self):
+        received = self.stream("missing")
+        self.assertEqual(len(received), 1)
+        self.assertTrue(received[0].startswith("event: error\n"))
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        metrics.collect()
+        patch = mock.patch.object(metrics, "_client", fakeredis.FakeRedis(decode_responses=True))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def record_job(self, petition_key):
+        metrics.start_job(petition_key)
+        metrics.observe("mask", 0.02, "hansen")
+        metrics.observe("mask", 3, "hansen")
+        # Lo medido en un proceso del pool se suma al padre
+        metrics.merge({"spans": [["mask", "hansen", 0.004, 1, [1] + [0] * len(metrics.BUCKETS)]], "counters": []})
+        metrics.count("raster_reads", 2, "hansen")
+        metrics.count("cache_hits", 5, 'polygon"result')
+        metrics.publish(petition_key)
+
+    def test_prometheus_exposition(self):
+        self.record_job("abc")
+        self.record_job("def")
+        lines = metrics.render_prometheus().splitlines()
+
+        self.assertIn('tree_capitator_stage_seconds_bucket{stage="mask",dataset="hansen",le="0.005"} 2', lines)
+        self.assertIn('tree_capitator_stage_seconds_bucket{stage="mask",dataset="hansen",le="0.025"} 4', lines)
+        self.assertIn('tree_capitator_stage_seconds_bucket{stage="mask",dataset="hansen",le="+Inf"} 6', lines)
+        self.assertIn('tree_capitator_stage_seconds_count{stage="mask",dataset="hansen"} 6', lines)
+        self.assertIn('tree_capitator_raster_reads_total{dataset="hansen"} 4', lines)
+        self.assertIn('tree_capitator_cache_hits_total{cache="polygon\\"result"} 10', lines)
+        self.assertIn("# TYPE tree_capitator_jobs_total counter", lines)
+
+    def test_job_summary(self):
+        self.record_job("abc")
+        summary = metrics.job_summary("abc")
+        self.assertIsNotNone(summary["elapsed_seconds"])
+        self.assertEqual(summary["stages"], [{"stage": "mask", "dataset": "hansen", "seconds": 3.024, "count": 3}])
+        self.assertIn({"name": "raster_reads", "dataset": "hansen", "value": 2}, summary["counters"])
+        self.assertEqual(metrics.job_summary("missing")["stages"], [])
+
+
+class ProfilingTests(SimpleTestCase):
+    def test_profiles_are_not_served_as_media(self):
+        root = os.path.realpath(settings.PROFILE_ROOT)
+        media = os.path.realpath(settings.MEDIA_ROOT)
+        self.assertNotEqual(os.path.commonpath([root, media]), media)
+        self.assertEqual(os.path.realpath(profiling.profile_storage.location), root)
+
+    def test_parts_are_combined_and_deleted(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(profiling, "profile_storage", FileSystemStorage(location=directory)):
+            for task_id in ("a", "b"):
+                profiling.start(task_id)
+                sorted(range(10000), key=lambda x: -x)
+                self.assertTrue(profiling.stop(task_id, "abc", "analyze_chunk"))
+            name, summary = profiling.combine("abc")
+            self.assertEqual(name, "abc.prof")
+            self.assertTrue(summary)
+            profiling.delete_profile("abc")
+            self.assertEqual(os.listdir(directory), [])
+
+
+class MosaicSignatureTests(SimpleTestCase):
+    def tile(self, path):
+        return Tile("1:datasets/a.tif", path, None, None, 10, 10, "uint8", 0, (10, 10))
+
+    def test_signature_changes_when_tile_reads_its_cog(self):
+        original = mosaic_signature("grid", [self.tile("media/datasets/a.tif")])
+        self.assertEqual(original, mosaic_signature("grid", [self.tile("media/datasets/a.tif")]))
+        self.assertNotEqual(original, mosaic_signature("grid", [self.tile("media/datasets/cog/a-1234.tif")]))
+
+
+@override_settings(DESCRIPTION_CONCURRENCY=4)
+class DescriptionBackendTests(SimpleTestCase):
+    def test_openai_client_is_shared_between_threads(self):
+        created = []
+
+        def client():
+            created.append(mock.Mock())
+            created[-1].completions.create.return_value.choices = [mock.Mock(text=" ok ")]
+            return created[-1]
+
+        inputs = [{"id": i, "area": 1.0, "hansen_total": 0, "history_total": 0, "indices": [], "weather": {}} for i in range(8)]
+        with mock.patch.object(descriptions.openai, "OpenAI", side_effect=client), \
+                mock.patch.object(descriptions, "_cache_client", fakeredis.FakeRedis(decode_responses=True)):
+            described = descriptions.describe_all(inputs, descriptions.OpenAIBackend())
+        self.assertEqual(described, ["ok"] * 8)
+        self.assertEqual(len(created), 1)
+        self.assertEqual(created[0].completions.create.call_count, 8)
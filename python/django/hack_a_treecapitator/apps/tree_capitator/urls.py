@@ -15,5 +15,13 @@ urlpatterns = [
     path("reset-password/<str:token>/", ResetPasswordView.as_view()),
     path("user/update-photo/", UserUpdatePhotoView.as_view()),
     path("api/v1/upload_file/", UploadTempFile.as_view()),
-    path("api/v1/model_status/", GetTempFileStatus.as_view())
+    path("api/v1/uploads/", ChunkedUploadInit.as_view()),
+    path("api/v1/uploads/<str:upload_id>/", ChunkedUploadStatus.as_view()),
+    path("api/v1/uploads/<str:upload_id>/parts/<int:number>/", ChunkedUploadPart.as_view()),
+    path("api/v1/uploads/<str:upload_id>/complete/", ChunkedUploadComplete.as_view()),
+    path("api/v1/model_status/", GetTempFileStatus.as_view()),
+    path("api/v1/model_status/<str:petition_key>/events/", stream_progress),
+    path("api/v1/results/<str:petition_key>/", GetTempFileResults.as_view()),
+    path("api/v1/results/<str:petition_key>/stream/", stream_temp_file_results),
+    path("metrics/", prometheus_metrics),
 ]
\ No newline at end of file
@@ -12,15 +12,21 @@ from django.contrib.auth import get_user_model
 from .authentication import CookieJWTAuthentication
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.decorators import action
+from rest_framework.pagination import CursorPagination
+from django.conf import settings
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 import redis
 import json
-import geopandas as gpd
 from .tasks import *
+from .events import progress_events
+from .loaders import is_supported, parse_bbox, upload_name
+from .chunked import UploadError, complete_upload, create_upload, get_upload, write_part
+from .resultstore import accepts_gzip, geojson_fragments, gzip_stream, ndjson_stream, text_stream
+from .metrics import render_prometheus
+from .profiling import request_profile
+from rest_framework.exceptions import AuthenticationFailed
+import hmac
 import uuid
-import tempfile
-import zipfile
-import gzip
-import base64
 
 User = get_user_model() 
 redis_manager_for_polygons = redis.Redis.from_url("redis://dragonfly:6379/0")
@@ -185,30 +191,6 @@ class UserUpdatePhotoView(APIView):
         })
 
 
-def loader_dataframe_from_file(file):
-    name = file.name.lower()
-
-    if name.endswith(".geojson") or name.endswith(".json"):
-        data = json.load(file)
-        gdf = gpd.GeoDataFrame.from_features(data["features"])
-        if gdf.crs is None:
-            gdf.set_crs("EPSG:4326", inplace=True)
-        elif gdf.crs.to_epsg() != 4326:
-            gdf = gdf.to_crs("EPSG:4326")
-        return gdf
-
-    if name.endswith(".zip"):
-        with tempfile.TemporaryDirectory() as tmpdir:
-            with zipfile.ZipFile(file, "r") as zpf:
-                zpf.extractall(tmpdir)
-            
-            gdf = gpd.read_file(tmpdir)
-            if gdf.crs is None:
-                gdf.set_crs("EPSG:4326", inplace=True)
-            elif gdf.crs.to_epsg() != 4326:
-                gdf = gdf.to_crs("EPSG:4326")   
-            return gdf
-
 class UploadTempFile(APIView):
     permission_classes = [AllowAny]
     parser_classes = [MultiPartParser, FormParser]
@@ -218,34 +200,137 @@ class UploadTempFile(APIView):
             return Response({"error": "No se envió el archivo"}, status=400)
         
         file = request.FILES["file"]
-
+        if not is_supported(file.name):
+            return Response({"error": "Formato de archivo no soportado"}, status=400)
         try:
-            gdf = loader_dataframe_from_file(file)
-        except Exception as e:
-            return Response({"error": f"Error leyendo archivo: {str(e)}"}, status=400)
+            bbox = parse_bbox(request.data.get("bbox"))
+        except (ValueError, TypeError) as e:
+            return Response({"error": str(e)}, status=400)
+        profile = profile_flag(request)
+        if profile and not is_staff_request(request):
+            return Response({"error": "Sólo el staff puede perfilar peticiones"}, status=403)
 
         # Crear clave única
         cache_key = f"{uuid.uuid4()}-{uuid.uuid4()}"
 
-        # Preparar objeto para Redis
-        redis_petition = {
-            "petition_key": cache_key,
-            "status":"tarea iniciada",
-            "load": 0
-        }
+        # Sólo se guardan los bytes; el worker lee y valida el archivo
+        upload = large_storage.save(upload_name(cache_key, file.name), file)
+        start_petition(upload, cache_key, bbox, profile)
 
-        # Guardar en Redis por 120 segundos (2 minutos)
-        redis_manager_for_polygons.set(
-            name=f"TEMP:{cache_key}",
-            value=json.dumps(redis_petition)
-        )
-        modelo_gdf.delay(gdf.to_json(), cache_key)
         return Response({
             "status": "petición realizada exitosamente",
             "petition_key": cache_key
         })
 
 
+def profile_flag(request):
+    return str(request.data.get("profile", "")).lower() in ("1", "true", "yes", "on")
+
+
+def is_staff_request(request):
+    """Usuario staff por la cookie JWT o por la sesión del admin."""
+    if request.user.is_authenticated:
+        return request.user.is_staff
+    try:
+        auth = CookieJWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return False
+    return auth is not None and auth[0].is_staff
+
+
+def start_petition(upload, cache_key, bbox=None, profile=False):
+    # Preparar objeto para Redis
+    redis_petition = {
+        "petition_key": cache_key,
+        "status":"tarea iniciada",
+        "load": 0
+    }
+
+    redis_manager_for_polygons.set(
+        name=f"TEMP:{cache_key}",
+        value=json.dumps(redis_petition)
+    )
+    # Las tareas de la petición leen la marca antes de empezar (ver profiling.py)
+    if profile:
+        request_profile(cache_key)
+    modelo_gdf.delay(upload, cache_key, bbox)
+
+
+class ChunkedUploadInit(APIView):
+    """
+    Inicia una subida por partes: ``{"filename", "size", "part_size"?}``.
+    Devuelve ``upload_id`` y el número de partes.
+    """
+    permission_classes = [AllowAny]
+
+    def post(self, request):
+        try:
+            upload = create_upload(
+                request.data.get("filename", ""),
+                request.data.get("size", 0),
+                request.data.get("part_size"),
+            )
+        except (UploadError, ValueError, TypeError) as e:
+            return Response({"error": str(e)}, status=getattr(e, "status", 400))
+        return Response(upload, status=201)
+
+
+class ChunkedUploadStatus(APIView):
+    """Estado de la subida con las partes ya recibidas, para reanudarla."""
+    permission_classes = [AllowAny]
+
+    def get(self, request, upload_id):
+        try:
+            upload = get_upload(upload_id)
+        except UploadError as e:
+            return Response({"error": str(e)}, status=e.status)
+        upload["received"] = sorted(upload["received"])
+        return Response(upload)
+
+
+class ChunkedUploadPart(APIView):
+    """
+    Recibe una parte como cuerpo binario (``PUT``), con su SHA-256 en la
+    cabecera ``X-Checksum-SHA256``. Reenviar una parte la reemplaza.
+    """
+    permission_classes = [AllowAny]
+
+    def put(self, request, upload_id, number):
+        try:
+            write_part(upload_id, number, request.stream, request.headers.get("X-Checksum-SHA256"))
+        except UploadError as e:
+            return Response({"error": str(e)}, status=e.status)
+        return Response({"upload_id": upload_id, "part": number, "success": True})
+
+
+class ChunkedUploadComplete(APIView):
+    """
+    Cierra la subida y lanza el análisis del archivo (``bbox`` opcional;
+    ``profile`` perfila la petición y sólo lo puede pedir el staff).
+    """
+    permission_classes = [AllowAny]
+
+    def post(self, request, upload_id):
+        try:
+            bbox = parse_bbox(request.data.get("bbox"))
+        except (ValueError, TypeError) as e:
+            return Response({"error": str(e)}, status=400)
+        profile = profile_flag(request)
+        if profile and not is_staff_request(request):
+            return Response({"error": "Sólo el staff puede perfilar peticiones"}, status=403)
+
+        cache_key = f"{uuid.uuid4()}-{uuid.uuid4()}"
+        try:
+            upload = complete_upload(upload_id, cache_key)
+        except UploadError as e:
+            return Response({"error": str(e)}, status=e.status)
+
+        start_petition(upload, cache_key, bbox, profile)
+        return Response({
+            "status": "petición realizada exitosamente",
+            "petition_key": cache_key
+        })
+
 
 class GetTempFileStatus(APIView):
     permission_classes = [AllowAny]
@@ -262,23 +347,129 @@ class GetTempFileStatus(APIView):
 
         # Si no ha terminado → devolver solo progreso
         if data.get("status") != "Proceso Completado":
-            return Response({
+            response = {
                 "petition_key": petition_key,
                 "status": data.get("status"),
                 "load": data.get("load")
-            })
-
-        # Buscar el resultado en PostgreSQL
+            }
+            if "error" in data:
+                response["error"] = data["error"]
+            return Response(response)
+
+        # Buscar el resultado en PostgreSQL; los resultados grandes se leen
+        # paginados o transmitidos desde api/v1/results/
+        result, count = None, 0
         try:
             temp = TempResult.objects.get(petition_key=petition_key)
-            result = temp.json_data
+            count = temp.feature_count()
+            if count <= settings.RESULT_INLINE_MAX_FEATURES:
+                result = temp.feature_collection()
         except TempResult.DoesNotExist:
-            result = None
+            pass
 
-        return Response({
+        response = {
             "petition_key": petition_key,
             "status": "Proceso Completado",
             "load": 100,
-            "result": result
+            "result": result,
+            "result_count": count,
+            "results_url": f"/api/v1/results/{petition_key}/",
+        }
+        if "descriptions" in data:
+            response["descriptions"] = data["descriptions"]
+        return Response(response)
+
+
+
+class ResultPagePagination(CursorPagination):
+    # Cada fila es una página comprimida de RESULT_PAGE_SIZE features
+    ordering = "start"
+    page_size = 1
+    page_size_query_param = "pages"
+    max_page_size = 10
+
+
+class GetTempFileResults(APIView):
+    """Features de un resultado, paginadas por cursor (``?cursor=...&pages=...``)."""
+    permission_classes = [AllowAny]
+
+    def get(self, request, petition_key):
+        try:
+            temp = TempResult.objects.get(petition_key=petition_key)
+        except TempResult.DoesNotExist:
+            return Response({"error": "Resultado no encontrado o expirado"}, status=404)
+
+        paginator = ResultPagePagination()
+        pages = paginator.paginate_queryset(temp.pages.all(), request, view=self)
+
+        return Response({
+            "petition_key": petition_key,
+            "type": "FeatureCollection",
+            "count": temp.feature_count(),
+            "next": paginator.get_next_link(),
+            "previous": paginator.get_previous_link(),
+            "features": [feature for page in pages for feature in page.features()],
         })
 
+
+async def stream_temp_file_results(request, petition_key):
+    """
+    Resultado completo escrito a medida que se leen las páginas de un cursor
+    del lado del servidor: GeoJSON por defecto o una feature por línea con
+    ``?output=ndjson``. Si el cliente acepta gzip, el GeoJSON se envía con
+    las páginas comprimidas tal como están guardadas. Es asíncrona para que
+    con ASGI las páginas se envíen a medida que se leen.
+    """
+    try:
+        temp = await TempResult.objects.aget(petition_key=petition_key)
+    except TempResult.DoesNotExist:
+        raise Http404("Resultado no encontrado o expirado")
+
+    pages = (
+        temp.pages.order_by("start")
+        .values_list("payload", "crc", "size")
+        .aiterator(chunk_size=settings.RESULT_STREAM_CHUNK)
+    )
+    gzip_ok = accepts_gzip(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+
+    if request.GET.get("output") == "ndjson":
+        content = ndjson_stream(pages)
+        content_type, extension = "application/x-ndjson", "ndjson"
+    elif gzip_ok:
+        content = gzip_stream(geojson_fragments(pages))
+        content_type, extension = "application/geo+json", "geojson"
+    else:
+        content = text_stream(geojson_fragments(pages))
+        content_type, extension = "application/geo+json", "geojson"
+
+    response = StreamingHttpResponse(content, content_type=content_type)
+    if gzip_ok and extension == "geojson":
+        response["Content-Encoding"] = "gzip"
+    response["Vary"] = "Accept-Encoding"
+    response["Content-Disposition"] = f'inline; filename="{petition_key}.{extension}"'
+    return response
+
+
+async def stream_progress(request, petition_key):
+    """
+    Avance de una petición como Server-Sent Events, sin consultas
+    periódicas. Requiere servir la aplicación con ASGI.
+    """
+    response = StreamingHttpResponse(progress_events(petition_key), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def prometheus_metrics(request):
+    """Histogramas por etapa y contadores de los análisis, para Prometheus."""
+    token = settings.METRICS_TOKEN
+    if token and not hmac.compare_digest(request.META.get("HTTP_AUTHORIZATION", ""), f"Bearer {token}"):
+        return HttpResponse(status=401)
+
+    try:
+        body = render_prometheus()
+    except redis.RedisError as e:
+        print("Métricas no disponibles:", e)
+        return HttpResponse(status=503)
+    return HttpResponse(body, content_type="text/plain; version=0.0.4; charset=utf-8")
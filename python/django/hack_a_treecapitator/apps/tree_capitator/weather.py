@@ -0,0 +1,316 @@
+"""
+Cliente de clima (Open-Meteo) para todos los polígonos de un trabajo.
+
+Los centroides se piden en lotes usando las consultas multi-coordenada de
+Open-Meteo (``latitude=a,b,c&longitude=x,y,z``), con un número acotado de
+lotes en vuelo, reintentos con backoff exponencial y un limitador de tasa en
+lugar de una pausa fija después de cada llamada.
+
+Las respuestas se guardan en Dragonfly por celda de rejilla (del tamaño de la
+resolución del modelo de pronóstico), día y zona horaria, hasta la medianoche
+local. Un candado por celda evita que trabajos concurrentes pidan la misma
+celda a la vez.
+"""
+import asyncio
+import json
+import random
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import httpx
+import redis
+from django.conf import settings
+
+from . import metrics
+
+
+DAILY_VARIABLES = (
+    "temperature_2m_max,"
+    "temperature_2m_min,"
+    "precipitation_sum,"
+    "shortwave_radiation_sum,"
+    "relative_humidity_2m_mean,"
+    "wind_speed_10m_mean"
+)
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """Limita el número de peticiones por segundo entre todos los lotes."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            delay = self._next - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next = max(loop.time(), self._next) + self.interval
+
+
+def polygon_centroid(polygon):
+    """Centroide ``(lat, lon)`` de un polígono válido, o None."""
+    if polygon is None or polygon.is_empty or not polygon.is_valid:
+        print("Polígono inválido o vacío")
+        return None
+
+    centroid = polygon.centroid
+    lat, lon = centroid.y, centroid.x
+
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        print("Coordenadas fuera de rango")
+        return None
+
+    return lat, lon
+
+
+async def _get_with_retries(client, params, limiter):
+    for attempt in range(settings.WEATHER_MAX_RETRIES + 1):
+        await limiter.wait()
+        try:
+            response = await client.get(settings.OPEN_METEO_URL, params=params)
+            if response.status_code not in RETRY_STATUS:
+                response.raise_for_status()
+                return response.json()
+            retry_after = response.headers.get("Retry-After")
+        except (httpx.TimeoutException, httpx.TransportError) as e:
+            print("Error al solicitar datos de Open-Meteo:", e)
+            retry_after = None
+
+        if attempt == settings.WEATHER_MAX_RETRIES:
+            break
+        if retry_after and retry_after.isdigit():
+            delay = float(retry_after)
+        else:
+            delay = settings.WEATHER_BACKOFF * 2 ** attempt * (1 + random.random())
+        await asyncio.sleep(delay)
+
+    raise httpx.HTTPError("Open-Meteo no respondió tras los reintentos")
+
+
+async def _fetch_batch(client, coords, day, timezone, limiter, semaphore):
+    params = {
+        "latitude": ",".join(f"{lat:.6f}" for lat, _ in coords),
+        "longitude": ",".join(f"{lon:.6f}" for _, lon in coords),
+        "start_date": day.isoformat(),
+        "end_date": day.isoformat(),
+        "daily": DAILY_VARIABLES,
+        "timezone": timezone,
+    }
+
+    async with semaphore:
+        try:
+            data = await _get_with_retries(client, params, limiter)
+        except Exception as e:
+            print("Error al solicitar datos de Open-Meteo:", e)
+            return [{} for _ in coords]
+
+    # Con una sola coordenada Open-Meteo devuelve un objeto en lugar de una lista
+    locations = data if isinstance(data, list) else [data]
+    if len(locations) != len(coords):
+        print("Respuesta de Open-Meteo con un número inesperado de ubicaciones")
+        return [{} for _ in coords]
+    return [location.get("daily") or {} for location in locations]
+
+
+async def fetch_weather_async(coords, timezone="America/Bogota", day=None, on_batch=None):
+    """
+    Clima diario de cada coordenada ``(lat, lon)``; ``{}`` si no hay datos.
+    ``on_batch(batch)`` se llama con las coordenadas de cada lote terminado.
+    """
+    day = day or datetime.utcnow().date()
+    batch_size = settings.WEATHER_BATCH_SIZE
+    batches = [coords[i:i + batch_size] for i in range(0, len(coords), batch_size)]
+
+    limiter = RateLimiter(settings.WEATHER_RATE_LIMIT)
+    semaphore = asyncio.Semaphore(settings.WEATHER_CONCURRENCY)
+
+    async with httpx.AsyncClient(timeout=settings.WEATHER_TIMEOUT) as client:
+        async def run(batch):
+            result = await _fetch_batch(client, batch, day, timezone, limiter, semaphore)
+            if on_batch is not None:
+                on_batch(batch)
+            return result
+
+        results = await asyncio.gather(*(run(batch) for batch in batches))
+
+    return [daily for batch in results for daily in batch]
+
+
+_cache_client = None
+
+
+def cache_client():
+    global _cache_client
+    if _cache_client is None:
+        _cache_client = redis.Redis.from_url(settings.WEATHER_CACHE_URL, decode_responses=True)
+    return _cache_client
+
+
+def grid_cell(lat, lon):
+    """Celda de la rejilla del modelo que contiene la coordenada."""
+    step = settings.WEATHER_GRID_DEGREES
+    return round(lat / step), round(lon / step)
+
+
+def cell_center(cell):
+    step = settings.WEATHER_GRID_DEGREES
+    return cell[0] * step, cell[1] * step
+
+
+def local_today(timezone):
+    return datetime.now(ZoneInfo(timezone)).date()
+
+
+def seconds_until_local_midnight(timezone):
+    now = datetime.now(ZoneInfo(timezone))
+    midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), ZoneInfo(timezone))
+    return max(int((midnight - now).total_seconds()), 1)
+
+
+def cache_key(cell, day, timezone):
+    return f"WEATHER:{timezone}:{day.isoformat()}:{cell[0]}:{cell[1]}"
+
+
+def weather_cache_stats():
+    """Contadores de aciertos y fallos de la caché de clima."""
+    hits, misses = cache_client().mget("WEATHER:stats:hits", "WEATHER:stats:misses")
+    return {"hits": int(hits or 0), "misses": int(misses or 0)}
+
+
+def _read_cache(client, keys):
+    return {
+        key: json.loads(raw)
+        for key, raw in zip(keys, client.mget(keys))
+        if raw is not None
+    }
+
+
+def fetch_cells(cells, timezone="America/Bogota", on_cells=None):
+    """
+    Clima de hoy para cada celda, pasando por la caché de Dragonfly.
+
+    Las celdas sin caché se reservan con un candado (``SET NX``) antes de
+    pedirlas a Open-Meteo; las que ya reservó otro trabajo se esperan hasta
+    ``WEATHER_LOCK_WAIT`` segundos y, si no aparecen o quien las pidió marcó
+    que fallaron (``{clave}:failed``), se piden directamente.
+    Si Dragonfly falla en cualquier paso, las celdas que faltan se piden sin
+    caché. ``on_cells(cells)`` se llama a medida que se resuelven celdas.
+    """
+    on_cells = on_cells or (lambda resolved: None)
+    day = local_today(timezone)
+    keys = {cell: cache_key(cell, day, timezone) for cell in cells}
+    client = cache_client()
+
+    try:
+        found = _read_cache(client, list(keys.values()))
+    except redis.RedisError as e:
+        print("Caché de clima no disponible:", e)
+        client, found = None, {}
+
+    results = {cell: found[key] for cell, key in keys.items() if key in found}
+    pending = [cell for cell in cells if cell not in results]
+    metrics.count("cache_hits", len(results), "weather")
+    metrics.count("cache_misses", len(pending), "weather")
+    on_cells(list(results))
+
+    owned, waiting = [], []
+    if client is not None:
+        try:
+            client.incrby("WEATHER:stats:hits", len(results))
+            client.incrby("WEATHER:stats:misses", len(pending))
+            for cell in pending:
+                locked = client.set(f"{keys[cell]}:lock", 1, nx=True, ex=settings.WEATHER_LOCK_TTL)
+                (owned if locked else waiting).append(cell)
+        except redis.RedisError as e:
+            print("Caché de clima no disponible:", e)
+            client, owned, waiting = None, pending, []
+    else:
+        owned = pending
+
+    def fetch(fetch_list):
+        centers = [cell_center(cell) for cell in fetch_list]
+        by_center = dict(zip(centers, fetch_list))
+        with metrics.span("open_meteo"):
+            fetched = asyncio.run(fetch_weather_async(
+                centers, timezone, day,
+                on_batch=lambda batch: on_cells([by_center[center] for center in batch]),
+            ))
+        return dict(zip(fetch_list, fetched))
+
+    if owned:
+        fetched = fetch(owned)
+        results.update(fetched)
+        if client is not None:
+            ttl = seconds_until_local_midnight(timezone)
+            try:
+                pipe = client.pipeline()
+                for cell, daily in fetched.items():
+                    if daily:
+                        pipe.set(keys[cell], json.dumps(daily), ex=ttl)
+                    else:
+                        # Los trabajos que esperan esta celda dejan de esperar
+                        pipe.set(f"{keys[cell]}:failed", 1, ex=settings.WEATHER_FAILED_TTL)
+                    pipe.delete(f"{keys[cell]}:lock")
+                pipe.execute()
+            except redis.RedisError as e:
+                print("Caché de clima no disponible:", e)
+
+    # Celdas que está pidiendo otro trabajo: se espera a que las publique
+    deadline = time.monotonic() + settings.WEATHER_LOCK_WAIT
+    while waiting and time.monotonic() < deadline:
+        time.sleep(0.2)
+        try:
+            found = _read_cache(client, [keys[cell] for cell in waiting])
+            failed = client.mget([f"{keys[cell]}:failed" for cell in waiting])
+        except redis.RedisError as e:
+            print("Caché de clima no disponible:", e)
+            break
+        resolved = [cell for cell in waiting if keys[cell] in found]
+        for cell in resolved:
+            results[cell] = found[keys[cell]]
+        on_cells(resolved)
+        failed = {cell for cell, marker in zip(waiting, failed) if marker is not None and cell not in results}
+        waiting = [cell for cell in waiting if cell not in results and cell not in failed]
+        if failed:
+            results.update(fetch(list(failed)))
+
+    if waiting:
+        results.update(fetch(waiting))
+
+    return results
+
+
+def fetch_weather(polygons, timezone="America/Bogota", on_batch=None):
+    """
+    Clima de hoy para cada polígono (alineado con ``polygons``). Los polígonos
+    que caen en la misma celda de la rejilla comparten una sola consulta.
+    ``on_batch(n)`` recibe el número de polígonos resueltos en cada paso.
+    """
+    on_batch = on_batch or (lambda n: None)
+    centroids = [polygon_centroid(polygon) for polygon in polygons]
+    cells = [grid_cell(*centroid) if centroid is not None else None for centroid in centroids]
+
+    polygons_per_cell = {}
+    for cell in cells:
+        if cell is not None:
+            polygons_per_cell[cell] = polygons_per_cell.get(cell, 0) + 1
+
+    invalid = cells.count(None)
+    if invalid:
+        on_batch(invalid)
+    if not polygons_per_cell:
+        return [{} for _ in polygons]
+
+    def on_cells(resolved):
+        if resolved:
+            on_batch(sum(polygons_per_cell[cell] for cell in resolved))
+
+    results = fetch_cells(list(polygons_per_cell), timezone, on_cells)
+    return [results.get(cell, {}) if cell is not None else {} for cell in cells]
@@ -0,0 +1,321 @@
+"""
+Estadística zonal por etiquetas.
+
+Todos los polígonos del trabajo se "queman" una sola vez por rejilla raster
+con su identificador (1..n) y las estadísticas por polígono se obtienen con
+una sola pasada de ``np.bincount`` sobre (etiqueta, valor), en lugar de
+recortar cada polígono con ``mask()`` y comparar el recorte valor a valor.
+
+Las etiquetas se guardan de forma dispersa por bloques de ``BLOCK_SIZE``
+píxeles alineados a la rejilla del raster: sólo se conservan los índices de
+los píxeles que caen dentro de algún polígono, y los bloques sin polígonos no
+se leen nunca.
+
+Si el raster tiene pirámide de conteos (ver ``pyramid.py``), la rejilla puede
+construirse excluyendo las teselas interiores de cada polígono, cuyos conteos
+se toman de la pirámide con ``interior_sums``.
+
+Las áreas se obtienen con las mismas sumas, ponderando cada píxel por el
+área de su fila (ver ``pixelarea.py``).
+"""
+from collections import defaultdict
+
+import numpy as np
+from rasterio.features import rasterize
+from rasterio.windows import Window, transform as window_transform
+from shapely import STRtree
+from shapely.geometry import mapping
+
+from . import metrics
+from .pyramid import interior_tiles, pyramid_levels
+
+
+BLOCK_SIZE = 1024
+
+
+def assign_layers(geometries):
+    """
+    Reparte los polígonos en capas sin intersecciones entre sí, de modo que
+    parcelas solapadas o colindantes conserven todos sus píxeles al quemarse
+    en un mismo arreglo de etiquetas.
+    """
+    layers = np.zeros(len(geometries), dtype="int32")
+    tree = STRtree(geometries)
+
+    for i, geometry in enumerate(geometries):
+        if geometry is None or geometry.is_empty:
+            continue
+        neighbours = tree.query(geometry, predicate="intersects")
+        used = {int(layers[j]) for j in neighbours if j < i}
+        layer = 0
+        while layer in used:
+            layer += 1
+        layers[i] = layer
+
+    return layers
+
+
+class PolygonSet:
+    """Polígonos de un trabajo con sus límites y capas precalculados."""
+
+    def __init__(self, geometries):
+        self.geometries = list(geometries)
+        self.n = len(self.geometries)
+        self.valid = np.array(
+            [g is not None and not g.is_empty for g in self.geometries], dtype=bool
+        )
+        self.bounds = np.array(
+            [g.bounds if ok else (np.nan,) * 4 for g, ok in zip(self.geometries, self.valid)],
+            dtype="float64",
+        ).reshape(self.n, 4)
+        self.layers = assign_layers(self.geometries)
+
+
+def pixel_windows(bounds, transform, width, height):
+    """
+    Ventana de píxeles ``(row0, row1, col0, col1)`` de cada caja de ``bounds``
+    recortada a la extensión del raster, y si se superpone con él.
+    """
+    inv = ~transform
+    xs = bounds[:, [0, 2, 0, 2]]
+    ys = bounds[:, [1, 1, 3, 3]]
+    cols = inv.a * xs + inv.b * ys + inv.c
+    rows = inv.d * xs + inv.e * ys + inv.f
+
+    with np.errstate(invalid="ignore"):
+        col0 = np.clip(np.floor(cols.min(axis=1)), 0, width)
+        col1 = np.clip(np.ceil(cols.max(axis=1)), 0, width)
+        row0 = np.clip(np.floor(rows.min(axis=1)), 0, height)
+        row1 = np.clip(np.ceil(rows.max(axis=1)), 0, height)
+
+    overlaps = (col0 < col1) & (row0 < row1)
+    windows = np.stack([row0, row1, col0, col1], axis=1)
+    windows = np.where(overlaps[:, None], windows, 0).astype("int64")
+    return windows, overlaps
+
+
+def grid_key(src, tile_size=None):
+    return (str(src.crs), tuple(src.transform), src.width, src.height, tile_size)
+
+
+class LabelGrid:
+    """
+    Etiquetas de los polígonos sobre la rejilla de un raster.
+
+    ``labels`` contiene la etiqueta (1..n) de cada píxel cubierto, en el mismo
+    orden en que ``values`` devuelve los valores de un raster de esta rejilla.
+    ``overlaps[i]`` indica si el polígono ``i`` se superpone al raster.
+
+    Con ``tile_size`` se excluyen de ``labels`` las teselas de pirámide que
+    quedan completamente dentro de cada polígono (ver ``interior_sums``).
+    """
+
+    def __init__(self, polygons, transform, width, height, block_size=BLOCK_SIZE, tile_size=None):
+        self.n = polygons.n
+        self.transform = transform
+        self.width = width
+        self.height = height
+        self._rows = None
+        self._by_polygon = None
+
+        windows, overlaps = pixel_windows(polygons.bounds, transform, width, height)
+        self.overlaps = overlaps & polygons.valid
+
+        self.interior = []
+        self.interior_rects = defaultdict(list)
+        if tile_size:
+            self._find_interior(polygons, windows, tile_size)
+
+        members = defaultdict(list)
+        for i in np.flatnonzero(self.overlaps):
+            row0, row1, col0, col1 = windows[i]
+            for block_row in range(row0 // block_size, (row1 - 1) // block_size + 1):
+                for block_col in range(col0 // block_size, (col1 - 1) // block_size + 1):
+                    if not self._block_is_interior(i, block_row, block_col, block_size):
+                        members[(block_row, block_col)].append(i)
+
+        self.blocks = []
+        for block_row, block_col in sorted(members):
+            window = Window(
+                block_col * block_size,
+                block_row * block_size,
+                min(block_size, width - block_col * block_size),
+                min(block_size, height - block_row * block_size),
+            )
+            flat, labels = self._burn(polygons, members[(block_row, block_col)], window)
+            if flat.size:
+                self.blocks.append((window, flat, labels))
+
+        if self.blocks:
+            self.labels = np.concatenate([labels for _, _, labels in self.blocks])
+        else:
+            self.labels = np.empty(0, dtype="int64")
+
+    def _find_interior(self, polygons, windows, tile_size):
+        n_levels = pyramid_levels(self.width, self.height, tile_size)
+        by_level = [[] for _ in range(n_levels)]
+
+        for i in np.flatnonzero(self.overlaps):
+            tiles = interior_tiles(
+                polygons.geometries[i], windows[i], self.transform,
+                self.width, self.height, tile_size, n_levels,
+            )
+            for level, r, c in tiles:
+                size = tile_size * 2 ** level
+                by_level[level].append((i, r, c))
+                self.interior_rects[i].append((
+                    r * size, min((r + 1) * size, self.height),
+                    c * size, min((c + 1) * size, self.width),
+                ))
+
+        self.interior = [
+            np.array(tiles, dtype="int64").reshape(-1, 3) for tiles in by_level
+        ]
+
+    def _block_is_interior(self, i, block_row, block_col, block_size):
+        row0, col0 = block_row * block_size, block_col * block_size
+        row1 = min(row0 + block_size, self.height)
+        col1 = min(col0 + block_size, self.width)
+        return any(
+            r0 <= row0 and row1 <= r1 and c0 <= col0 and col1 <= c1
+            for r0, r1, c0, c1 in self.interior_rects.get(i, ())
+        )
+
+    def interior_sums(self, pyramid):
+        """Conteos ``(n, bins)`` de las teselas interiores de cada polígono."""
+        sums = np.zeros((self.n, pyramid.bins), dtype="int64")
+        for level, tiles in enumerate(self.interior):
+            if tiles.size:
+                np.add.at(sums, tiles[:, 0], pyramid.levels[level][tiles[:, 1], tiles[:, 2]])
+        return sums
+
+    def interior_areas(self, pyramid, row_area):
+        """
+        Áreas (m²) ``(n, bins)`` de las teselas interiores de cada polígono.
+        Si la pirámide no guarda áreas se usa el área media de las filas de
+        cada tesela.
+        """
+        sums = np.zeros((self.n, pyramid.bins))
+        cumulative = None
+        for level, tiles in enumerate(self.interior):
+            if not tiles.size:
+                continue
+            if pyramid.areas is not None:
+                values = pyramid.areas[level][tiles[:, 1], tiles[:, 2]]
+            else:
+                if cumulative is None:
+                    cumulative = np.concatenate([[0], np.cumsum(row_area)])
+                size = pyramid.tile_size * 2 ** level
+                row0 = tiles[:, 1] * size
+                row1 = np.minimum(row0 + size, self.height)
+                mean_area = (cumulative[row1] - cumulative[row0]) / (row1 - row0)
+                values = pyramid.levels[level][tiles[:, 1], tiles[:, 2]] * mean_area[:, None]
+            np.add.at(sums, tiles[:, 0], values)
+        return sums
+
+    @property
+    def rows(self):
+        """Fila del raster de cada píxel etiquetado, en el orden de ``labels``."""
+        if self._rows is None:
+            chunks = [int(window.row_off) + flat // int(window.width) for window, flat, _ in self.blocks]
+            self._rows = np.concatenate(chunks) if chunks else np.empty(0, dtype="int64")
+        return self._rows
+
+    def polygon_pixels(self):
+        """
+        ``(order, offsets)``: ``order[offsets[i]:offsets[i + 1]]`` son las
+        posiciones en ``labels`` de los píxeles del polígono ``i``, en el orden
+        de ``labels`` (que no depende de los demás polígonos del trabajo).
+        """
+        if self._by_polygon is None:
+            order = np.argsort(self.labels, kind="stable")
+            counts = np.bincount(self.labels, minlength=self.n + 1)[1:]
+            self._by_polygon = (order, np.concatenate([[0], np.cumsum(counts)]))
+        return self._by_polygon
+
+    def _burn(self, polygons, indices, window):
+        out_shape = (int(window.height), int(window.width))
+        block_transform = window_transform(window, self.transform)
+        flats, labels = [], []
+
+        for layer in np.unique(polygons.layers[indices]):
+            layer_indices = [i for i in indices if polygons.layers[i] == layer]
+            shapes = [(mapping(polygons.geometries[i]), i + 1) for i in layer_indices]
+            burned = rasterize(
+                shapes,
+                out_shape=out_shape,
+                transform=block_transform,
+                fill=0,
+                dtype="int32",
+            )
+
+            # Las teselas interiores se responden desde la pirámide
+            for i in layer_indices:
+                for row0, row1, col0, col1 in self.interior_rects.get(i, ()):
+                    row0, row1 = max(row0 - window.row_off, 0), min(row1 - window.row_off, out_shape[0])
+                    col0, col1 = max(col0 - window.col_off, 0), min(col1 - window.col_off, out_shape[1])
+                    if row0 < row1 and col0 < col1:
+                        burned[row0:row1, col0:col1] = 0
+
+            burned = burned.ravel()
+            flat = np.flatnonzero(burned)
+            flats.append(flat)
+            labels.append(burned[flat].astype("int64"))
+
+        return np.concatenate(flats), np.concatenate(labels)
+
+    @classmethod
+    def for_source(cls, polygons, src, tile_size=None):
+        return cls(polygons, src.transform, src.width, src.height, tile_size=tile_size)
+
+    def values(self, src):
+        """Valores float32 de los píxeles etiquetados; nodata se devuelve como NaN."""
+        chunks = []
+        for window, flat, _ in self.blocks:
+            data = src.read(1, window=window, masked=True)
+            values = data.data.ravel()[flat].astype("float32")
+            values[np.ma.getmaskarray(data).ravel()[flat]] = np.nan
+            chunks.append(values)
+
+        if not chunks:
+            return np.empty(0, dtype="float32")
+        return np.concatenate(chunks)
+
+
+def label_grid(grids, polygons, src, pyramid=None):
+    """
+    ``LabelGrid`` de la rejilla de ``src``, reutilizada entre rasters iguales.
+    Con ``pyramid`` se usa la variante que excluye las teselas interiores.
+    """
+    tile_size = pyramid.tile_size if pyramid is not None else None
+    key = grid_key(src, tile_size)
+    if key in grids:
+        metrics.count("cache_hits", 1, "label_grid")
+    else:
+        metrics.count("cache_misses", 1, "label_grid")
+        with metrics.span("label"):
+            grids[key] = LabelGrid.for_source(polygons, src, tile_size)
+    return grids[key]
+
+
+def zonal_counts(labels, selection, n):
+    """Número de píxeles seleccionados por polígono (arreglo de largo ``n``)."""
+    return np.bincount(labels[selection], minlength=n + 1)[1:]
+
+
+def zonal_histogram(labels, codes, selection, n, n_classes, weights=None):
+    """
+    Histograma de clases por polígono en una sola pasada: arreglo ``(n, n_classes)``
+    donde ``codes`` son enteros en ``[0, n_classes)``. Con ``weights`` se suman
+    esos pesos (por ejemplo el área de cada píxel) en lugar de contar.
+    """
+    flat = labels[selection] * n_classes + codes[selection].astype("int64")
+    if weights is not None:
+        weights = weights[selection]
+    hist = np.bincount(flat, weights=weights, minlength=(n + 1) * n_classes)
+    return hist.reshape(n + 1, n_classes)[1:]
+
+
+def zonal_sums(labels, values, selection, n):
+    """Suma de ``values`` seleccionados por polígono."""
+    return np.bincount(labels[selection], weights=values[selection], minlength=n + 1)[1:]
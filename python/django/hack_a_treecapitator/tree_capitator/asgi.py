@@ -3,6 +3,11 @@ ASGI config for config project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve with an ASGI server (e.g. ``gunicorn tree_capitator.asgi:application
+-k uvicorn.workers.UvicornWorker``) so the progress event stream
+(``api/v1/model_status/<petition_key>/events/``) holds connections without
+tying up a worker thread each.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
@@ -38,6 +38,75 @@ CSRF_TRUSTED_ORIGINS = ["http://*", "https://*"]
 CELERY_BROKER_URL = "redis://dragonfly:6379/1"
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
+CELERY_RESULT_BACKEND = "redis://dragonfly:6379/2"
+CELERY_RESULT_EXPIRES = 3600
+
+# Polígonos por bloque al repartir un análisis entre workers
+ANALYSIS_CHUNK_SIZE = 250
+
+# Procesos por tarea de análisis (1 = secuencial). Se suma a la concurrencia
+# de Celery: núcleos usados = concurrency del worker x ANALYSIS_POOL_SIZE
+ANALYSIS_POOL_SIZE = int(os.environ.get("ANALYSIS_POOL_SIZE", 1))
+
+# Cliente de clima (Open-Meteo)
+OPEN_METEO_URL = os.environ.get("OPEN_METEO_URL", "https://api.open-meteo.com/v1/forecast")
+WEATHER_BATCH_SIZE = 50      # coordenadas por petición
+WEATHER_CONCURRENCY = 4      # lotes en vuelo
+WEATHER_RATE_LIMIT = 5       # peticiones por segundo
+WEATHER_MAX_RETRIES = 4
+WEATHER_BACKOFF = 0.5        # segundos, se duplica en cada reintento
+WEATHER_TIMEOUT = 10
+
+# Caché de clima en Dragonfly por celda de rejilla, día y zona horaria
+WEATHER_CACHE_URL = "redis://dragonfly:6379/4"
+WEATHER_GRID_DEGREES = 0.1   # ~11 km, resolución del modelo de pronóstico
+WEATHER_LOCK_TTL = 60        # segundos que dura el candado de una celda
+WEATHER_LOCK_WAIT = 30       # segundos que se espera a otro trabajo
+WEATHER_FAILED_TTL = 30      # segundos que se recuerda que una celda falló
+
+# Eventos de avance por Server-Sent Events (ver apps/tree_capitator/events.py)
+PROGRESS_PUBSUB_URL = "redis://dragonfly:6379/0"
+PROGRESS_KEEPALIVE = 15          # segundos entre comentarios keepalive
+PROGRESS_STREAM_TIMEOUT = 3600   # duración máxima de una conexión
+
+# Subidas por partes (ver apps/tree_capitator/chunked.py)
+CHUNKED_UPLOAD_URL = "redis://dragonfly:6379/0"
+CHUNKED_UPLOAD_PART_SIZE = 8 * 1024 * 1024
+CHUNKED_UPLOAD_MIN_PART = 1024 * 1024
+CHUNKED_UPLOAD_MAX_PART = 64 * 1024 * 1024
+CHUNKED_UPLOAD_MAX_SIZE = 4 * 1024 ** 3
+CHUNKED_UPLOAD_TTL = 24 * 3600
+
+# Versión del catálogo de rasters compartida por los workers
+CATALOG_CACHE_URL = "redis://dragonfly:6379/0"
+
+# Resultados por polígono reutilizados entre peticiones
+POLYGON_FINGERPRINT_GRID = 1e-7   # grados (~1 cm) al normalizar geometrías
+POLYGON_CACHE_MAX_ENTRIES = 500_000
+
+# Resultados: features por página comprimida, páginas leídas por consulta
+# al transmitir, y máximo de features que se devuelven en el estado
+RESULT_PAGE_SIZE = 500
+RESULT_STREAM_CHUNK = 20
+RESULT_INLINE_MAX_FEATURES = 1000
+
+# Métricas de los análisis (ver apps/tree_capitator/metrics.py). Con
+# METRICS_TOKEN, /metrics exige "Authorization: Bearer <token>"
+METRICS_URL = "redis://dragonfly:6379/0"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# Funciones del resumen de las peticiones perfiladas (ver apps/tree_capitator/profiling.py)
+PROFILE_TOP_N = 30
+# Perfiles fuera de MEDIA_ROOT: sólo se descargan desde el admin
+PROFILE_ROOT = os.environ.get("PROFILE_ROOT", str(BASE_DIR / "private" / "profiles"))
+
+# Descripciones de los polígonos: "openai", "template" o "stub"
+DESCRIPTION_BACKEND = os.environ.get("DESCRIPTION_BACKEND", "openai")
+DESCRIPTION_MODEL = "gpt-3.5-turbo-instruct"
+DESCRIPTION_CONCURRENCY = 8
+DESCRIPTION_CACHE_URL = "redis://dragonfly:6379/5"
+DESCRIPTION_CACHE_TTL = 7 * 24 * 3600
+# Si es True, el resultado se guarda sin descripciones y se completan después
+DESCRIPTIONS_DEFERRED = False
 
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
 EMAIL_HOST = "smtp.gmail.com"
@@ -97,7 +166,16 @@ CELERY_BEAT_SCHEDULE = {
     "clean_temp_results": {
         "task": "clean_temp_results",
         "schedule": 3600,  # cada hora
-    }
+    },
+    "evict_polygon_results": {
+        "task": "apps.tree_capitator.tasks.evict_polygon_results",
+        "schedule": 3600,
+    },
+    # Huellas de los rasters registrados antes de existir el índice espacial
+    "index_raster_footprints": {
+        "task": "apps.tree_capitator.tasks.index_raster_footprints",
+        "schedule": 3600,
+    },
 }
 
 
@@ -144,6 +222,22 @@ FILE_UPLOAD_HANDLERS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Normalización de rasters a Cloud-Optimized GeoTIFF al registrarlos
+RASTER_TILE_SIZE = 256
+RASTER_COG_COMPRESS = "DEFLATE"
+RASTER_COG_LEVEL = 6
+
+# Datasets rasterio abiertos que conserva cada proceso del worker
+RASTER_POOL_MAX_OPEN = 64
+# Opciones de GDAL por proceso (la caché de bloques se multiplica por el
+# número de procesos de Celery y de ANALYSIS_POOL_SIZE)
+GDAL_CONFIG = {
+    "GDAL_CACHEMAX": os.environ.get("GDAL_CACHEMAX", "256"),   # MB
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "VSI_CACHE": "TRUE",
+    "VSI_CACHE_SIZE": str(16 * 1024 * 1024),
+}
+
 
 
 DATABASES = {